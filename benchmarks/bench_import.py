@@ -0,0 +1,101 @@
+"""
+Import-time benchmark for the 'restatement' package.
+
+Imports src.section in fresh interpreters, without OPENAI_API_KEY set, and reports the median
+import time and which heavy dependencies (langchain, openai, Chroma, tiktoken) were loaded.
+Fails if the import needs an API key, loads a heavy dependency, or exceeds the time budget.
+With --importtime, also prints the slowest modules reported by `python -X importtime`.
+
+Usage (from the repository root):
+    python benchmarks/bench_import.py
+    python benchmarks/bench_import.py --module src.utils_llm --budget 0.3 --importtime
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Modules that should only be imported once an LLM call, tokenizer or vector database is used.
+HEAVY_MODULES = ("langchain", "openai", "chromadb", "tiktoken")
+
+# Run in the child interpreter: imports the module and reports the time and heavy modules.
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+heavy = sorted({{name.split('.')[0] for name in sys.modules}} & set({heavy!r}))
+print(json.dumps({{"seconds": seconds, "heavy": heavy}}))
+"""
+
+
+def child_env():
+    """Returns the environment for the child interpreter, without an OpenAI API key."""
+    env = dict(os.environ)
+    env.pop("OPENAI_API_KEY", None)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")]))
+    return env
+
+
+def time_import(module):
+    """Imports module in a fresh interpreter and returns the seconds and heavy modules loaded."""
+    result = subprocess.run(
+        [sys.executable, "-c", CHILD.format(module=module, heavy=HEAVY_MODULES)],
+        cwd=ROOT,
+        env=child_env(),
+        capture_output=True,
+        text=True,
+        check=False
+    )
+    if result.returncode != 0:
+        raise SystemExit(f"Importing {module} failed without OPENAI_API_KEY:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(module, top):
+    """Returns the modules with the largest cumulative import time, in microseconds."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        env=child_env(),
+        capture_output=True,
+        text=True,
+        check=False
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--module", default="src.section")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=0.5, help="Maximum median seconds.")
+    parser.add_argument("--importtime", action="store_true")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    runs = [time_import(args.module) for _ in range(args.repeat)]
+    median = statistics.median(run["seconds"] for run in runs)
+    heavy = sorted(set().union(*(run["heavy"] for run in runs)))
+    print(f"import {args.module}: median {median * 1000:.1f} ms over {args.repeat} runs "
+          f"(budget {args.budget * 1000:.0f} ms)")
+    print(f"heavy modules loaded: {', '.join(heavy) or 'none'}")
+    if args.importtime:
+        for cumulative, name in slowest_imports(args.module, args.top):
+            print(f"{cumulative / 1000:10.1f} ms  {name}")
+    assert not heavy, f"Importing {args.module} loaded {', '.join(heavy)}"
+    assert median <= args.budget, f"Importing {args.module} took {median:.3f}s"
+
+
+if __name__ == "__main__":
+    main()
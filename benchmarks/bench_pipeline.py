@@ -0,0 +1,256 @@
+"""
+End-to-end benchmark of the Section pipeline against the offline stub backend.
+
+Builds synthetic sections of 10, 100 and 1,000 cases, runs every Section.process_* stage with
+StubBackend and StubEmbeddings (see src/utils_backend.py), and reports per stage:
+wall time, LLM calls, injected rate limit errors, prompt and completion tokens, and peak RSS.
+LLM calls are also broken down by the class and method that made them (see utils_telemetry).
+Results are written as JSON so runs can be compared between releases.
+
+Usage (from the repository root):
+    python benchmarks/bench_pipeline.py
+    python benchmarks/bench_pipeline.py --cases 10 100 --latency lognormal -1.5 0.5 \
+        --tokens-per-second 80 --rate-limit-rate 0.02 --output results.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.section import Section  # noqa: E402
+from src.utils_backend import StubBackend, StubEmbeddings, set_llm_backend  # noqa: E402
+from src.utils_llm import LLMSettings  # noqa: E402
+from src.utils_ratelimit import set_rate_limit  # noqa: E402
+from src.utils_telemetry import (  # noqa: E402
+    MemorySink,
+    add_telemetry_sink,
+    remove_telemetry_sink
+)
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+STAGES = (
+    "process_load_cases",
+    "process_brief_cases",
+    "process_extract",
+    "process_discern",
+    "process_comment",
+    "process_illustration",
+    "process_reporter",
+)
+
+WORDS = (
+    "court plaintiff defendant held contract void consideration statute frauds writing signed "
+    "party charged appellant argues trial erred granting summary judgment affirm reverse "
+    "remand promise reliance damages breach performance offer acceptance mutual assent"
+).split()
+
+
+def rss_bytes():
+    """Returns the resident set size of this process."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    with open("/proc/self/statm", encoding="utf-8") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+class PeakRSS:
+    """Samples RSS in a background thread and keeps the peak."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, rss_bytes())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = rss_bytes()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss_bytes())
+
+
+def write_cases(folder, count, seed=0):
+    """Writes count synthetic opinions as .rtf files."""
+    rng = random.Random(seed)
+    for i in range(count):
+        paragraphs = []
+        for _ in range(rng.randint(10, 80)):
+            sentences = [
+                " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 30))).capitalize() + "."
+                for _ in range(rng.randint(2, 6))
+            ]
+            paragraphs.append(" ".join(sentences))
+        body = "\\par\\par ".join(paragraphs)
+        name = f"Party{i} v. Party{i + count}"
+        with open(os.path.join(folder, f"{name}.rtf"), "w", encoding="utf-8") as f:
+            f.write("{\\rtf1\\ansi\\deff0 " + body + "}")
+
+
+def run_section(count, backend, settings, keep_outputs=False):
+    """Runs every stage on a synthetic section and returns the per-stage results."""
+    folder = tempfile.mkdtemp(prefix=f"bench_cases_{count}_")
+    write_cases(folder, count)
+    section = Section(settings)
+    section.set_section_title(f"Benchmark Section {count}")
+    section.set_area_of_law("contracts")
+    section.set_restatement_title("Restatement of Benchmarks")
+    section.set_description("Synthetic section for benchmarking the pipeline.")
+    section.set_cases_path(folder)
+    # Each run gets its own folder, so it does not resume from the briefs checkpoint of an
+    # earlier run, which is kept above the dated folder.
+    section.set_path(name=f"benchmark_{count}_cases_{int(time.time())}", date="run")
+    results = []
+    try:
+        for stage in STAGES:
+            before = backend.stats()
+            with PeakRSS() as peak:
+                start = time.perf_counter()
+                getattr(section, stage)()
+                wall = time.perf_counter() - start
+            after = backend.stats()
+            result = {
+                "stage": stage,
+                "wall_s": round(wall, 4),
+                "llm_calls": after["calls"] - before["calls"],
+                "rate_limit_errors": after["rate_limit_errors"] - before["rate_limit_errors"],
+                "prompt_tokens": after["prompt_tokens"] - before["prompt_tokens"],
+                "completion_tokens": after["completion_tokens"] - before["completion_tokens"],
+                "peak_rss_mb": round(peak.peak / 2 ** 20, 1),
+            }
+            results.append(result)
+            print(
+                f"{count:5} cases  {stage:22} {result['wall_s']:9.2f}s  "
+                f"calls={result['llm_calls']:6}  prompt={result['prompt_tokens']:10}  "
+                f"completion={result['completion_tokens']:9}  rss={result['peak_rss_mb']:8.1f}MB"
+            )
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+        if not keep_outputs:
+            shutil.rmtree(os.path.dirname(section.path), ignore_errors=True)
+    return results
+
+
+def git_commit():
+    """Returns the current commit hash, or None outside a git checkout."""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+            text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--cases", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument(
+        "--latency", nargs="+", default=["constant", "0"],
+        help="Latency distribution and parameters, e.g. 'uniform 0.2 1.0'."
+    )
+    parser.add_argument("--tokens-per-second", type=float, default=None)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--output-tokens", type=int, default=200)
+    parser.add_argument("--max-concurrency", type=int, default=LLMSettings.max_concurrency)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Path of the JSON results file.")
+    parser.add_argument("--keep-outputs", action="store_true")
+    args = parser.parse_args()
+
+    latency = (args.latency[0],) + tuple(float(value) for value in args.latency[1:])
+    # Every cache that persists between runs is off, so each run does the full work and runs can
+    # be compared. The parse cache is keyed by file path, and the cases are written to a new
+    # folder for each run, so it never hits.
+    settings = LLMSettings(
+        cache_scope=None,
+        brief_library=False,
+        embedding_cache=False,
+        max_concurrency=args.max_concurrency
+    )
+    settings.embeddings = StubEmbeddings()
+    # The stub answers instantly, so the account's rate limits would dominate the timings.
+    for model in (settings.model, settings.model_long):
+        set_rate_limit(model, tokens_per_minute=10 ** 12, requests_per_minute=10 ** 9)
+
+    runs = []
+    for count in args.cases:
+        backend = StubBackend(
+            latency=latency,
+            tokens_per_second=args.tokens_per_second,
+            rate_limit_rate=args.rate_limit_rate,
+            retry_after=0.01,
+            output_tokens=args.output_tokens,
+            seed=args.seed
+        )
+        set_llm_backend(backend)
+        telemetry = MemorySink(keep_events=False)
+        add_telemetry_sink(telemetry)
+        start = time.perf_counter()
+        stages = run_section(count, backend, settings, args.keep_outputs)
+        remove_telemetry_sink(telemetry)
+        runs.append({
+            "cases": count,
+            "wall_s": round(time.perf_counter() - start, 4),
+            "llm_calls": sum(stage["llm_calls"] for stage in stages),
+            "prompt_tokens": sum(stage["prompt_tokens"] for stage in stages),
+            "completion_tokens": sum(stage["completion_tokens"] for stage in stages),
+            "peak_rss_mb": max(stage["peak_rss_mb"] for stage in stages),
+            "stages": stages,
+            "calls_by_method": telemetry.summary(),
+        })
+    set_llm_backend(None)
+
+    report = {
+        "benchmark": "pipeline",
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "latency": list(latency),
+            "tokens_per_second": args.tokens_per_second,
+            "rate_limit_rate": args.rate_limit_rate,
+            "output_tokens": args.output_tokens,
+            "max_concurrency": args.max_concurrency,
+            "seed": args.seed,
+        },
+        "runs": runs,
+    }
+    output = args.output or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "results",
+        f"pipeline_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
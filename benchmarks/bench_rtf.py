@@ -0,0 +1,125 @@
+"""
+Benchmark of the RTF engines used by LoadCases.
+
+Converts RTF files with striprtf's rtf_to_text and with utils_rtf.rtf_to_text, checks that both
+return the same text for every file, and prints the time each took. The files are either the
+.rtf files in a folder, or synthetic opinions in the shape exported by research services: a font
+table, a color table and a stylesheet, paragraphs with escaped quotes and unicode characters,
+and embedded pictures as hex and as \\bin data.
+
+Usage (from the repository root):
+    python benchmarks/bench_rtf.py
+    python benchmarks/bench_rtf.py --folder data/cases/my_cases --top 10
+    python benchmarks/bench_rtf.py --files 20 --paragraphs 200 --picture-kb 512
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from striprtf.striprtf import rtf_to_text as striprtf_to_text  # noqa: E402
+
+from src.utils_rtf import rtf_to_text  # noqa: E402
+
+WORDS = (
+    "court plaintiff defendant held that the contract was void because consideration "
+    "failed and the statute of frauds requires a writing signed by the party to be charged "
+    "appellant argues trial erred in granting summary judgment we affirm reverse remand"
+).split()
+
+HEADER = (
+    "{\\rtf1\\ansi\\ansicpg1252\\deff0"
+    "{\\fonttbl{\\f0\\froman\\fcharset0 Times New Roman;}{\\f1\\fswiss\\fcharset0 Arial;}"
+    "{\\f2\\fnil\\fcharset2 Symbol;}}"
+    "{\\colortbl;\\red0\\green0\\blue0;\\red0\\green0\\blue255;}"
+    "{\\stylesheet{\\s0\\f0\\fs24 Normal;}{\\s1\\f1\\fs28\\b Heading 1;}}"
+    "{\\*\\generator Riched20 10.0.19041;}\\viewkind4\\uc1\n"
+)
+
+
+def make_opinion(rng, paragraphs, picture_kb):
+    """Returns a synthetic opinion as RTF."""
+    parts = [HEADER]
+    for i in range(paragraphs):
+        sentences = []
+        for _ in range(rng.randint(2, 6)):
+            words = [rng.choice(WORDS) for _ in range(rng.randint(6, 30))]
+            sentences.append(" ".join(words).capitalize() + ".")
+        text = " ".join(sentences)
+        text = text.replace(" the ", " \\ldblquote the\\rdblquote  ", 1)
+        text = text.replace(" court ", " court\\rquote s ", 1)
+        parts.append(f"\\pard\\s0\\f0\\fs24 {text} \\'a7 {i} \\u8212? \\par\n")
+        if picture_kb and i % 50 == 25:
+            data = bytes(rng.getrandbits(8) for _ in range(picture_kb * 1024 // 2))
+            if i % 100 == 25:
+                # Picture as hex, as most exporters write it
+                parts.append("{\\*\\shppict{\\pict\\pngblip\\picw100\\pich100 "
+                             + data.hex() + "}}\n")
+            else:
+                # Picture as raw binary data, decoded as latin-1 like the file would be
+                raw = data.decode("latin-1")
+                parts.append("{\\*\\shppict{\\pict\\pngblip\\bin" + str(len(raw)) + " "
+                             + raw + "}}\n")
+    parts.append("}")
+    return "".join(parts)
+
+
+def load_folder(folder):
+    """Returns the names and contents of the .rtf files in folder."""
+    documents = []
+    for filename in sorted(os.listdir(folder)):
+        if filename.endswith(".rtf"):
+            with open(os.path.join(folder, filename), 'r', encoding="utf-8") as f:
+                documents.append((filename, f.read()))
+    return documents
+
+
+def timed(func, *args):
+    """Returns the result of func and the seconds it took."""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--folder", default=None, help="Folder of .rtf files to convert.")
+    parser.add_argument("--files", type=int, default=10)
+    parser.add_argument("--paragraphs", type=int, default=150)
+    parser.add_argument("--picture-kb", type=int, default=256)
+    parser.add_argument("--top", type=int, default=5, help="Number of slowest files to list.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.folder:
+        documents = load_folder(args.folder)
+    else:
+        rng = random.Random(args.seed)
+        documents = [
+            (f"synthetic_{i}.rtf", make_opinion(rng, args.paragraphs, args.picture_kb))
+            for i in range(args.files)
+        ]
+    total_bytes = sum(len(content) for _, content in documents)
+    print(f"Input: {len(documents)} files, {total_bytes / 2 ** 20:.1f} MB")
+
+    rows = []
+    for filename, content in documents:
+        expected, striprtf_seconds = timed(striprtf_to_text, content)
+        result, fast_seconds = timed(rtf_to_text, content)
+        assert result == expected, f"The engines return different text for {filename}"
+        rows.append((striprtf_seconds, fast_seconds, filename))
+
+    striprtf_total = sum(row[0] for row in rows)
+    fast_total = sum(row[1] for row in rows)
+    print(f"striprtf={striprtf_total:8.3f}s  fast={fast_total:8.3f}s  "
+          f"speedup={striprtf_total / max(fast_total, 1e-9):6.1f}x")
+    print("Slowest files for striprtf:")
+    for striprtf_seconds, fast_seconds, filename in sorted(rows, reverse=True)[:args.top]:
+        print(f"  {filename:40} striprtf={striprtf_seconds:8.3f}s  fast={fast_seconds:8.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Microbenchmark for trim_for_tokens and trim_part_for_tokens.
+
+Builds a synthetic opinion of roughly the requested number of tokens, trims it to several
+budgets with the current implementation and with the original cut-and-recount loop, checks
+that both return the same string, and prints the time each took.
+
+Usage (from the repository root):
+    python benchmarks/bench_trim.py --tokens 100000 --budgets 3000 6000 12000
+    python benchmarks/bench_trim.py --skip-legacy
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.utils_llm import (  # noqa: E402
+    num_tokens,
+    trim_for_tokens,
+    trim_part_for_tokens,
+    trim_to_last_blank_line,
+)
+
+WORDS = (
+    "court plaintiff defendant held that the contract was void because consideration "
+    "failed and the statute of frauds requires a writing signed by the party to be charged "
+    "appellant argues trial erred in granting summary judgment we affirm reverse remand"
+).split()
+
+
+def legacy_trim_for_tokens(string, max_tokens=6000, max_attempts=3000):
+    """The original implementation of trim_for_tokens."""
+    tokens = num_tokens(string)
+    count = 1
+    while tokens > max_tokens and count < max_attempts:
+        if string == trim_to_last_blank_line(string):
+            string = string[:string.rfind(".")+1]
+            tokens = num_tokens(string)
+            count += 1
+            continue
+        string = trim_to_last_blank_line(string)
+        tokens = num_tokens(string)
+        count += 1
+    return string
+
+
+def legacy_trim_part_for_tokens(part, remainder, max_tokens=6000, trim_tokens=3000, max_attempts=3000):
+    """The original implementation of trim_part_for_tokens."""
+    if num_tokens(remainder) > max_tokens:
+        return legacy_trim_for_tokens(part, trim_tokens)
+    tokens = num_tokens(part + remainder)
+    count = 1
+    while tokens > max_tokens and count < max_attempts:
+        if part == trim_to_last_blank_line(part):
+            part = part[:part.rfind(".")+1]
+            tokens = num_tokens(part + remainder)
+            count += 1
+            continue
+        part = trim_to_last_blank_line(part)
+        tokens = num_tokens(part + remainder)
+        count += 1
+    return part
+
+
+def make_opinion(tokens, seed=0):
+    """Returns paragraphs of random sentences totalling roughly `tokens` tokens."""
+    rng = random.Random(seed)
+    paragraphs = []
+    words = 0
+    while words < tokens:
+        sentences = []
+        for _ in range(rng.randint(1, 6)):
+            length = rng.randint(5, 30)
+            words += length + 1
+            sentences.append(" ".join(rng.choice(WORDS) for _ in range(length)).capitalize() + ".")
+        paragraphs.append(" ".join(sentences))
+    return "\n\n".join(paragraphs)
+
+
+def timed(func, *args, **kwargs):
+    """Returns the result of func and the seconds it took."""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--tokens", type=int, default=100000)
+    parser.add_argument("--budgets", type=int, nargs="+", default=[3000, 6000, 12000])
+    parser.add_argument("--skip-legacy", action="store_true")
+    args = parser.parse_args()
+
+    opinion = make_opinion(args.tokens)
+    remainder = make_opinion(500, seed=1)
+    print(f"Input: {len(opinion)} characters, {num_tokens(opinion)} tokens")
+    for budget in args.budgets:
+        cases = [
+            ("trim_for_tokens", trim_for_tokens, legacy_trim_for_tokens, (opinion, budget)),
+            (
+                "trim_part_for_tokens",
+                trim_part_for_tokens,
+                legacy_trim_part_for_tokens,
+                (opinion, remainder, budget)
+            ),
+        ]
+        for name, func, legacy, func_args in cases:
+            result, seconds = timed(func, *func_args)
+            line = f"{name:22} budget={budget:6}  new={seconds:8.3f}s"
+            if not args.skip_legacy:
+                expected, legacy_seconds = timed(legacy, *func_args)
+                assert result == expected, f"{name} differs from the original at budget {budget}"
+                line += f"  legacy={legacy_seconds:8.3f}s  speedup={legacy_seconds / seconds:6.1f}x"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Benchmark of the vector stores used for briefs_db.
+
+Builds a store of synthetic briefs with Chroma and with NumpyVectorIndex, then times
+similarity_search queries against each, and checks that both return the same nearest brief for
+every query. Embeddings come from the offline StubEmbeddings, so no API key is needed and the
+time measured is the store's own. Each store is built and queried in its own process, so the
+peak memory reported for it is not mixed with the other.
+
+Usage (from the repository root):
+    python benchmarks/bench_vectordb.py
+    python benchmarks/bench_vectordb.py --briefs 5000 --queries 500 --dim 1536 --k 8
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+WORDS = (
+    "court plaintiff defendant held contract void consideration failed statute frauds "
+    "writing signed party charged appellant argues trial erred summary judgment affirm "
+    "reverse remand damages negligence duty breach causation reliance estoppel offer "
+    "acceptance revocation mistake duress unconscionable warranty merchantability"
+).split()
+
+
+def make_texts(count, seed):
+    """Returns count synthetic briefs."""
+    rng = random.Random(seed)
+    return [
+        f"Case Name: Party{i} v. Other\n" + " ".join(rng.choice(WORDS) for _ in range(120))
+        for i in range(count)
+    ]
+
+
+def build(backend, texts, embedding, directory):
+    """Builds a store of the texts with the backend."""
+    if backend == "numpy":
+        from src.utils_vectordb import NumpyVectorIndex
+        store = NumpyVectorIndex.from_texts(texts, embedding, persist_directory=directory)
+    else:
+        from langchain.vectorstores import Chroma
+        store = Chroma.from_texts(texts, embedding, persist_directory=directory)
+    store.persist()
+    return store
+
+
+def run_backend(args):
+    """Builds and queries one store, and prints the results as JSON."""
+    from src.utils_backend import StubEmbeddings
+    embedding = StubEmbeddings(size=args.dim)
+    texts = make_texts(args.briefs, args.seed)
+    queries = make_texts(args.queries, args.seed + 1)
+    start = time.perf_counter()
+    store = build(args.backend, texts, embedding, tempfile.mkdtemp())
+    build_seconds = time.perf_counter() - start
+    latencies = []
+    nearest = []
+    for query in queries:
+        start = time.perf_counter()
+        docs = store.similarity_search(query, k=args.k)
+        latencies.append(time.perf_counter() - start)
+        nearest.append(docs[0].page_content.split("\n")[0])
+    print(json.dumps({
+        "build": build_seconds,
+        "p50": statistics.median(latencies),
+        "p95": sorted(latencies)[int(len(latencies) * 0.95) - 1],
+        "total": sum(latencies),
+        "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "nearest": nearest
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--briefs", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--dim", type=int, default=1536, help="Size of the embeddings.")
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--backend", choices=["chroma", "numpy"], default=None,
+                        help="Run only this store in this process (used internally).")
+    args = parser.parse_args()
+    if args.backend:
+        run_backend(args)
+        return
+
+    print(f"{args.briefs} briefs, {args.queries} queries, dim={args.dim}, k={args.k}")
+    results = {}
+    for backend in ("chroma", "numpy"):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--backend", backend,
+             "--briefs", str(args.briefs), "--queries", str(args.queries),
+             "--dim", str(args.dim), "--k", str(args.k), "--seed", str(args.seed)],
+            check=True, capture_output=True, text=True
+        ).stdout
+        results[backend] = json.loads(output.strip().splitlines()[-1])
+        result = results[backend]
+        print(f"{backend:7} build={result['build']:7.3f}s  "
+              f"p50={result['p50'] * 1000:7.2f}ms  p95={result['p95'] * 1000:7.2f}ms  "
+              f"queries={result['total']:7.3f}s  peak_rss={result['rss_mb']:7.1f}MB")
+    agree = sum(a == b for a, b in zip(results["chroma"]["nearest"], results["numpy"]["nearest"]))
+    print(f"Same nearest brief for {agree} of {args.queries} queries.")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,46 +10,94 @@ llm calls (`utils_llm`), and string manipulation (`utils_string`).
 
 ## Attributes
 
-- `cases`: A list of cases to be converted into briefs.
+- `cases`: The cases to be converted into briefs: a list of strings, or a `CaseSource` from 
+`LoadCases`, which reads each case when it is needed instead of holding them all in memory, or a 
+`CorpusStore`, which slices each case from a memory-mapped file.
 - `section`: The section of the law that the cases belong to.
-- `briefs`: A list of briefs generated from the cases.
+- `briefs`: A list of briefs generated from the cases, in the order of the cases. Cases that 
+could not be briefed have no brief, so use `brief_sources` to match a brief to its case.
+- `brief_sources`: The index in `cases` of the case that each brief was made from.
 - `briefs_token_list`: A list of content from briefs, condensed so each item in list approaches 
 token length.
+- `briefs_token_sources`: For each item in `briefs_token_list`, the indices of the briefs it 
+contains.
 - `briefs_db`: A vector database of briefs.
+- `briefs_index`: A dict from the normalized case name and citations in the header of each brief 
+to the index of the brief. Names or citations shared by several briefs map to None.
+- `briefs_checkpoint`: The path of the checkpoint file that each brief is appended to as soon as 
+it is created (see `utils_checkpoint`). It is kept in the section's folder of outputs, above the 
+dated folder of each run, so a run that is resumed on a later day still finds it. With 
+`llm_settings.brief_library`, briefs are saved to the brief library instead and this is None.
+- `brief_failures`: The cases that could not be briefed, as a list of dicts with the `index` of 
+the case and the `error`.
 - `prompt_lst`: A list of prompts used to generate the briefs.
 - `prompts_str`: A string of prompts used to generate the briefs.
 
+## Functions
+
+- `remove_synopsis(case)`: Returns the case without the synopsis paragraph at its beginning.
+- `normalize_case_name(name)`: Returns a case name in lower case without punctuation, with 
+"versus" and "vs." written as "v", so that different spellings of a name compare equal.
+- `normalize_citations(text)`: Returns the reporter citations in text (e.g. "123 N.E.2d 456") 
+in lower case without spaces or punctuation.
+- `brief_header(brief)`: Returns the case name (or statute name) and citation from the header 
+of a brief.
+- `reference_name(reference)`: Returns the case name from a reference such as 
+"Smith v. Jones, 123 N.E.2d 456 (Mass. 1990)".
+
 ## Methods
 
 - `__init__(self, loadcases, section)`: Initializes the `BriefCases` class with a list of cases 
 and a section.
 - `remove_synopsis(self)`: Removes the synopsis from each case.
-- `llm_condense_case(self, case)`: Condenses a case to fit within the context window.
+- `llm_condense_case(self, case, max_tokens=None)`: Condenses a case to fit within the context 
+window.
+- `brief_prompts(self)`: Returns the system and human prompts used to brief a case. With 
+`llm_settings.brief_library`, the system prompt is prompt_brief_shared.txt, which does not name 
+the section or area of law, so that the brief can be reused by other sections.
 - `create_brief(self, case)`: Creates a brief from a case.
-- `create_briefs(self, start_index=0)`: Creates briefs for all of the cases.
-- `set_briefs_token_list(self)`: Sets `briefs_token_list` from `briefs`.
-- `set_briefs_db(self)`: Stores `briefs` in a vector database.
+- `checkpoint_dir(self)`: Returns the date-independent folder of the briefs checkpoint.
+- `case_digest(self, index)`: Returns a digest of the text of a case. For a CorpusStore it is the 
+stored content hash and for a CaseSource the parse cache key, so the case is not read.
+- `create_briefs(self)`: Creates briefs for all of the cases, `llm_settings.brief_workers` cases 
+at a time. Cases that fail are recorded in `brief_failures` and the other cases are still briefed. 
+Cases that already have a brief in the checkpoint file, or with `llm_settings.brief_library` in 
+the brief library shared by every section (see `utils_cache.BriefLibrary`), are not briefed again.
+- `set_briefs_token_list(self)`: Sets `briefs_token_list` and `briefs_token_sources` from 
+`briefs`.
+- `set_briefs_index(self)`: Sets `briefs_index` from the headers of `briefs`.
+- `find_brief(self, reference)`: Returns the brief of the case in a reference, found by 
+citation and then by name in `briefs_index`, or None if no single brief matches.
+- `set_briefs_db(self)`: Stores `briefs` in a vector database at `path_db/{section_title_short}.db`. 
+If the database is already saved there, only new briefs are embedded.
 - `load_briefs_db(self, path=None)`: Loads `briefs` from a vector database.
 - `get_outputs(self)`: Returns the outputs from this class.
 - `save_attributes(self)`: Saves attributes to a JSON file.
 - `load_attributes(self, filename=None)`: Loads attributes from a JSON file.
 - `save_to_md(self)`: Saves prompts and outputs to a markdown file.
 """
+import contextvars
+import itertools
 import logging
 import re
 import os
 import textwrap
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from src.baseclass import BaseClass
+from src.loadcases import CaseSource
+from src.utils_cache import get_brief_library, hash_key
+from src.utils_checkpoint import CheckpointStore
+from src.utils_corpus import CorpusStore
 from src.utils_file import (
     get_root_dir
 )
 from src.utils_llm import (
     llm_call,
     llm_call_long,
+    llm_condense_string,
+    llm_condense_tree,
     num_tokens,
-    sleep_for_tokens,
-    string_to_token_list,
-    list_to_token_list,
+    iter_token_chunks,
     list_to_db,
     load_db
 )
@@ -62,6 +110,74 @@ from src.utils_string import (
 # Set up logger
 logger = logging.getLogger('restatement')
 
+# Number of characters at the top of a brief that are searched for its header.
+HEADER_CHARS = 2000
+# A field of the brief header, e.g. "Case Name: Smith v. Jones" or "**Citation**".
+HEADER_FIELD = r"^[^\w\n]*{label}\b[^\w\n]*(.*)$"
+# Labels of the header fields.
+HEADER_LABELS = r"(?:case\s+name|name|citation|jurisdiction|year)"
+# A reporter citation: volume, reporter abbreviation and first page, e.g. "123 Cal. App. 4th 456".
+CITATION = re.compile(r"\b\d{1,4}\s+[A-Za-z][A-Za-z0-9.' ]{0,24}?\s+\d{1,5}\b")
+# Bullets or numbers at the start of a line of a list.
+LIST_MARKER = re.compile(r"^\s*(?:[-*\u2022]|\d+[.)])\s+")
+
+
+def remove_synopsis(case):
+    """Return the case without the synopsis paragraph that may be at its beginning."""
+    # Check for 'synopsis' within the first 1500 characters
+    if 'synopsis' in case[:1500].lower():
+        # If 'synopsis' is found, then remove 'synopsis' and any material after it
+        # until it hits the '*'.
+        # The rest of the string after the first 1500 characters is kept intact.
+        return re.sub(r'Synopsis.*?\*', '', case[:1500], flags=re.DOTALL) + case[1500:]
+    return case
+
+
+def normalize_case_name(name):
+    """Return a case name in lower case without punctuation, with "versus" and "vs." as "v"."""
+    name = name.lower()
+    name = re.sub(r"\b(?:versus|vs)\b", " v ", name)
+    name = re.sub(r"[^a-z0-9&]+", " ", name).strip()
+    return re.sub(r"^the ", "", name)
+
+
+def normalize_citations(text):
+    """Return the reporter citations in text in lower case without spaces or punctuation."""
+    return [re.sub(r"[^a-z0-9]+", "", match.group().lower())
+            for match in CITATION.finditer(text)]
+
+
+def _header_field(header, label):
+    """Return the value of a field of a brief header, or "" if there is none."""
+    match = re.search(HEADER_FIELD.format(label=label), header, re.IGNORECASE | re.MULTILINE)
+    if match is None:
+        return ""
+    value = match.group(1).strip(" *_:")
+    if not value:
+        # The value may be on the line after the label, unless that line is another field.
+        for line in header[match.end():].split("\n"):
+            line = line.strip(" *_:")
+            if line:
+                if not re.match(HEADER_LABELS + r"\b", line, re.IGNORECASE):
+                    value = line
+                break
+    return value
+
+
+def brief_header(brief):
+    """Return the case name (or statute name) and citation from the header of a brief."""
+    header = brief[:HEADER_CHARS]
+    name = _header_field(header, r"case\s+name") or _header_field(header, "name")
+    return name, _header_field(header, "citation")
+
+
+def reference_name(reference):
+    """Return the case name from a reference such as "Smith v. Jones, 123 N.E.2d 456 (1990)"."""
+    reference = LIST_MARKER.sub("", reference)
+    reference = re.sub(r"^\W*case\s+name\W*", "", reference, flags=re.IGNORECASE)
+    # The name ends where the citation or the parenthetical begins.
+    return re.split(r",\s*\d|\s\d+\s|\(", reference, maxsplit=1)[0]
+
 
 class BriefCases(BaseClass):
     """Class for turning legal opinions into briefs.
@@ -79,10 +195,21 @@ class BriefCases(BaseClass):
         # Initialize attributes
         # List of briefs
         self.briefs = []
+        # Index of the case that each brief was made from (briefs[j] is the brief of
+        # cases[brief_sources[j]]), since cases that fail have no brief
+        self.brief_sources = []
         # List of content from briefs, condensed so each item in list approaches token length.
         self.briefs_token_list = []
+        # Indices of the briefs in each item of briefs_token_list
+        self.briefs_token_sources = []
         # Vector database of briefs
         self.briefs_db = []
+        # Index of each brief by normalized case name and citation (None if ambiguous)
+        self.briefs_index = {}
+        # Cases that could not be briefed: dicts with the index of the case and the error
+        self.brief_failures = []
+        # Checkpoint file that each brief is appended to as soon as it is created
+        self.briefs_checkpoint = None
 
     def remove_synopsis(self):
         """Remove the synopsis from each case.
@@ -91,35 +218,26 @@ class BriefCases(BaseClass):
         This function loops through the list of cases and removes the synopsis,
         if one is present.
         """
+        # A CaseSource or CorpusStore applies the change whenever a case is read, instead of
+        # keeping the text.
+        if isinstance(self.cases, (CaseSource, CorpusStore)):
+            self.cases.add_transform(remove_synopsis)
+            return
         for i, case in enumerate(self.cases):
-            # Check for 'synopsis' within the first 1500 characters
-            if 'synopsis' in case[:1500].lower():
-                # If 'synopsis' is found, then remove 'synopsis' and any material after it
-                # until it hits the '*'.
-                # The rest of the string after the first 1500 characters is kept intact.
-                self.cases[i] = re.sub(
-                    r'Synopsis.*?\*', '', case[:1500], flags=re.DOTALL) + case[1500:]
+            self.cases[i] = remove_synopsis(case)
 
     def llm_condense_case(
         self,
-        case
+        case,
+        max_tokens=None
     ):
         """ Condense a case to fit within the context window.
         This is similar to llm_utils' llm_condense_string function except that the first LLM call
         includes instructions to preserve case information that is usually at the beginning of 
-        a legal opinion.
+        a legal opinion. The chunks of the case are condensed concurrently.
+        If max_tokens is given, the case is condensed in tree-reduction rounds until it is at 
+        most max_tokens long (see llm_utils' llm_condense_tree).
         """
-        case_condensed = ""
-        prompts_str = ""
-
-        # Split up strings into token-sized list
-        texts = string_to_token_list(
-            case,
-            chunk_size=self.section.llm_settings.chunk_size_long,
-            chunk_overlap=self.section.llm_settings.chunk_overlap)
-        logger.debug(
-            "llm_condense_case: Number of strings to condense: %s", len(texts))
-
         # Set prompts for LLM.
         # Set brief condense prompt with contents from txt file
         prompt_brief_condense = set_full_prompt(
@@ -143,48 +261,53 @@ class BriefCases(BaseClass):
         # Set human prompt. Note that {query} is required for LLMChain to work.
         prompt_human = "Please write a shorter version of this: {query}"
 
-        # Call on LLM to condense each string in the list. Then add each output to case_condensed.
-        logger.debug(
-            "llm_condense_case: Condensing case. %s strings to condense.", len(texts))
-        for count, text in enumerate(texts):
-            if count == 0:
-                prompt_system = prompt_brief_condense0
-            else:
-                prompt_system = prompt_brief_condense
-            logger.debug(
-                "llm_condense_case: Condensing string %s of %s.", count, len(texts))
-            output, total_tokens, model, chat_prompt_str = llm_call_long(
-                prompt_system,
-                prompt_human,
-                query=text,
-                model=self.section.llm_settings.model_long
+        # Call on LLM to condense each token-sized string of the case. Then recombine the
+        # outputs in order.
+        logger.debug("llm_condense_case: Condensing case.")
+        settings = self.section.llm_settings
+        if max_tokens is None:
+            case_condensed, prompt_lst = llm_condense_string(
+                case,
+                prompt_brief_condense,
+                model=settings.model_long,
+                chunk_size=settings.chunk_size_long,
+                chunk_overlap=settings.chunk_overlap,
+                max_concurrency=settings.max_concurrency,
+                prompt_condense_first=prompt_brief_condense0,
+                human_template=prompt_human,
+                separator="\n \n"
             )
-
-            case_condensed += output["text"] + "\n \n"
-            prompts_str += chat_prompt_str + "\n \n"
-            logger.debug(
-                "llm_condense_case: String str(%s+1) of %s condensed.", count, len(texts))
-
-            # Sleep for tokens
-            sleep_for_tokens(total_tokens, model)
+        else:
+            case_condensed, prompt_lst = llm_condense_tree(
+                case,
+                prompt_brief_condense,
+                max_tokens,
+                model=settings.model_long,
+                chunk_size=settings.chunk_size_long,
+                chunk_overlap=settings.chunk_overlap,
+                max_rounds=settings.max_attempts,
+                max_concurrency=settings.max_concurrency,
+                prompt_condense_first=prompt_brief_condense0,
+                human_template=prompt_human,
+                separator="\n \n"
+            )
+        prompts_str = "".join(prompt + "\n \n" for prompt in prompt_lst)
+        logger.debug("llm_condense_case: %s strings condensed.", len(prompt_lst))
 
         return case_condensed, prompts_str
 
-    def create_brief(self, case):
-        """Create a brief from a case.
-        Returns a tuple of the output, tokens used, and model used. Tokens and model are
-        used to calculate the amount of time to sleep between API calls.
-        This is a modified version of the llm_router function. The loops are modified to make
-        sure that case specific information is not lost.
+    def brief_prompts(self):
+        """Return the system and human prompts used to brief a case.
+        Briefs for the brief library use a prompt that does not name the section, so that the
+        same prompt, and so the same brief, serves every section.
         """
-        # Initialize variable that will store the prompts used in this method.
-        brief_prompts = ""
-
-        # Set prompts for LLM.
+        if self.section.llm_settings.brief_library:
+            name = "prompt_brief_shared.txt"
+        else:
+            name = "prompt_brief.txt"
         # Set system prompt with contents from txt file
         prompt_system = set_full_prompt(
-            os.path.join(get_root_dir(), "data", "prompts",
-                         "brief", "prompt_brief.txt"),
+            os.path.join(get_root_dir(), "data", "prompts", "brief", name),
             self.section
         )
         # Set human prompt. Note that {query} is required for LLMChain to work.
@@ -194,12 +317,41 @@ class BriefCases(BaseClass):
             {query}
             """
         )
+        return prompt_system, prompt_human
+
+    def create_brief(self, case):
+        """Create a brief from a case.
+        Returns a tuple of the output, tokens used, and model used. Tokens and model are
+        used to calculate the amount of time to sleep between API calls.
+        This is a modified version of the llm_router function. The loops are modified to make
+        sure that case specific information is not lost.
+        """
+        # Initialize variable that will store the prompts used in this method.
+        brief_prompts = ""
+
+        # Set prompts for LLM.
+        prompt_system, prompt_human = self.brief_prompts()
         query = case
-        total_tokens = num_tokens(prompt_system + prompt_human + query)
+        # The input is counted with the long model's tokenizer for its limit, and again with
+        # the short model's for the choice of model.
+        model_long = self.section.llm_settings.model_long
+        total_tokens = num_tokens(prompt_system + prompt_human + query, model=model_long)
 
         # Initialize attempts
         attempts = 0
 
+        # If tree reduction is on, condense the case in rounds instead of the loop below.
+        if (self.section.llm_settings.condense_tree and
+                total_tokens > self.section.llm_settings.max_tokens_long):
+            query, prompts_str = self.llm_condense_case(
+                query,
+                max_tokens=(self.section.llm_settings.max_tokens_long
+                            - num_tokens(prompt_system + prompt_human, model=model_long))
+            )
+            attempts = self.section.llm_settings.max_attempts
+            brief_prompts += "##Condense prompt \n \n" + prompts_str + "\n \n \n"
+            total_tokens = num_tokens(prompt_system + prompt_human + query, model=model_long)
+
         # If the token length of the case is too long, then condense it.
         while (total_tokens > self.section.llm_settings.max_tokens_long and
                attempts < self.section.llm_settings.max_attempts):
@@ -208,10 +360,12 @@ class BriefCases(BaseClass):
             query, prompts_str = self.llm_condense_case(query)
             attempts += 1
             brief_prompts += "##Condense prompt \n \n" + prompts_str + "\n \n \n"
-            total_tokens = num_tokens(prompt_system + prompt_human + query)
+            total_tokens = num_tokens(prompt_system + prompt_human + query, model=model_long)
 
         # If token length is under max tokens, then use the regular llm_call function.
-        if total_tokens <= self.section.llm_settings.max_tokens:
+        if (num_tokens(prompt_system + prompt_human + query,
+                       model=self.section.llm_settings.model)
+                <= self.section.llm_settings.max_tokens):
             logger.debug(
                 "create_brief: Case is under max tokens. Using regular llm_call.")
             brief, total_tokens, model, chat_prompt_str = llm_call(
@@ -239,52 +393,177 @@ class BriefCases(BaseClass):
 
         return (brief, total_tokens, model, brief_prompts)
 
-    def create_briefs(self, start_index=0):
+    def create_briefs(self):
         """Create briefs for all of the cases.
-        start_index can be specified if a previous run was interrupted.
+        Cases are briefed llm_settings.brief_workers at a time, longest first, so that a long
+        case is not left to run alone at the end. briefs and prompt_lst keep the order of the
+        cases. A case that fails is logged and recorded in brief_failures, and the remaining
+        cases are still briefed.
+        Each brief is appended to the checkpoint file as soon as it is created, and cases that
+        already have a brief there are not briefed again. So after a crash, running this again
+        only briefs the cases that were not finished.
+        With llm_settings.brief_library, the brief library takes the place of the checkpoint
+        file: briefs are saved to it as they are created, and cases briefed by any section with
+        the same models are taken from it.
         """
-        # If starting from beginning, then clear the briefs list and prompts list.
-        if start_index == 0:
-            self.briefs = []
-            self.prompt_lst = []
-        # Loop through each case and create a brief.
-        for i, case in enumerate(self.cases[start_index:]):
-            try:
-                logger.info("create_briefs: Creating brief %s of %s.",
-                            i + start_index, len(self.cases))
-                # Create brief for case
-                brief, total_tokens, model, brief_prompts = self.create_brief(
-                    case)
-                # Append brief to list of briefs
-                self.briefs.append(brief['text'])
-                # Append brief prompts to list of prompts
-                self.prompt_lst.append(brief_prompts)
-                # Sleep function to prevent hitting API limit.
-                sleep_for_tokens(total_tokens, model)
-            except Exception as e:
-                logger.critical(
-                    "Exception occurred at index %s: %s", i + start_index, e)
-                logger.critical(
-                    "Please run create_briefs(%s) to resume from this index.", i + start_index)
-                break
+        self.briefs = []
+        self.brief_sources = []
+        self.prompt_lst = []
+        self.brief_failures = []
+        workers = max(1, self.section.llm_settings.brief_workers)
+        settings = self.section.llm_settings
+        library = get_brief_library() if settings.brief_library else None
+        # Briefs are saved to the brief library, which is shared by every section, or else to
+        # the section's checkpoint file, never to both.
+        if library is not None:
+            self.briefs_checkpoint = None
+            load, save, where = library.get_brief, library.set_brief, "the brief library"
+        else:
+            if self.briefs_checkpoint is None:
+                self.briefs_checkpoint = os.path.join(self.checkpoint_dir(),
+                                                      "briefs_checkpoint.jsonl")
+            store = CheckpointStore(self.briefs_checkpoint)
+            load, save, where = store.get, store.put, self.briefs_checkpoint
+        # Briefs are keyed by a hash of the case, the brief prompts and the models, so a brief
+        # is not reused after any of them changes. With the brief library the prompts do not
+        # name the section, so the key is the same in every section.
+        parts = (*self.brief_prompts(), settings.model, settings.model_long)
+        # Cases from a CaseSource or CorpusStore are keyed by a digest they already store, so a
+        # resumed run does not read the corpus again before briefing the rest.
+        keys = [hash_key(self.case_digest(i), *parts) for i in range(len(self.cases))]
+        # Briefs and prompts of the cases that were already briefed
+        results = [load(key) for key in keys]
+        todo = [i for i, result in enumerate(results) if result is None]
+        if len(todo) < len(self.cases):
+            logger.info("create_briefs: %s of %s cases already briefed in %s.",
+                        len(self.cases) - len(todo), len(self.cases), where)
+        # Longest cases first, by characters as a cheap stand-in for tokens.
+        if isinstance(self.cases, (CaseSource, CorpusStore)):
+            length = self.cases.length
+        else:
+            length = lambda i: len(self.cases[i])
+        order = iter(sorted(todo, key=length, reverse=True))
+        count = 0
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="brief") as executor:
+            # Cases are read when they are submitted, and only twice as many cases as workers
+            # are submitted at once, so the text of a case is dropped soon after its brief is
+            # saved. Each case runs in a copy of the current context, so telemetry_stage still
+            # applies.
+            futures = {}
+            while True:
+                for i in itertools.islice(order, 2 * workers - len(futures)):
+                    futures[executor.submit(
+                        contextvars.copy_context().run, self.create_brief, self.cases[i]
+                    )] = i
+                if not futures:
+                    break
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = futures.pop(future)
+                    count += 1
+                    self._save_brief(future, i, count, len(todo), keys, results, save)
+        # Keep the briefs and their prompts in the order of the cases, and record which case
+        # each brief belongs to.
+        for i, result in enumerate(results):
+            if result is not None:
+                self.briefs.append(result['brief'])
+                self.brief_sources.append(i)
+                self.prompt_lst.append(result['prompts'])
+        self.brief_failures.sort(key=lambda failure: failure['index'])
+        if self.brief_failures:
+            logger.warning("create_briefs: %s of %s cases could not be briefed: %s",
+                           len(self.brief_failures), len(self.cases),
+                           [failure['index'] for failure in self.brief_failures])
         # Create a list of token-sized text from the briefs.
-        self.briefs_token_list = list_to_token_list(
-            self.briefs,
-            self.section.llm_settings.chunk_size,
-            self.section.llm_settings.chunk_overlap
-        )
+        self.set_briefs_token_list()
+        # Index the briefs by case name and citation.
+        self.set_briefs_index()
+
+    def case_digest(self, index):
+        """Return a digest of the text of a case, without reading it if the cases store one.
+        """
+        if isinstance(self.cases, CorpusStore):
+            digest = self.cases.content_hash(index)
+        elif isinstance(self.cases, CaseSource):
+            # The parse cache key covers the file's path, modification time and size, and the
+            # RTF engine.
+            digest = self.cases.entries[index][2]
+        else:
+            return hash_key(self.cases[index])
+        # The transforms change the text when it is read, so they are part of the digest.
+        return hash_key(digest, *(f"{func.__module__}.{func.__qualname__}"
+                                  for func in self.cases.transforms))
+
+    def checkpoint_dir(self):
+        """Return the folder of the briefs checkpoint: the folder that holds the section's dated
+        output folders (outputs/<name>), or outputs/<short title> if no path is set.
+        """
+        if self.section.path:
+            return os.path.dirname(os.path.normpath(self.section.path))
+        return os.path.join(get_root_dir(), "outputs", self.section.section_title_short)
+
+    def _save_brief(self, future, i, count, total, keys, results, save):
+        """Save the brief of case i from a finished future, or record why it failed.
+        """
+        try:
+            brief, total_tokens, model, brief_prompts = future.result()
+        except Exception as e:
+            logger.error("create_briefs: Exception occurred at index %s: %s", i, e)
+            self.brief_failures.append({'index': i, 'error': f"{type(e).__name__}: {e}"})
+            return
+        results[i] = {'brief': brief['text'], 'prompts': brief_prompts}
+        # Save the brief before moving on, so it survives a crash.
+        save(keys[i], results[i])
+        logger.info("create_briefs: Created brief %s of %s (case %s).", count, total, i)
 
     def set_briefs_token_list(self):
-        """Set briefs_token_list from briefs.
+        """Set briefs_token_list from briefs, and briefs_token_sources to the indices of the
+        briefs in each item.
         """
-        self.briefs_token_list = list_to_token_list(
+        chunks = list(iter_token_chunks(
             self.briefs,
             self.section.llm_settings.chunk_size,
-            self.section.llm_settings.chunk_overlap
-        )
+            self.section.llm_settings.chunk_overlap,
+            self.section.llm_settings.first_fit_decreasing
+        ))
+        self.briefs_token_list = [chunk for chunk, _ in chunks]
+        self.briefs_token_sources = [sources for _, sources in chunks]
+
+    def set_briefs_index(self):
+        """Set briefs_index from the case name and citation in the header of each brief.
+        A name or citation that appears in more than one brief maps to None, so that a lookup
+        never picks one of them at random.
+        """
+        self.briefs_index = {}
+        for i, brief in enumerate(self.briefs):
+            name, citation = brief_header(brief)
+            keys = set(normalize_citations(citation))
+            if normalize_case_name(name):
+                keys.add(normalize_case_name(name))
+            for key in keys:
+                if key in self.briefs_index and self.briefs_index[key] != i:
+                    self.briefs_index[key] = None
+                else:
+                    self.briefs_index[key] = i
+        logger.info("set_briefs_index: Indexed %s briefs under %s names and citations.",
+                    len(self.briefs), len(self.briefs_index))
+
+    def find_brief(self, reference):
+        """Return the brief of the case in a reference, or None if no single brief matches.
+        The reference is looked up by its citations first, then by its case name.
+        """
+        keys = normalize_citations(reference)
+        keys.append(normalize_case_name(reference_name(reference)))
+        for key in keys:
+            i = self.briefs_index.get(key)
+            if i is not None:
+                return self.briefs[i]
+        return None
 
     def set_briefs_db(self):
         """Store briefs in a vector database.
+        The database is saved where load_briefs_db looks for it. Briefs that are already in a
+        saved database are not embedded again.
         """
         self.briefs_db = list_to_db(
             lst=self.briefs,
@@ -300,7 +579,7 @@ class BriefCases(BaseClass):
         if path is None:
             path = os.path.join(self.section.path_db,
                                 f"{self.section.section_title_short}.db")
-        self.briefs_db = load_db(path)
+        self.briefs_db = load_db(path, self.section.llm_settings.embeddings)
 
     def get_outputs(self):
         """Get outputs from this class.
@@ -319,6 +598,8 @@ class BriefCases(BaseClass):
         if filename is None:
             filename = os.path.join(self.section.path_json, "briefcases.json")
         self.load_from_json(filename)
+        # Rebuild the index, which older files do not have.
+        self.set_briefs_index()
 
     def save_to_md(self):
         """Save prompts and outputs to markdown file.
@@ -38,11 +38,14 @@ from src.utils_file import (
 )
 from src.utils_llm import (
     num_tokens,
-    sleep_for_tokens,
     llm_router,
     llm_router_gpt4,
     trim_part_for_tokens
 )
+from src.utils_retriever import (
+    TokenBudgetRetriever,
+    token_budget
+)
 from src.utils_string import (
     set_full_prompt,
     get_timestamp,
@@ -148,9 +151,6 @@ class Comment(BaseClass):
         self.prompt_lst.append(save_used_prompts(
             "## Outline prompts", prompt_lst))
 
-        # Sleep for tokens
-        sleep_for_tokens(total_tokens, model)
-
     def create_comment(self, heading):
         """Create a component of the Comment.
         """
@@ -168,54 +168,21 @@ class Comment(BaseClass):
         Your notes are:
         {query}
         """)
-        # Retrieve relevant briefs
-        k = 1
-        relevant_briefs = []
-        # Get relevant briefs, looping until token limit is reached or
-        # maximum k value is exceeded
-        while True:
-            try:
-                # Get relevant briefs from briefs_db (vector database)
-                relevant_briefs_x = self.briefcases.briefs_db.similarity_search(
-                    heading, k=k)
-            except Exception:
-                break
-            # Convert relevant briefs to a list of strings
-            relevant_briefs_x_doc = [
-                doc.page_content for doc in relevant_briefs]
-            # Join the list of strings with newline characters
-            relevant_briefs_x_str = "\n \n".join(relevant_briefs_x_doc)
-            # Calculate token length of input variables
-            input_tokens = (
-                num_tokens(relevant_briefs_x_str)
-                + num_tokens(heading)
-                + num_tokens(self.provision_final)
-                + num_tokens(self.outline_str)
-                + num_tokens(self.explanation)
-                + num_tokens(prompt_system)
-                + num_tokens(prompt_human)
-            )
-            # Check if token limit is exceeded
-            if input_tokens > self.section.llm_settings.chunk_size:
-                # If so, break out of loop
-                break
-            # Check if we have collected eight briefs
-            if k >= 8:
-                # If so, break out of loop
-                relevant_briefs = relevant_briefs_x
-                break
-            # If token limit is not exceeded and maximum k value is not exceeded,
-            # increment k, set relevant_briefs and continue loop
-            k += 1
-            relevant_briefs = relevant_briefs_x
-
-        # If the relevant_briefs list has items, then set relevant_briefs_str
-        if len(relevant_briefs) > 0:
-            relevant_briefs_doc = [doc.page_content for doc in relevant_briefs]
-            relevant_briefs_str = "\n \n".join(relevant_briefs_doc)
-        # Otherwise, set relevant_briefs_str to empty string
-        else:
-            relevant_briefs_str = ""
+        # Retrieve up to eight relevant briefs that fit in the tokens left after the other
+        # input variables.
+        budget = token_budget(
+            self.section.llm_settings.chunk_size,
+            heading,
+            self.provision_final,
+            self.outline_str,
+            self.explanation,
+            prompt_system,
+            prompt_human
+        )
+        retrieval = TokenBudgetRetriever(self.briefcases.briefs_db).retrieve(heading, 8, budget)
+        logger.debug("create_comment: Using %s briefs (%s of %s tokens).",
+                     len(retrieval.documents), retrieval.used_tokens, budget)
+        relevant_briefs_str = retrieval.text
 
         # Set query to include the provision, outline, heading, explanation, and relevant briefs
         query = textwrap.dedent(
@@ -273,8 +240,6 @@ class Comment(BaseClass):
             self.comments.append(output['text'])
             # Add prompts to temporary prompt list.
             self.prompt_temp += prompt_lst
-            # Sleep for tokens
-            sleep_for_tokens(total_tokens, model)
 
         # Join comments into a single string
         self.comments_str = "\n \n".join(self.comments)
@@ -54,7 +54,6 @@ from src.utils_file import (
 )
 from src.utils_llm import (
     num_tokens,
-    sleep_for_tokens,
     llm_router,
     llm_router_gpt4,
     trim_part_for_tokens
@@ -157,9 +156,6 @@ class Discern(BaseClass):
         self.prompt_lst.append(save_used_prompts(
             "## Consensus prompts", prompt_lst))
 
-        # Sleep for tokens
-        sleep_for_tokens(total_tokens, model)
-
     def get_disagreement(self):
         """Decide what points of disagreement to include in the final rule based on notes about 
         disagreement produced by Group class instance.
@@ -221,9 +217,6 @@ class Discern(BaseClass):
         self.prompt_lst.append(save_used_prompts(
             "## Disagreement prompts", prompt_lst))
 
-        # Sleep for tokens
-        sleep_for_tokens(total_tokens, model)
-
     def resolve(self):
         """Resolve each point of disagreement.
         Do this by creating instances of Resolve class for each point of disagreement.
@@ -300,9 +293,6 @@ class Discern(BaseClass):
         self.prompt_lst.append(save_used_prompts(
             "## Resolve prompts", prompt_lst))
 
-        # Sleep for tokens
-        sleep_for_tokens(total_tokens, model)
-
     def get_clear(self):
         """Create notes on how the rule could be made more clear and logical.
         """
@@ -341,9 +331,6 @@ class Discern(BaseClass):
         self.prompt_lst.append(save_used_prompts(
             "## Clear prompts", prompt_lst))
 
-        # Sleep for tokens
-        sleep_for_tokens(total_tokens, model)
-
     def get_edit(self):
         """Create a revised, final rule based on notes for making rule more clear and logical.
         """
@@ -394,9 +381,6 @@ class Discern(BaseClass):
         self.prompt_lst.append(save_used_prompts(
             "## Edit prompts", prompt_lst))
 
-        # Sleep for tokens
-        sleep_for_tokens(total_tokens, model)
-
     def set_explanation(self):
         """Set explanation of rule.
         self.explanation is a string passed to Comment class as notes for determining what 
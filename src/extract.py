@@ -45,7 +45,6 @@ from src.utils_file import (
 )
 from src.utils_llm import (
     num_tokens,
-    sleep_for_tokens,
     string_to_token_list,
     llm_loop_gpt4,
     llm_condense_string,
@@ -182,7 +181,6 @@ class Extract(BaseClass):
             self.section.llm_settings
         )
 
-        sleep_for_tokens(total_tokens, model)
         return output['text'], prompt_lst
 
     def group_all(self):
@@ -252,8 +250,6 @@ class Extract(BaseClass):
         self.prompt_lst.append(save_used_prompts(
             "## Group synthesize prompts", prompt_lst))
 
-        sleep_for_tokens(total_tokens, model)
-
     def group_condense(self):
         """Condense notes on legal rules if the notes are too long for context window for
         subsequent LLM calls.
@@ -273,7 +269,8 @@ class Extract(BaseClass):
             prompt_system,
             self.section.llm_settings.model,
             self.section.llm_settings.chunk_size,
-            self.section.llm_settings.chunk_overlap
+            self.section.llm_settings.chunk_overlap,
+            max_concurrency=self.section.llm_settings.max_concurrency
         )
 
         # Save the prompts used in this method
@@ -305,7 +302,8 @@ class Extract(BaseClass):
 
         attempts = 0
         # Condense rules (if rules are too long for context window).
-        while (num_tokens(self.groups_str) > self.section.llm_settings.max_tokens
+        while (num_tokens(self.groups_str, model=self.section.llm_settings.model)
+               > self.section.llm_settings.max_tokens
                and attempts < self.section.llm_settings.max_attempts):
             self.group_condense()
             attempts += 1
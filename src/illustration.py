@@ -43,10 +43,13 @@ from src.utils_file import (
 )
 from src.utils_llm import (
     num_tokens,
-    sleep_for_tokens,
     llm_router,
     trim_part_for_tokens,
 )
+from src.utils_retriever import (
+    TokenBudgetRetriever,
+    token_budget
+)
 from src.utils_string import (
     set_full_prompt,
     get_timestamp,
@@ -181,9 +184,6 @@ class Illustration(BaseClass):
             # Add prompts to temporary prompt list.
             self.prompt_temp += prompt_lst
 
-            # Sleep for tokens
-            sleep_for_tokens(total_tokens, model)
-
         # Save the prompts used in this method
         self.prompt_lst.append(save_used_prompts(
             "## Illustration plan prompts", self.prompt_temp))
@@ -204,43 +204,19 @@ class Illustration(BaseClass):
         Write illustrations for this part of the Comment.
         Your notes are: {query}
         """)
-        # Get relevant briefs for query
-        k = 1
-        relevant_briefs = []
-        # Get relevant briefs, looping until token limit is reached or
-        # maximum k value is exceeded
-        while True:
-            # Get relevant briefs from briefs_db (vector database)
-            relevant_briefs_x = self.briefcases.briefs_db.similarity_search(
-                comment, k=k)
-            # Convert relevant briefs to a list of strings
-            relevant_briefs_x_doc = [
-                doc.page_content for doc in relevant_briefs]
-            # Join the list of strings with newline characters
-            relevant_briefs_x_str = "\n \n".join(relevant_briefs_x_doc)
-            # Calculate token length of input variables
-            input_tokens = (
-                num_tokens(relevant_briefs_x_str)
-                + num_tokens(self.provision)
-                + num_tokens(comment)
-                + num_tokens(prompt_system)
-                + num_tokens(prompt_human)
-            )
-            # Check if token limit is exceeded
-            if input_tokens > self.section.llm_settings.chunk_size:
-                # If so, break out of loop
-                break
-            # Check if we have collected five briefs
-            if k >= 5:
-                # If so, break out of loop
-                relevant_briefs = relevant_briefs_x
-                break
-            # If token limit is not exceeded and maximum k value is not exceeded,
-            # increment k, set relevant_briefs and continue loop
-            k += 1
-            relevant_briefs = relevant_briefs_x
-        relevant_briefs_doc = [doc.page_content for doc in relevant_briefs]
-        relevant_briefs_str = "\n \n".join(relevant_briefs_doc)
+        # Get up to five relevant briefs that fit in the tokens left after the other input
+        # variables.
+        budget = token_budget(
+            self.section.llm_settings.chunk_size,
+            self.provision,
+            comment,
+            prompt_system,
+            prompt_human
+        )
+        retrieval = TokenBudgetRetriever(self.briefcases.briefs_db).retrieve(comment, 5, budget)
+        logger.debug("create_ill: Using %s briefs (%s of %s tokens).",
+                     len(retrieval.documents), retrieval.used_tokens, budget)
+        relevant_briefs_str = retrieval.text
 
         # Set query to include the provision, comment, and briefs.
         query = textwrap.dedent(
@@ -315,9 +291,6 @@ class Illustration(BaseClass):
             # Add prompts to temporary prompt list.
             self.prompt_temp += prompt_lst
 
-            # Sleep for tokens
-            sleep_for_tokens(total_tokens, model)
-
         # Save the prompts used in this method
         self.prompt_lst.append(save_used_prompts(
             "## Illustration prompts", self.prompt_temp))
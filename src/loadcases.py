@@ -1,35 +1,157 @@
-"""This module contains the `LoadCases` class which is responsible for ingesting cases. 
+"""This module contains the `LoadCases` class which is responsible for ingesting cases.
 
 Currently, it only supports cases in .rtf format. Other methods can be introduced here.
-So long as the cases are stored as a list of strings in self.cases, the rest of the process should
-function.
+So long as the cases are stored as a sequence of strings in self.cases (a list, or a
+`CaseSource`), the rest of the process should function.
+
+Parsed text is cached on disk, keyed by the path, modification time and size of each file and by
+the engine, so unchanged files are only parsed once. The cache holds at most
+`llm_settings.parse_cache_max_mb` megabytes of text. A `CaseSource` reads its cases from the cache,
+so a case evicted from it is parsed again each time it is read; the limit should hold the whole
+corpus, or `llm_settings.corpus_store` should be used. Files that are not in the cache are parsed in
+`llm_settings.parse_workers` processes, with the engine named by `llm_settings.rtf_engine`:
+'fast' (`utils_rtf.rtf_to_text`, the default) or 'striprtf'. Both return the same text, but the
+fast engine skips font tables, pictures and binary data instead of reading them.
+
+With `llm_settings.corpus_store`, the parsed cases are also written to a memory-mapped corpus
+(see `utils_corpus.CorpusStore`) that is shared by every section that loads the same folder, and
+`cases` reads from it. Each case is then sliced from one file instead of being read from the
+parse cache, and the corpus can be handed to worker processes without copying the text. The
+corpus is rewritten only when a file in the folder has changed.
 
 ## Class: LoadCases
 
-The `LoadCases` class has methods for ingesting cases. It stores the cases as a list of strings.
+The `LoadCases` class has methods for ingesting cases. It stores the cases as a `CaseSource`.
 
 ### Attributes
 
 - `section`: The section object.
-- `cases`: A list of strings, where each string is a case.
+- `cases`: A `CaseSource` of the cases, where each case is a string, or a `CorpusStore` with
+`llm_settings.corpus_store`.
+- `parse_times`: A dict of the seconds it took to parse each file that was not in the cache,
+slowest first.
 
 ### Methods
 
 __init__(self, section)
-    The constructor for the `LoadCases` class. It initializes the `section` object and an empty 
+    The constructor for the `LoadCases` class. It initializes the `section` object and an empty
     list of `cases`.
 
 rtf_to_list(self)
-    This method loads .rtf files from a folder into a list of strings. Each string in the list 
-    represents a case.
+    This method loads .rtf files from a folder into a `CaseSource`. Each string in it represents
+    a case. Files are parsed into the parse cache as they finish, so the whole corpus is never
+    held in memory.
+
+get_corpus_path(self) -> str
+    Returns the path prefix of the corpus for the cases folder and RTF engine.
+
+write_corpus(self, source: CaseSource) -> CorpusStore
+    Writes the cases of source to the corpus, unless the corpus already holds the same files,
+    and returns the opened corpus.
+
+## Class: CaseSource
+
+A lazy sequence of cases. It keeps only the name, path, parse cache key and length of each case
+and reads a case's text from the parse cache when the case is accessed. The text is not kept,
+so once a case has been briefed nothing holds it in memory.
+
+CaseSource(entries: List[Tuple[str, str, str, int]], cache: SQLiteLRUCache, engine: str = 'fast')
+    entries are the name, path, parse cache key and length of each case. engine parses cases
+    that are no longer in the cache.
+    len(source), source[i] and iteration work as for a list of strings.
+    length(index: int) -> int
+        Returns the number of characters in a case without reading it.
+    add_transform(func: Callable[[str], str]) -> None
+        Applies func to the text of each case when it is read, e.g. to remove synopses.
+
+## Functions
+
+parse_rtf_file(path: str, engine: str = 'fast') -> Tuple[str, float]
+    Returns the text of an .rtf file and the seconds it took to parse with the engine ('fast' or
+    'striprtf'). Runs in worker processes.
 """
 import logging
 import os
-from striprtf.striprtf import rtf_to_text
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from striprtf.striprtf import rtf_to_text as striprtf_to_text
+
+from src.utils_cache import SQLiteLRUCache, hash_key
+from src.utils_corpus import CorpusStore
+from src.utils_file import get_root_dir
+from src.utils_rtf import rtf_to_text
 
 # Set up logger
 logger = logging.getLogger('restatement')
 
+# Number of slowest files whose parse times are logged.
+SLOWEST_FILES_LOGGED = 5
+# Parse caches opened by get_parse_cache, by path, so each is opened once per process.
+_parse_caches = {}
+_parse_caches_lock = threading.Lock()
+
+# RTF engines by name (see llm_settings.rtf_engine).
+RTF_ENGINES = {
+    'fast': rtf_to_text,
+    'striprtf': striprtf_to_text
+}
+
+
+def parse_rtf_file(path, engine='fast'):
+    """Returns the text of an .rtf file and the seconds it took to parse."""
+    start = time.perf_counter()
+    with open(path, 'r', encoding="utf-8") as f:
+        content = f.read()
+    text = RTF_ENGINES[engine](content)
+    return text, time.perf_counter() - start
+
+
+class CaseSource:
+    """A lazy sequence of cases.
+    Each case is read from the parse cache when it is accessed, and parsed again if it has
+    been evicted from the cache. Transforms added with add_transform are applied on every read.
+    """
+
+    def __init__(self, entries, cache, engine='fast'):
+        # (name, path, parse cache key, length) of each case
+        self.entries = entries
+        self.cache = cache
+        self.engine = engine
+        self.transforms = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        name, path, key, _ = self.entries[index]
+        value = self.cache.get(key)
+        if value is None:
+            text, _ = parse_rtf_file(path, self.engine)
+            self.cache.set(key, text.encode("utf-8"), length=len(text))
+        else:
+            text = value.decode("utf-8")
+        # Each case begins with its file name.
+        case = name + text
+        for transform in self.transforms:
+            case = transform(case)
+        return case
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def length(self, index):
+        """Return the number of characters in a case without reading it."""
+        return self.entries[index][3]
+
+    def add_transform(self, func):
+        """Apply func to the text of each case when it is read."""
+        if func not in self.transforms:
+            self.transforms.append(func)
+
 
 class LoadCases:
     """Methods for ingesting cases.
@@ -39,23 +161,140 @@ class LoadCases:
 
         # Section object.
         self.section = section
-        # List of strings, each string is a case.
+        # Sequence of strings, each string is a case.
         self.cases = []
+        # Seconds it took to parse each file that was not in the cache, slowest first.
+        self.parse_times = {}
+
+    def get_parse_cache(self):
+        """Return the on-disk cache of parsed text, shared by every section.
+        The cache is opened once per path and reused, so its connection is not left open by
+        every call.
+        """
+        path = os.path.join(get_root_dir(), "outputs", "cache", "parsed_cases.sqlite")
+        max_bytes = self.section.llm_settings.parse_cache_max_mb * 1024 * 1024
+        with _parse_caches_lock:
+            cache = _parse_caches.get(path)
+            if cache is None:
+                cache = _parse_caches[path] = SQLiteLRUCache(path, "parsed_rtf", max_bytes)
+            cache.max_bytes = max_bytes
+        return cache
 
     def rtf_to_list(self):
-        """Load .rtf files from a folder into a list of strings."""
+        """Load .rtf files from a folder into a CaseSource.
+        Files that are unchanged since they were last parsed are found in the parse cache.
+        The others are parsed in llm_settings.parse_workers processes with
+        llm_settings.rtf_engine, and stored in the cache as they finish, so no more than a few
+        cases are in memory at once.
+        """
         self.cases = []
+        self.parse_times = {}
         try:
-            for filename in os.listdir(self.section.cases_path):
-                if filename.endswith(".rtf"):
-                    with open(
-                        os.path.join(self.section.cases_path, filename),
-                        'r',
-                        encoding="utf-8"
-                    ) as f:
-                        name = str(filename.replace(".rtf", ""))
-                        content = f.read()
-                        text = name + rtf_to_text(content)
-                        self.cases += [text]
+            filenames = [
+                filename for filename in os.listdir(self.section.cases_path)
+                if filename.endswith(".rtf")
+            ]
         except IOError as e:
             logger.error("Failed to load .rtf files: %s", e)
+            return
+        cache = self.get_parse_cache()
+        engine = self.section.llm_settings.rtf_engine
+        # Look up each file by its path, modification time and size, and the engine.
+        paths = {}
+        keys = {}
+        for filename in filenames:
+            path = os.path.abspath(os.path.join(self.section.cases_path, filename))
+            try:
+                stat = os.stat(path)
+            except OSError as e:
+                logger.error("Failed to load %s: %s", filename, e)
+                continue
+            paths[filename] = path
+            keys[filename] = hash_key(path, stat.st_mtime_ns, stat.st_size, engine)
+        # The length of each text is stored with it, so cached texts are not read here.
+        stored = cache.get_lengths(keys.values())
+        lengths = {}
+        for filename, key in keys.items():
+            if key not in stored:
+                continue
+            if stored[key] is None:
+                # Stored before lengths were kept: read the text once and store its length.
+                value = cache.get(key)
+                if value is None:
+                    continue
+                text = value.decode("utf-8")
+                cache.set(key, value, length=len(text))
+                stored[key] = len(text)
+            lengths[filename] = stored[key]
+        # Parse the files that are not in the cache.
+        todo = [filename for filename in paths if filename not in lengths]
+        logger.info("rtf_to_list: %s files cached, %s to parse.", len(lengths), len(todo))
+        workers = max(1, self.section.llm_settings.parse_workers)
+        if workers > 1 and len(todo) > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(todo))) as executor:
+                futures = {executor.submit(parse_rtf_file, paths[filename], engine): filename
+                           for filename in todo}
+                for future in as_completed(futures):
+                    # Drop the future once it is stored, so its text can be freed.
+                    filename = futures.pop(future)
+                    self._store(cache, filename, keys[filename], lengths, future.result)
+        else:
+            for filename in todo:
+                self._store(cache, filename, keys[filename], lengths,
+                            lambda filename=filename: parse_rtf_file(paths[filename], engine))
+        self.parse_times = dict(
+            sorted(self.parse_times.items(), key=lambda item: item[1], reverse=True)
+        )
+        for filename, seconds in list(self.parse_times.items())[:SLOWEST_FILES_LOGGED]:
+            logger.info("rtf_to_list: Parsed %s in %.3f seconds.", filename, seconds)
+        # Keep the order of the folder listing. Each case begins with its file name.
+        entries = []
+        for filename in filenames:
+            if filename in lengths:
+                name = str(filename.replace(".rtf", ""))
+                entries.append((name, paths[filename], keys[filename],
+                                len(name) + lengths[filename]))
+        # Cases evicted from the parse cache are parsed again whenever they are read.
+        total = sum(entry[3] for entry in entries)
+        if total > 0.9 * cache.max_bytes:
+            logger.warning(
+                "rtf_to_list: The cases (about %s MB) do not fit in the parse cache (%s MB), so "
+                "some will be parsed again when they are read. Raise "
+                "llm_settings.parse_cache_max_mb or use llm_settings.corpus_store.",
+                total // (1024 * 1024), cache.max_bytes // (1024 * 1024)
+            )
+        self.cases = CaseSource(entries, cache, engine)
+        if self.section.llm_settings.corpus_store:
+            self.cases = self.write_corpus(self.cases)
+
+    def get_corpus_path(self):
+        """Return the path prefix of the corpus for the cases folder and RTF engine."""
+        key = hash_key(os.path.abspath(self.section.cases_path),
+                       self.section.llm_settings.rtf_engine)
+        return os.path.join(get_root_dir(), "outputs", "cache", "corpus", key)
+
+    def write_corpus(self, source):
+        """Write the cases of source to the corpus and return the opened corpus.
+        The corpus is kept if it holds the same files, by parse cache key, in the same order.
+        """
+        path = self.get_corpus_path()
+        keys = [entry[2] for entry in source.entries]
+        if CorpusStore.keys(path) == keys:
+            logger.info("rtf_to_list: Using the corpus at %s.", path)
+            return CorpusStore(path)
+        # Cases are read from the parse cache one at a time as they are written.
+        items = ((entry[0], source[i], entry[2]) for i, entry in enumerate(source.entries))
+        return CorpusStore.write(path, items)
+
+    def _store(self, cache, filename, key, lengths, parse):
+        """Parse a file and store its text in the parse cache. Files that fail are logged and
+        skipped.
+        """
+        try:
+            text, seconds = parse()
+        except Exception as e:
+            logger.error("Failed to parse %s: %s", filename, e)
+            return
+        cache.set(key, text.encode("utf-8"), length=len(text))
+        lengths[filename] = len(text)
+        self.parse_times[filename] = seconds
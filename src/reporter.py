@@ -36,10 +36,13 @@ from src.utils_file import (
 )
 from src.utils_llm import (
     num_tokens,
-    sleep_for_tokens,
     llm_router,
     trim_part_for_tokens
 )
+from src.utils_retriever import (
+    TokenBudgetRetriever,
+    token_budget
+)
 from src.utils_string import (
     set_full_prompt,
     get_timestamp,
@@ -96,46 +99,22 @@ class Reporter(BaseClass):
         {query}
         """)
 
-        # Get relevant briefs for query
-        k = 1
-        relevant_briefs = []
-        # Get relevant briefs, looping until token limit is reached or
-        # maximum k value is exceeded
-        while True:
-            try:
-                # Get relevant briefs from briefs_db (vector database)
-                relevant_briefs_x = self.briefcases.briefs_db.similarity_search(
-                    part, k=k)
-            except Exception:
-                break
-            # Convert relevant briefs to a list of strings
-            relevant_briefs_x_doc = [
-                doc.page_content for doc in relevant_briefs]
-            # Join the list of strings with newline characters
-            relevant_briefs_x_str = "\n \n".join(relevant_briefs_x_doc)
-            # Calculate token length of input variables
-            input_tokens = (
-                num_tokens(relevant_briefs_x_str)
-                + num_tokens(part)
-                + num_tokens(prompt_system)
-                + num_tokens(prompt_human)
-            )
-            # Check if token limit is exceeded
-            if input_tokens > self.section.llm_settings.chunk_size:
-                # If so, break out of loop
-                break
-            # Check if we have collected ten briefs
-            if k >= 10:
-                # If so, break out of loop
-                relevant_briefs = relevant_briefs_x
-                break
-            # If token limit is not exceeded and maximum k value is not exceeded,
-            # increment k, set relevant_briefs and continue loop
-            k += 1
-            relevant_briefs = relevant_briefs_x
-
-        relevant_briefs_doc = [doc.page_content for doc in relevant_briefs]
-        relevant_briefs_str = "\n \n".join(relevant_briefs_doc)
+        # Get up to ten relevant briefs that fit in the tokens left after the other input
+        # variables.
+        budget = token_budget(
+            self.section.llm_settings.chunk_size,
+            part,
+            prompt_system,
+            prompt_human
+        )
+        # As before, a failed search leaves the part without briefs instead of stopping the
+        # Reporter's Note.
+        retrieval = TokenBudgetRetriever(
+            self.briefcases.briefs_db, ignore_errors=True
+        ).retrieve(part, 10, budget)
+        logger.debug("report_part: Using %s briefs (%s of %s tokens).",
+                     len(retrieval.documents), retrieval.used_tokens, budget)
+        relevant_briefs_str = retrieval.text
 
         # Set query to include the part and relevant briefs string.
 
@@ -205,9 +184,6 @@ class Reporter(BaseClass):
             # Add prompts to prompt_temp list.
             self.prompt_temp += prompt_lst
 
-            # Sleep function to prevent hitting API limit.
-            sleep_for_tokens(part_tokens, part_model)
-
         # Set section.reporter_final to the final draft of the Reporter's Note from this method.
         self.section.reporter_final = "\n \n".join(self.reporter)
 
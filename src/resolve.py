@@ -30,7 +30,9 @@ best outcomes, and aligns with the purpose of Restatements of Law.
 - `set_authority_sum(self)`: Sets a summary of authority information collected in the 
 `get_authority` method.
 - `get_majority(self)`: Creates notes on the majority rule and trends.
-- `get_reasoning(self)`: Gets the reasoning behind the rules from caselaw.
+- `get_reasoning(self)`: Gets the reasoning behind the rules from caselaw. The brief of each 
+supporting case is looked up by citation or name with `BriefCases.find_brief`, and found by 
+vector search only if it is not in the index.
 - `get_fit(self)`: Creates notes on the rule that fits within the body of law, produces the 
 best outcomes, and aligns with the purpose of Restatements of Law.
 - `get_decide(self)`: Decides on the best rule based on the information gathered so far.
@@ -52,7 +54,6 @@ from src.utils_file import (
 from src.utils_llm import (
     list_to_token_list,
     num_tokens,
-    sleep_for_tokens,
     llm_loop,
     llm_router,
     llm_router_gpt4,
@@ -154,9 +155,6 @@ class Resolve(BaseClass):
         self.prompt_lst.append(save_used_prompts(
             "## Rules prompts", prompt_lst))
 
-        # Sleep for tokens
-        sleep_for_tokens(total_tokens, model)
-
     def get_authority(self):
         """Get legal authority for each rule in self.rules_lst.
         """
@@ -246,7 +244,8 @@ class Resolve(BaseClass):
             self.authority_sum += string
 
         # If summary exceeds token limits, remove list of cases supporting each provision.
-        if num_tokens(self.authority_sum) > self.section.llm_settings.max_tokens:
+        if (num_tokens(self.authority_sum, model=self.section.llm_settings.model)
+                > self.section.llm_settings.max_tokens):
             self.authority_sum = ""
             for authority in self.authority_lst:
                 string = textwrap.dedent(
@@ -301,9 +300,6 @@ class Resolve(BaseClass):
         self.prompt_lst.append(save_used_prompts(
             "## Majority prompts", prompt_lst))
 
-        # Sleep for tokens
-        sleep_for_tokens(total_tokens, model)
-
     def get_reasoning(self):
         """Get reasoning behind the rules from caselaw.
         """
@@ -312,14 +308,18 @@ class Resolve(BaseClass):
             # Retrieve relevant briefs
             # Loop through each case in the list of cases supporting the rule.
             for case in rule[2]:
-                case_name = f"Case Name {case}"
-                # Retrieve relevant casebrief
-                relevant_brief = self.briefcases.briefs_db.similarity_search(
-                    case_name, k=1)
-                # Convert relevant_brief to a list of strings
-                relevant_brief = [doc.page_content for doc in relevant_brief]
-                # Join the list of strings into one string
-                relevant_brief = '\n'.join(relevant_brief)
+                # Look up the casebrief by its citation or case name.
+                relevant_brief = self.briefcases.find_brief(case)
+                if relevant_brief is None:
+                    # Fall back on the closest casebrief in the vector database.
+                    logger.debug("get_reasoning: No brief indexed for %s.", case)
+                    case_name = f"Case Name {case}"
+                    relevant_brief = self.briefcases.briefs_db.similarity_search(
+                        case_name, k=1)
+                    # Convert relevant_brief to a list of strings
+                    relevant_brief = [doc.page_content for doc in relevant_brief]
+                    # Join the list of strings into one string
+                    relevant_brief = '\n'.join(relevant_brief)
                 # Add relevant casebrief to rule[4]
                 rule[4].append(relevant_brief)
             # Create token list of casebriefs
@@ -439,9 +439,6 @@ class Resolve(BaseClass):
         # Save the prompts used in this method
         self.prompt_lst.append(save_used_prompts("## Fit prompts", prompt_lst))
 
-        # Sleep for tokens
-        sleep_for_tokens(total_tokens, model)
-
     def get_decide(self):
         """Decide on best rule.
         """
@@ -496,9 +493,6 @@ class Resolve(BaseClass):
         self.prompt_lst.append(save_used_prompts(
             "## Decide prompts", prompt_lst))
 
-        # Sleep for tokens
-        sleep_for_tokens(total_tokens, model)
-
     def write_rule(self):
         """Write the rule for this particular disagreement.
         """
@@ -561,9 +555,6 @@ class Resolve(BaseClass):
         self.prompt_lst.append(save_used_prompts(
             "## Revise prompts", prompt_lst))
 
-        # Sleep for tokens
-        sleep_for_tokens(total_tokens, model)
-
     def get_outputs(self):
         """Get outputs from this class.
         """
@@ -32,6 +32,25 @@ set_cases_folder(self, folder)
 set_path(self, name: str = None, date: str = None)
     Sets the path for saving data to file.
 
+set_llm_cache(self)
+    Sets the LLM response cache according to llm_settings.cache_scope. 
+    With 'section', cached responses are only reused by sections with the same short title. 
+    With 'global', they are reused by every section. With None, caching is turned off.
+    The namespace of the section is kept in cache_namespace, and each process_ method makes 
+    its calls in it (see utils_cache.llm_cache_namespace), so several sections can run in one 
+    process.
+
+set_brief_library(self)
+    Opens the brief library if llm_settings.brief_library is set. With the library, briefs are 
+    written with a prompt that does not name the section or area of law, and a case that was 
+    briefed by any section with the same models is not briefed again. Off by default, because 
+    the briefs are then not focused on the section's issue.
+
+set_embedding_cache(self)
+    Sets the embedding cache according to llm_settings.embedding_cache. With the cache, a text 
+    that was embedded by any section with the same embeddings model is not sent to the 
+    embeddings API again.
+
 set_llm_settings(
     self, embeddings = None,
     model: str = None,
@@ -41,10 +60,25 @@ set_llm_settings(
     chunk_size: int = None,
     chunk_overlap: int = None,
     chunk_size_long: int = None,
-    max_attempts: int = None
+    max_attempts: int = None,
+    max_concurrency: int = None,
+    first_fit_decreasing: bool = None,
+    condense_tree: bool = None,
+    brief_workers: int = None,
+    brief_library: bool = None,
+    parse_workers: int = None,
+    rtf_engine: str = None,
+    parse_cache_max_mb: int = None,
+    corpus_store: bool = None,
+    vector_store: str = None,
+    embedding_cache: bool = None,
+    cache_scope: str = None,
+    cache_max_mb: int = None
 )
     Sets the LLM settings. 
     With this function, only the settings that you want to change need to be passed.
+    Since None means "unchanged", pass cache_scope='off' to turn the LLM response cache off.
+    Changing the cache settings reopens the caches that depend on them.
     
 
 process_load_cases()
@@ -103,6 +137,7 @@ load_attributes(filename: str = None)
 
 """
 
+import functools
 import logging
 import re
 import textwrap
@@ -125,18 +160,35 @@ from src.utils_llm import (
     LLMSettings
 )
 
-from src.loadcases import LoadCases
-from src.briefcases import BriefCases
-from src.extract import Extract
-from src.discern import Discern
-from src.comment import Comment
-from src.illustration import Illustration
-from src.reporter import Reporter
+from src.utils_cache import (
+    BriefLibrary,
+    EmbeddingCache,
+    LLMCache,
+    get_brief_library,
+    get_embedding_cache,
+    get_llm_cache,
+    llm_cache_namespace,
+    set_brief_library,
+    set_embedding_cache,
+    set_llm_cache
+)
+
+# The stage classes (LoadCases, BriefCases, Extract, Discern, Comment, Illustration, Reporter)
+# are imported by the methods that use them, so that importing Section stays cheap.
 
 # Set up logger
 logger = logging.getLogger('restatement')
 
 
+def _in_cache_namespace(method):
+    """Runs a Section method with the LLM calls it makes cached in the section's namespace."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with llm_cache_namespace(self.cache_namespace):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class Section:
     """Class for creating an artificial restatement section.
     This is a composite class that manages the classes that build a restatement.
@@ -167,6 +219,8 @@ class Section:
         self.path_json = ""
         self.path_md = ""
         self.path_db = ""
+        # Namespace of this section's LLM calls in the response cache (set by set_llm_cache)
+        self.cache_namespace = ""
 
         # Class instances
         self.loadcases = None
@@ -268,6 +322,62 @@ class Section:
         self.path_db = os.path.join(self.path, "db")
         # Create the directory if it does not exist.
         os.makedirs(self.path_db, exist_ok=True)
+        # Set the LLM response cache for this section.
+        self.set_llm_cache()
+        # Set the library of briefs shared across sections.
+        self.set_brief_library()
+        # Set the embedding cache shared across sections.
+        self.set_embedding_cache()
+
+    def set_llm_cache(self):
+        """Set the LLM response cache according to llm_settings.cache_scope.
+        All sections share one cache file. Section scope keeps each section's responses in a
+        namespace named after its short title. Global scope shares responses across sections.
+        """
+        if self.llm_settings.cache_scope is None:
+            set_llm_cache(None)
+            return
+        if self.llm_settings.cache_scope == 'global':
+            namespace = ''
+        else:
+            namespace = self.section_title_short
+        # The namespace is passed with each call rather than set on the shared cache, so one
+        # section does not change the namespace of another.
+        self.cache_namespace = namespace
+        path = os.path.join(get_root_dir(), "outputs", "cache", "llm_cache.sqlite")
+        max_bytes = self.llm_settings.cache_max_mb * 1024 * 1024
+        cache = get_llm_cache()
+        # Reuse the open cache if it is the same file and size.
+        if cache is None or cache.path != path or cache.max_bytes != max_bytes:
+            set_llm_cache(LLMCache(path, max_bytes=max_bytes))
+
+    def set_brief_library(self):
+        """Open the brief library if llm_settings.brief_library is set.
+        Every section shares one library file, so briefs are reused across sections. A section
+        without the setting leaves the library open for the others, and does not use it.
+        """
+        if not self.llm_settings.brief_library:
+            return
+        path = os.path.join(get_root_dir(), "outputs", "cache", "brief_library.sqlite")
+        max_bytes = self.llm_settings.cache_max_mb * 1024 * 1024
+        library = get_brief_library()
+        # Keep the open library unless the settings changed.
+        if library is None or library.path != path or library.max_bytes != max_bytes:
+            set_brief_library(BriefLibrary(path, max_bytes=max_bytes))
+
+    def set_embedding_cache(self):
+        """Set the embedding cache according to llm_settings.embedding_cache.
+        Every section shares one cache file, so a text is embedded once for each embeddings model.
+        """
+        if not self.llm_settings.embedding_cache:
+            set_embedding_cache(None)
+            return
+        path = os.path.join(get_root_dir(), "outputs", "cache", "embeddings.sqlite")
+        max_bytes = self.llm_settings.cache_max_mb * 1024 * 1024
+        cache = get_embedding_cache()
+        # Keep the open cache unless the settings changed.
+        if cache is None or cache.path != path or cache.max_bytes != max_bytes:
+            set_embedding_cache(EmbeddingCache(path, max_bytes=max_bytes))
 
     def set_llm_settings(
         self,
@@ -279,10 +389,24 @@ class Section:
         chunk_size: int = None,
         chunk_overlap: int = None,
         chunk_size_long: int = None,
-        max_attempts: int = None
+        max_attempts: int = None,
+        max_concurrency: int = None,
+        first_fit_decreasing: bool = None,
+        condense_tree: bool = None,
+        brief_workers: int = None,
+        brief_library: bool = None,
+        parse_workers: int = None,
+        rtf_engine: str = None,
+        parse_cache_max_mb: int = None,
+        corpus_store: bool = None,
+        vector_store: str = None,
+        embedding_cache: bool = None,
+        cache_scope: str = None,
+        cache_max_mb: int = None
     ):
         """Set the LLM settings.
         With this function, only the settings that you want to change need to be passed.
+        Pass cache_scope='off' to turn the LLM response cache off.
         """
         if embeddings is not None:
             self.llm_settings.embeddings = embeddings
@@ -302,18 +426,54 @@ class Section:
             self.llm_settings.chunk_size_long = chunk_size_long
         if max_attempts is not None:
             self.llm_settings.max_attempts = max_attempts
+        if max_concurrency is not None:
+            self.llm_settings.max_concurrency = max_concurrency
+        if first_fit_decreasing is not None:
+            self.llm_settings.first_fit_decreasing = first_fit_decreasing
+        if condense_tree is not None:
+            self.llm_settings.condense_tree = condense_tree
+        if brief_workers is not None:
+            self.llm_settings.brief_workers = brief_workers
+        if brief_library is not None:
+            self.llm_settings.brief_library = brief_library
+            self.set_brief_library()
+        if parse_workers is not None:
+            self.llm_settings.parse_workers = parse_workers
+        if rtf_engine is not None:
+            self.llm_settings.rtf_engine = rtf_engine
+        if parse_cache_max_mb is not None:
+            self.llm_settings.parse_cache_max_mb = parse_cache_max_mb
+        if corpus_store is not None:
+            self.llm_settings.corpus_store = corpus_store
+        if vector_store is not None:
+            self.llm_settings.vector_store = vector_store
+        if embedding_cache is not None:
+            self.llm_settings.embedding_cache = embedding_cache
+            self.set_embedding_cache()
+        if cache_scope is not None:
+            self.llm_settings.cache_scope = None if cache_scope == 'off' else cache_scope
+            self.set_llm_cache()
+        if cache_max_mb is not None:
+            self.llm_settings.cache_max_mb = cache_max_mb
+            # These caches are bounded by cache_max_mb, so reopen them with the new limit.
+            self.set_llm_cache()
+            self.set_brief_library()
+            self.set_embedding_cache()
 
     def process_load_cases(self):
         """Execute each necessary method of LoadCases class.
         """
+        from src.loadcases import LoadCases
         # Create instance of LoadCases
         self.loadcases = LoadCases(section=self)
         # Load the cases as a list
         self.loadcases.rtf_to_list()
 
+    @_in_cache_namespace
     def process_brief_cases(self):
         """Execute each necessary method of BriefCases class.
         """
+        from src.briefcases import BriefCases
         # Create instance of BriefCases
         self.briefcases = BriefCases(
             loadcases=self.loadcases,
@@ -330,9 +490,11 @@ class Section:
         # Save prompts and outputs to markdown file.
         self.briefcases.save_to_md()
 
+    @_in_cache_namespace
     def process_extract(self):
         """ Execute each necessary method of Extract class.
         """
+        from src.extract import Extract
         # Create instance
         self.extract = Extract(
             briefcases=self.briefcases,
@@ -349,9 +511,11 @@ class Section:
         # Save prompts and outputs to markdown file.
         self.extract.save_to_md()
 
+    @_in_cache_namespace
     def process_discern(self):
         """Execute each necessary method of Discern class.
         """
+        from src.discern import Discern
         # Create instance of DiscernDis
         self.discern = Discern(
             extract=self.extract,
@@ -376,9 +540,11 @@ class Section:
         # Save prompts and outputs to markdown file.
         self.discern.save_to_md()
 
+    @_in_cache_namespace
     def process_comment(self):
         """ Execute each necessary method of Comment class.
         """
+        from src.comment import Comment
         # Create instance of Comment
         self.comment = Comment(
             briefcases=self.briefcases,
@@ -397,9 +563,11 @@ class Section:
         # Save prompts and outputs to markdown file.
         self.comment.save_to_md()
 
+    @_in_cache_namespace
     def process_illustration(self):
         """ Execute each necessary method of Illustration class.
         """
+        from src.illustration import Illustration
         # Create instance of Illustration
         self.illustration = Illustration(
             briefcases=self.briefcases,
@@ -418,9 +586,11 @@ class Section:
         # Save prompts and outputs to markdown file.
         self.illustration.save_to_md()
 
+    @_in_cache_namespace
     def process_reporter(self):
         """ Execute each necessary method of Reporter class.
         """
+        from src.reporter import Reporter
         # Create instance of Reporter
         self.reporter = Reporter(
             briefcases=self.briefcases,
@@ -503,7 +673,20 @@ class Section:
                 setattr(self, key, value)
         except FileNotFoundError:
             logger.warning("File not found: %s", filename)
+        # Set the LLM response cache for the loaded section.
+        self.set_llm_cache()
+        # Set the library of briefs shared across sections.
+        self.set_brief_library()
+        # Set the embedding cache shared across sections.
+        self.set_embedding_cache()
         # Create instances of each class and load attributes from JSON file.
+        from src.loadcases import LoadCases
+        from src.briefcases import BriefCases
+        from src.extract import Extract
+        from src.discern import Discern
+        from src.comment import Comment
+        from src.illustration import Illustration
+        from src.reporter import Reporter
 
         self.loadcases = LoadCases(section=self)
         self.loadcases.rtf_to_list()
@@ -0,0 +1,281 @@
+"""
+Pluggable backends for LLM calls in the 'restatement' project.
+
+llm_call sends every request that is not answered from the cache through the backend set with
+set_llm_backend. By default no backend is set, and requests go to OpenAI through the pooled
+ChatOpenAI clients in utils_llm. StubBackend and StubEmbeddings stand in for the OpenAI APIs, so a
+full section can be run offline, e.g. to benchmark or regression-test the pipeline:
+
+    set_llm_backend(StubBackend(latency=('lognormal', 0.0, 0.5), tokens_per_second=50))
+    section.set_llm_settings(embeddings=StubEmbeddings())
+
+Calls to a backend still wait on the shared rate limiters in utils_ratelimit. Raise the limits
+with set_rate_limit to run without throttling.
+
+Classes
+
+LLMBackend()
+    Base class for LLM backends.
+    agenerate(
+        model: str, 
+        messages: List[BaseMessage], 
+        temperature: float = 0.0, 
+        on_first_token: Callable = None
+    ) -> Tuple[str, dict]
+        Returns the completion text and the token usage reported for it. The usage dict may be
+        empty if the backend does not report usage. on_first_token, if given, is called when 
+        the first token of the response arrives.
+
+StubBackend(
+    latency=('constant', 0.0),
+    tokens_per_second: float = None,
+    rate_limit_rate: float = 0.0,
+    retry_after: float = 1.0,
+    output_tokens: int = 200,
+    seed: int = 0
+)
+    A local stand-in for the OpenAI chat API. Outputs are a deterministic function of the
+    request and honor the formats the pipeline parses: a "Case Name:" header, "Rule:" lines,
+    and paragraphs separated by '***' and '####'.
+    stats() -> dict
+        Returns the number of calls, injected rate limit errors and tokens used.
+
+StubRateLimitError(retry_after: float)
+    The 429 error raised by StubBackend when it injects a rate limit error.
+
+StubEmbeddings(size: int = 256)
+    A local stand-in for OpenAIEmbeddings. Vectors are normalized hashed bags of words, so texts
+    that share words are similar. It implements the methods of langchain's Embeddings interface
+    without subclassing it, so this module does not import langchain.
+
+Functions
+
+set_llm_backend(backend: LLMBackend or None) -> None
+    Sets the backend used by every LLM call in the process. None restores OpenAI.
+
+get_llm_backend() -> LLMBackend or None
+    Returns the backend set with set_llm_backend.
+"""
+import abc
+import asyncio
+import hashlib
+import logging
+import math
+import random
+import re
+import threading
+
+from src.utils_tokens import get_token_counter
+
+# Set up logger
+logger = logging.getLogger('restatement')
+
+# Backend used by every LLM call in the process (set by set_llm_backend).
+_llm_backend = None
+
+
+class LLMBackend(abc.ABC):
+    """Base class for LLM backends. A subclass without agenerate cannot be instantiated."""
+
+    @abc.abstractmethod
+    async def agenerate(self, model, messages, temperature=0.0, on_first_token=None):
+        """Returns the completion text and the token usage reported for it."""
+
+
+class StubRateLimitError(Exception):
+    """The 429 error raised by StubBackend when it injects a rate limit error.
+    It carries a status code and a Retry-After header like the OpenAI error does, so it is
+    retried by llm_call and pauses the shared rate limiter.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__("Rate limit reached (injected by StubBackend).")
+        self.status_code = 429
+        self.headers = {'retry-after': str(retry_after)}
+
+
+def _digest(*parts):
+    """Returns a stable integer hash of the parts."""
+    data = "\x00".join(str(part) for part in parts).encode("utf-8", "surrogatepass")
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
+
+
+class StubBackend(LLMBackend):
+    """A local stand-in for the OpenAI chat API.
+    latency is the time to the first token, given as ('constant', seconds),
+    ('uniform', low, high), ('exponential', mean) or ('lognormal', mu, sigma), or as a
+    function of a random.Random that returns seconds. Generating the output then takes
+    output tokens / tokens_per_second more seconds, or no time if tokens_per_second is None.
+    The first attempt of a request fails with a StubRateLimitError with probability
+    rate_limit_rate.
+    """
+
+    def __init__(
+        self,
+        latency=('constant', 0.0),
+        tokens_per_second=None,
+        rate_limit_rate=0.0,
+        retry_after=1.0,
+        output_tokens=200,
+        seed=0
+    ):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.output_tokens = output_tokens
+        self.seed = seed
+        self.calls = 0
+        self.rate_limit_errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        # Requests that already had their injected error, so that their retry succeeds
+        self._failed = set()
+        self._lock = threading.Lock()
+
+    def sample_latency(self, rng):
+        """Returns the seconds before the first token of a response."""
+        if callable(self.latency):
+            return max(0.0, self.latency(rng))
+        kind, *params = self.latency
+        if kind == 'constant':
+            return params[0]
+        if kind == 'uniform':
+            return rng.uniform(params[0], params[1])
+        if kind == 'exponential':
+            return rng.expovariate(1 / params[0]) if params[0] > 0 else 0.0
+        if kind == 'lognormal':
+            return rng.lognormvariate(params[0], params[1])
+        raise ValueError(f"Unknown latency distribution: {kind}")
+
+    def complete(self, query, key):
+        """Returns the deterministic output for a request.
+        Sentences are drawn from the human message, so briefs resemble their cases and retrieval
+        over them behaves sensibly.
+        """
+        rng = random.Random(key)
+        # Cases begin with their file name (e.g. "Smith v. Jones"), which is kept as the case
+        # name of the brief.
+        match = re.search(r"^.*\bv\. .*$", query, re.MULTILINE)
+        lines = [line for line in query.split("\n") if line.strip()] or [""]
+        first_line = (match.group(0) if match else lines[0]).strip()[:80]
+        sentences = [
+            sentence.strip() for sentence in re.split(r"(?<=[.!?])\s+|\n+", query)
+            if len(sentence.strip()) >= 20
+        ] or ["The court held that the rule applies to the facts of this case."]
+        counter = get_token_counter()
+        lines = [
+            f"Case Name: {first_line}",
+            f"Citation: {key % 900 + 100} Stub Rep. {key % 9000 + 1000}",
+            f"Rule: {rng.choice(sentences)[:300]}",
+            f"Rule: {rng.choice(sentences)[:300]}",
+        ]
+        tokens = counter.count("\n".join(lines))
+        # Paragraphs of at least 100 characters separated by '***' and '####', so that the
+        # group, disagreement and rule lists parsed from the output are never empty.
+        delimiters = ["***", "####"]
+        paragraphs = 0
+        while tokens < self.output_tokens or paragraphs < 4:
+            paragraph = " ".join(rng.choice(sentences) for _ in range(3))
+            paragraph = (paragraph + " " + sentences[0])[:600]
+            if len(paragraph) < 100:
+                paragraph = paragraph.ljust(100, ".")
+            lines.append(delimiters[paragraphs % 2])
+            lines.append(paragraph)
+            tokens += counter.count(paragraph) + 2
+            paragraphs += 1
+        return "\n".join(lines) + "\n"
+
+    async def agenerate(self, model, messages, temperature=0.0, on_first_token=None):
+        """Returns the stub completion text and its token usage."""
+        text = "\n".join(message.content for message in messages)
+        key = _digest(self.seed, model, temperature, text)
+        rng = random.Random(key)
+        with self._lock:
+            self.calls += 1
+            inject = (
+                key not in self._failed
+                and self.rate_limit_rate > 0
+                and rng.random() < self.rate_limit_rate
+            )
+            if inject:
+                self._failed.add(key)
+                self.rate_limit_errors += 1
+        await asyncio.sleep(self.sample_latency(rng))
+        if inject:
+            raise StubRateLimitError(self.retry_after)
+        output = self.complete(messages[-1].content, key)
+        counter = get_token_counter()
+        prompt_tokens = counter.count(text)
+        completion_tokens = counter.count(output)
+        if on_first_token is not None:
+            on_first_token()
+        if self.tokens_per_second:
+            await asyncio.sleep(completion_tokens / self.tokens_per_second)
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens
+        }
+        return output, usage
+
+    def stats(self):
+        """Returns the number of calls, injected rate limit errors and tokens used."""
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'rate_limit_errors': self.rate_limit_errors,
+                'prompt_tokens': self.prompt_tokens,
+                'completion_tokens': self.completion_tokens
+            }
+
+
+class StubEmbeddings:
+    """A local stand-in for OpenAIEmbeddings."""
+
+    def __init__(self, size=256):
+        self.size = size
+        self.calls = 0
+        self.texts = 0
+        self._lock = threading.Lock()
+
+    def _embed(self, text):
+        """Returns the normalized hashed bag of words of text."""
+        vector = [0.0] * self.size
+        for word in re.findall(r"\w+", text.lower()):
+            vector[_digest(word) % self.size] += 1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+    def embed_documents(self, texts):
+        """Returns a vector for each text."""
+        with self._lock:
+            self.calls += 1
+            self.texts += len(texts)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        """Returns the vector for a query."""
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts):
+        """Returns a vector for each text."""
+        return self.embed_documents(texts)
+
+    async def aembed_query(self, text):
+        """Returns the vector for a query."""
+        return self.embed_query(text)
+
+
+def set_llm_backend(backend):
+    """Sets the backend used by every LLM call in the process. None restores OpenAI."""
+    global _llm_backend
+    _llm_backend = backend
+
+
+def get_llm_backend():
+    """Returns the backend set with set_llm_backend."""
+    return _llm_backend
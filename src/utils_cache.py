@@ -0,0 +1,627 @@
+"""
+Persistent caches for the 'restatement' project.
+
+Responses are stored in a SQLite file keyed by a hash of their inputs, so a rerun of unchanged
+work is answered from disk instead of the API. Each cache evicts its least recently used entries
+once the stored values exceed a size limit, and counts hits and misses.
+
+Classes
+
+SQLiteLRUCache(path: str, table: str, max_bytes: int = 1024 ** 3)
+    A key-value store in a SQLite table with size-based LRU eviction.
+    get(key: str) -> bytes or None
+        Returns the value stored under key, or None on a miss.
+    get_many(keys: List[str]) -> Dict[str, bytes]
+        Returns the values stored under the keys that are in the cache, in a few queries.
+    get_lengths(keys: List[str]) -> Dict[str, int or None]
+        Returns the length stored with each key that is in the cache, without reading the
+        values. The length is None for values stored without one.
+    set(key: str, value: bytes, namespace: str = '', length: int = None) -> None
+        Stores value under key and evicts old entries if the cache is over its size limit.
+        length is stored with the value, for instance the number of characters of a text.
+    set_many(items: Dict[str, bytes], namespace: str = '',
+             lengths: Dict[str, int] = None) -> None
+        Stores several values, and the lengths given for them, in one transaction.
+    flush() -> None
+        Writes the access times of recent hits to the table. Reads do not write, so the access
+        times are kept in memory until the next write, flush or close, or until ACCESS_BATCH
+        hits have built up.
+    clear(namespace: str = None) -> None
+        Deletes every entry, or every entry in one namespace.
+    stats() -> dict
+        Returns hits, misses, hit rate, number of entries and stored bytes.
+
+LLMCache(path: str, max_bytes: int = 1024 ** 3, namespace: str = '', cache_all_temperatures: bool = False)
+    Cache of LLM responses keyed by a hash of namespace, model, temperature, system prompt,
+    human template and query. Only temperature-0 calls are cached unless
+    cache_all_temperatures is set.
+    get_response(model, prompt_template, human_template, query, temperature=0.0,
+                 namespace=None) -> dict or None
+        Returns the cached {'text': ..., 'usage': ...} response, or None on a miss.
+    set_response(model, prompt_template, human_template, query, response, temperature=0.0,
+                 namespace=None)
+        Stores a response.
+    namespace is the namespace of the call. If it is None, the cache's own namespace is used.
+
+BriefLibrary(path: str, max_bytes: int = 1024 ** 3)
+    Case briefs shared by every Section, keyed by a hash of the case, the brief prompt and the
+    models. Shared briefs are written with a prompt that does not name the section, so a case
+    that appears in several sections is only briefed once.
+    get_brief(key: str) -> dict or None
+        Returns the stored {'brief': ..., 'prompts': ...}, or None on a miss.
+    set_brief(key: str, brief: dict) -> None
+        Stores a brief.
+
+EmbeddingCache(path: str, max_bytes: int = 1024 ** 3)
+    Embedding vectors keyed by a hash of the embedding model and the text, stored as float32.
+    get_vectors(model: str, texts: List[str]) -> Dict[str, List[float]]
+        Returns the cached vector of each text that is in the cache.
+    set_vectors(model: str, vectors: Dict[str, List[float]]) -> None
+        Stores the vector of each text.
+
+CachedEmbeddings(embeddings: Embeddings, cache: EmbeddingCache)
+    Wraps embeddings so that texts already in the cache are not sent to the embeddings API.
+    Each call looks up all of its texts at once and sends the misses in one batch. Vectors are
+    returned at float32 precision whether or not they were cached, so results do not depend on
+    the state of the cache.
+    embed_documents(texts: List[str]) -> List[List[float]]
+    embed_query(text: str) -> List[float]
+    aembed_documents(texts: List[str]) -> List[List[float]]
+    aembed_query(text: str) -> List[float]
+    stats() -> dict
+        Returns the embedding cache's hits, misses and hit rate, and the number of texts and
+        calls sent to the wrapped embeddings.
+
+Functions
+
+hash_key(*parts) -> str
+    Returns a SHA-256 hex digest of the parts.
+
+embedding_name(embeddings: Embeddings) -> str
+    Returns a name for the embeddings: their class and, if they have one, their model. The
+    name of CachedEmbeddings is the name of the embeddings they wrap.
+
+set_llm_cache(cache: LLMCache or None) -> None
+    Sets the cache used by every LLM call in the process. None disables caching.
+
+get_llm_cache() -> LLMCache or None
+    Returns the cache used by LLM calls.
+
+llm_cache_namespace(namespace: str) -> ContextManager
+    Caches the LLM calls made inside the block, and in the threads and tasks it starts with a
+    copy of its context, in namespace instead of the cache's own namespace. Section runs each
+    stage inside one, so sections in the same process keep their responses apart.
+
+get_llm_cache_namespace() -> str or None
+    Returns the namespace set by llm_cache_namespace, or None outside of one.
+
+set_brief_library(library: BriefLibrary or None) -> None
+    Sets the brief library used by BriefCases in the process. None turns reuse off.
+
+get_brief_library() -> BriefLibrary or None
+    Returns the brief library used by BriefCases.
+
+set_embedding_cache(cache: EmbeddingCache or None) -> None
+    Sets the embedding cache used by list_to_db and load_db in the process. None turns it off.
+
+get_embedding_cache() -> EmbeddingCache or None
+    Returns the embedding cache.
+
+cached_embeddings(embeddings: Embeddings) -> Embeddings
+    Returns embeddings wrapped in CachedEmbeddings with the embedding cache, or embeddings 
+    unchanged if there is no cache or they are already wrapped.
+"""
+import array
+import contextlib
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# Set up logger
+logger = logging.getLogger('restatement')
+
+# Cache used by every LLM call in the process (set by set_llm_cache).
+_llm_cache = None
+# Brief library used by BriefCases in the process (set by set_brief_library).
+_brief_library = None
+# Embedding cache used by list_to_db and load_db in the process (set by set_embedding_cache).
+_embedding_cache = None
+# Namespace of the LLM calls made in the current context (set by llm_cache_namespace).
+_llm_namespace = contextvars.ContextVar('restatement_llm_namespace', default=None)
+# Largest number of keys looked up in one query (SQLite limits the number of parameters).
+LOOKUP_BATCH = 500
+# Number of hits whose access times are kept in memory before they are written to the table.
+ACCESS_BATCH = 1000
+
+
+def hash_key(*parts):
+    """Returns a SHA-256 hex digest of the parts."""
+    digest = hashlib.sha256()
+    for part in parts:
+        data = str(part).encode("utf-8")
+        # Prefix each part with its length so that ("ab", "c") and ("a", "bc") differ.
+        digest.update(len(data).to_bytes(8, "big"))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+class SQLiteLRUCache:
+    """A key-value store in a SQLite table with size-based LRU eviction.
+    A single connection is shared by every thread and guarded by a lock. Hits do not write to
+    the database: their access times are kept in memory and written with the next write.
+    """
+
+    def __init__(self, path, table, max_bytes=1024 ** 3):
+        self.path = path
+        self.table = table
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Access times of hits that are not yet written to the table, by key.
+        self._accessed = {}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                "key TEXT PRIMARY KEY, namespace TEXT, value BLOB, "
+                "size INTEGER, last_access REAL, length INTEGER)"
+            )
+            # Tables created before the length column get it added, empty.
+            columns = [row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")]
+            if "length" not in columns:
+                self._conn.execute(f"ALTER TABLE {table} ADD COLUMN length INTEGER")
+            self._conn.execute(
+                f"CREATE INDEX IF NOT EXISTS {table}_last_access ON {table} (last_access)"
+            )
+            self._conn.commit()
+            row = self._conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {table}").fetchone()
+            self._size = row[0]
+
+    def get(self, key):
+        """Returns the value stored under key, or None on a miss."""
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touch([key])
+            return row[0]
+
+    def get_many(self, keys):
+        """Returns the values stored under the keys that are in the cache, in a few queries."""
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), LOOKUP_BATCH):
+                batch = keys[start:start + LOOKUP_BATCH]
+                rows = self._conn.execute(
+                    f"SELECT key, value FROM {self.table} "
+                    f"WHERE key IN ({', '.join('?' * len(batch))})", batch
+                )
+                found.update(rows)
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+            self._touch(found)
+        return found
+
+    def get_lengths(self, keys):
+        """Returns the length stored with each key that is in the cache, without reading the
+        values.
+        """
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), LOOKUP_BATCH):
+                batch = keys[start:start + LOOKUP_BATCH]
+                rows = self._conn.execute(
+                    f"SELECT key, length FROM {self.table} "
+                    f"WHERE key IN ({', '.join('?' * len(batch))})", batch
+                )
+                found.update(rows)
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+            self._touch(found)
+        return found
+
+    def _touch(self, keys):
+        """Records the access time of keys that were hit. Called with the lock held."""
+        now = time.time()
+        for key in keys:
+            self._accessed[key] = now
+        if len(self._accessed) >= ACCESS_BATCH:
+            self._flush()
+            self._conn.commit()
+
+    def _flush(self):
+        """Writes the recorded access times to the table without committing. Called with the
+        lock held.
+        """
+        if self._accessed:
+            self._conn.executemany(
+                f"UPDATE {self.table} SET last_access = ? WHERE key = ?",
+                [(now, key) for key, now in self._accessed.items()]
+            )
+            self._accessed = {}
+
+    def flush(self):
+        """Writes the access times of recent hits to the table."""
+        with self._lock:
+            self._flush()
+            self._conn.commit()
+
+    def set(self, key, value, namespace='', length=None):
+        """Stores value under key and evicts old entries if the cache is over its size limit."""
+        self.set_many({key: value}, namespace, None if length is None else {key: length})
+
+    def set_many(self, items, namespace='', lengths=None):
+        """Stores several values in one transaction."""
+        lengths = lengths or {}
+        with self._lock:
+            # Write the access times of recent hits first, so that eviction sees them.
+            self._flush()
+            now = time.time()
+            for key, value in items.items():
+                row = self._conn.execute(
+                    f"SELECT size FROM {self.table} WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    self._size -= row[0]
+                self._conn.execute(
+                    f"INSERT OR REPLACE INTO {self.table} "
+                    "(key, namespace, value, size, last_access, length) VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, namespace, value, len(value), now, lengths.get(key))
+                )
+                self._size += len(value)
+            if self._size > self.max_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """Deletes least recently used entries until the cache is at 90% of its size limit.
+        Called with the lock held.
+        """
+        target = self.max_bytes * 0.9
+        rows = self._conn.execute(
+            f"SELECT key, size FROM {self.table} ORDER BY last_access"
+        )
+        evicted = []
+        for key, size in rows:
+            if self._size <= target:
+                break
+            evicted.append((key,))
+            self._size -= size
+        self._conn.executemany(f"DELETE FROM {self.table} WHERE key = ?", evicted)
+        logger.debug("SQLiteLRUCache: Evicted %s entries from %s.", len(evicted), self.table)
+
+    def clear(self, namespace=None):
+        """Deletes every entry, or every entry in one namespace."""
+        with self._lock:
+            self._flush()
+            if namespace is None:
+                self._conn.execute(f"DELETE FROM {self.table}")
+            else:
+                self._conn.execute(
+                    f"DELETE FROM {self.table} WHERE namespace = ?", (namespace,)
+                )
+            self._conn.commit()
+            row = self._conn.execute(
+                f"SELECT COALESCE(SUM(size), 0) FROM {self.table}"
+            ).fetchone()
+            self._size = row[0]
+
+    def stats(self):
+        """Returns hits, misses, hit rate, number of entries and stored bytes."""
+        with self._lock:
+            entries = self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": entries,
+                "bytes": self._size
+            }
+
+    def close(self):
+        """Writes the access times of recent hits and closes the database connection."""
+        with self._lock:
+            self._flush()
+            self._conn.commit()
+            self._conn.close()
+
+
+class LLMCache(SQLiteLRUCache):
+    """Cache of LLM responses.
+    Keys are a hash of the namespace, model, temperature, system prompt, human template and
+    query. A Section uses its short title as namespace. The empty namespace is global and is
+    shared by every Section.
+    """
+
+    def __init__(
+        self,
+        path,
+        max_bytes=1024 ** 3,
+        namespace='',
+        cache_all_temperatures=False
+    ):
+        super().__init__(path, "llm_responses", max_bytes)
+        self.namespace = namespace
+        # Responses at temperature > 0 are not deterministic, so they are not cached by default.
+        self.cache_all_temperatures = cache_all_temperatures
+
+    def cacheable(self, temperature):
+        """Returns True if calls at this temperature may be cached."""
+        return temperature == 0 or self.cache_all_temperatures
+
+    def response_key(
+        self,
+        model,
+        prompt_template,
+        human_template,
+        query,
+        temperature=0.0,
+        namespace=None
+    ):
+        """Returns the cache key for an LLM call."""
+        if namespace is None:
+            namespace = self.namespace
+        return hash_key(
+            namespace, model, float(temperature), prompt_template, human_template, query
+        )
+
+    def get_response(
+        self,
+        model,
+        prompt_template,
+        human_template,
+        query,
+        temperature=0.0,
+        namespace=None
+    ):
+        """Returns the cached {'text': ..., 'usage': ...} response, or None on a miss."""
+        if not self.cacheable(temperature):
+            return None
+        value = self.get(
+            self.response_key(model, prompt_template, human_template, query, temperature,
+                              namespace)
+        )
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def set_response(
+        self,
+        model,
+        prompt_template,
+        human_template,
+        query,
+        response,
+        temperature=0.0,
+        namespace=None
+    ):
+        """Stores a response."""
+        if not self.cacheable(temperature):
+            return
+        if namespace is None:
+            namespace = self.namespace
+        self.set(
+            self.response_key(model, prompt_template, human_template, query, temperature,
+                              namespace),
+            json.dumps(response).encode("utf-8"),
+            namespace=namespace
+        )
+
+
+class BriefLibrary(SQLiteLRUCache):
+    """Case briefs shared by every Section.
+    Keys are a hash of the case, the brief prompt and the models. The prompt of shared briefs
+    does not name the section (see BriefCases.brief_prompts), so a brief written for one section
+    is reused by the others.
+    """
+
+    def __init__(self, path, max_bytes=1024 ** 3):
+        super().__init__(path, "briefs", max_bytes)
+
+    def get_brief(self, key):
+        """Returns the stored {'brief': ..., 'prompts': ...}, or None on a miss."""
+        value = self.get(key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def set_brief(self, key, brief):
+        """Stores a brief."""
+        self.set(key, json.dumps(brief).encode("utf-8"))
+
+
+class EmbeddingCache(SQLiteLRUCache):
+    """Embedding vectors keyed by a hash of the embedding model and the text.
+    Vectors are stored as float32, which is half the size of the floats the API returns and
+    more precise than cosine similarity needs.
+    """
+
+    def __init__(self, path, max_bytes=1024 ** 3):
+        super().__init__(path, "embeddings", max_bytes)
+
+    def get_vectors(self, model, texts):
+        """Returns the cached vector of each text that is in the cache."""
+        keys = {hash_key(model, text): text for text in texts}
+        found = self.get_many(keys)
+        return {keys[key]: _decode_vector(value) for key, value in found.items()}
+
+    def set_vectors(self, model, vectors):
+        """Stores the vector of each text."""
+        self.set_many(
+            {hash_key(model, text): _encode_vector(vector) for text, vector in vectors.items()},
+            namespace=model
+        )
+
+
+def _encode_vector(vector):
+    """Returns a vector as float32 bytes."""
+    return array.array('f', vector).tobytes()
+
+
+def _decode_vector(value):
+    """Returns the vector stored as float32 bytes."""
+    vector = array.array('f')
+    vector.frombytes(value)
+    return vector.tolist()
+
+
+def embedding_name(embeddings):
+    """Returns a name for the embeddings: their class and, if they have one, their model."""
+    while isinstance(embeddings, CachedEmbeddings):
+        embeddings = embeddings.embeddings
+    name = f"{type(embeddings).__module__}.{type(embeddings).__qualname__}"
+    model = getattr(embeddings, "model", None)
+    return f"{name}:{model}" if model else name
+
+
+class CachedEmbeddings:
+    """Embeddings that are looked up in an EmbeddingCache before they are sent to the API.
+    """
+
+    def __init__(self, embeddings, cache):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = embedding_name(embeddings)
+        # Texts and calls sent to the wrapped embeddings
+        self.texts_embedded = 0
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _lookup(self, texts):
+        """Returns the cached vectors of the texts and the distinct texts that are not cached."""
+        found = self.cache.get_vectors(self.model, texts)
+        missing = [text for text in dict.fromkeys(texts) if text not in found]
+        return found, missing
+
+    def _store(self, found, missing, vectors):
+        """Stores the vectors of the missing texts and adds them to found."""
+        with self._lock:
+            self.texts_embedded += len(missing)
+            self.calls += 1
+        new = dict(zip(missing, vectors))
+        self.cache.set_vectors(self.model, new)
+        # Round the new vectors as the cache does, so a text's vector does not depend on
+        # whether it was cached.
+        for text, vector in new.items():
+            found[text] = _decode_vector(_encode_vector(vector))
+
+    def embed_documents(self, texts):
+        """Returns a vector for each text."""
+        texts = list(texts)
+        found, missing = self._lookup(texts)
+        if missing:
+            self._store(found, missing, self.embeddings.embed_documents(missing))
+        return [found[text] for text in texts]
+
+    def embed_query(self, text):
+        """Returns the vector for a query."""
+        found, missing = self._lookup([text])
+        if missing:
+            self._store(found, missing, [self.embeddings.embed_query(text)])
+        return found[text]
+
+    async def aembed_documents(self, texts):
+        """Returns a vector for each text."""
+        texts = list(texts)
+        found, missing = self._lookup(texts)
+        if missing:
+            self._store(found, missing, await self.embeddings.aembed_documents(missing))
+        return [found[text] for text in texts]
+
+    async def aembed_query(self, text):
+        """Returns the vector for a query."""
+        found, missing = self._lookup([text])
+        if missing:
+            self._store(found, missing, [await self.embeddings.aembed_query(text)])
+        return found[text]
+
+    def stats(self):
+        """Returns the cache's hit rate and the texts and calls sent to the wrapped embeddings."""
+        stats = self.cache.stats()
+        with self._lock:
+            stats["texts_embedded"] = self.texts_embedded
+            stats["calls"] = self.calls
+        return stats
+
+
+def _flush_replaced(old, new):
+    """Writes the access times of a cache that is being replaced, so its hits are not lost."""
+    if old is not None and old is not new:
+        try:
+            old.flush()
+        except sqlite3.Error as e:
+            logger.warning("SQLiteLRUCache: Could not flush %s: %s", old.path, e)
+
+
+def set_llm_cache(cache):
+    """Sets the cache used by every LLM call in the process. None disables caching."""
+    global _llm_cache
+    _flush_replaced(_llm_cache, cache)
+    _llm_cache = cache
+
+
+def get_llm_cache():
+    """Returns the cache used by LLM calls."""
+    return _llm_cache
+
+
+@contextlib.contextmanager
+def llm_cache_namespace(namespace):
+    """Caches the LLM calls made inside the block in namespace."""
+    token = _llm_namespace.set(namespace)
+    try:
+        yield
+    finally:
+        _llm_namespace.reset(token)
+
+
+def get_llm_cache_namespace():
+    """Returns the namespace set by llm_cache_namespace, or None outside of one."""
+    return _llm_namespace.get()
+
+
+def set_brief_library(library):
+    """Sets the brief library used by BriefCases in the process. None turns reuse off."""
+    global _brief_library
+    _flush_replaced(_brief_library, library)
+    _brief_library = library
+
+
+def get_brief_library():
+    """Returns the brief library used by BriefCases."""
+    return _brief_library
+
+
+def set_embedding_cache(cache):
+    """Sets the embedding cache used by list_to_db and load_db. None turns it off."""
+    global _embedding_cache
+    _flush_replaced(_embedding_cache, cache)
+    _embedding_cache = cache
+
+
+def get_embedding_cache():
+    """Returns the embedding cache."""
+    return _embedding_cache
+
+
+def cached_embeddings(embeddings):
+    """Returns embeddings wrapped in CachedEmbeddings with the embedding cache."""
+    cache = get_embedding_cache()
+    if cache is None or isinstance(embeddings, CachedEmbeddings):
+        return embeddings
+    return CachedEmbeddings(embeddings, cache)
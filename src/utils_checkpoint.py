@@ -0,0 +1,113 @@
+"""
+Append-only checkpoint store for the 'restatement' project.
+
+Work that is expensive to redo, such as case briefs, is written to a JSON lines file as soon as
+it is produced, so an interrupted run can pick up where it stopped. Each line holds one record:
+its key, its value and a checksum of the value. Writes are flushed and fsynced before put
+returns. A line that was cut short by a crash, or that fails its checksum, is skipped when the
+file is read. If a key was written more than once, the last valid record wins.
+
+Classes
+
+CheckpointStore(path: str)
+    An append-only key-value store in a JSON lines file. Safe to use from several threads.
+    `key in store` and `len(store)` count the valid records.
+    get(key: str) -> Any or None
+        Returns the value stored under key, or None if there is none.
+    put(key: str, value: Any) -> None
+        Appends a record for key and waits until it is on disk. value must be JSON serializable.
+    stats() -> dict
+        Returns the number of valid records, skipped lines and records written by this store.
+"""
+import json
+import logging
+import os
+import threading
+
+from src.utils_cache import hash_key
+
+# Set up logger
+logger = logging.getLogger('restatement')
+
+
+class CheckpointStore:
+    """An append-only key-value store in a JSON lines file.
+    The whole file is read when the store is opened, and values are kept in memory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.skipped = 0
+        self.written = 0
+        self._values = {}
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """Reads the valid records in the file."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        for line in data.split(b"\n"):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                value = record['value']
+                valid = record['checksum'] == hash_key(json.dumps(value, sort_keys=True))
+            except (ValueError, KeyError, TypeError):
+                valid = False
+            if valid:
+                self._values[record['key']] = value
+            else:
+                self.skipped += 1
+        if self.skipped:
+            logger.warning("CheckpointStore: Skipped %s incomplete or corrupt records in %s.",
+                           self.skipped, self.path)
+        # A crash can leave a partial line at the end. End it, so the next record starts on
+        # its own line.
+        if data and not data.endswith(b"\n"):
+            with open(self.path, 'ab') as f:
+                f.write(b"\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def get(self, key):
+        """Returns the value stored under key, or None if there is none."""
+        with self._lock:
+            return self._values.get(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._values
+
+    def __len__(self):
+        with self._lock:
+            return len(self._values)
+
+    def put(self, key, value):
+        """Appends a record for key and waits until it is on disk."""
+        record = {
+            'key': key,
+            'value': value,
+            'checksum': hash_key(json.dumps(value, sort_keys=True))
+        }
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        with self._lock:
+            with open(self.path, 'ab') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self._values[key] = value
+            self.written += 1
+
+    def stats(self):
+        """Returns the number of valid records, skipped lines and records written by this store."""
+        with self._lock:
+            return {
+                "records": len(self._values),
+                "skipped": self.skipped,
+                "written": self.written
+            }
@@ -0,0 +1,206 @@
+"""
+Memory-mapped corpus of case text for the 'restatement' project.
+
+A corpus is three files that share a path prefix:
+
+- `<path>.bin`: the UTF-8 text of every case, one after the other.
+- `<path>.idx`: an array of 64-bit integers with the byte offset, byte length and character
+  length of each case.
+- `<path>.json`: the name, content hash and source key of each case. It is written last, so a
+  corpus without it is incomplete and is not opened.
+
+The text file is memory-mapped, so a case is sliced from the page cache when it is read, and
+every process that opens the corpus shares the same pages. A CorpusStore pickles as its path,
+so it can be passed to worker processes without copying the text.
+
+Classes
+
+CorpusStore(path: str)
+    Opens a corpus read-only. len(store), store[i] and iteration work as for a list of strings,
+    so a CorpusStore can be used as LoadCases.cases.
+    write(path: str, items: Iterable[Tuple[str, str, str]]) -> CorpusStore
+        Class method. Writes the (name, text, source key) items as a corpus and opens it.
+        Items are written as they are produced, so they never all need to be in memory.
+    keys(path: str) -> List[str] or None
+        Class method. Returns the source keys of the corpus at path, or None if there is no
+        complete corpus there.
+    get_bytes(index: int) -> bytes
+        Returns a copy of the UTF-8 text of a case. A copy does not hold the memory map open,
+        so the store can be closed while it is still in use.
+    length(index: int) -> int
+        Returns the number of characters in a case.
+    name(index: int) -> str
+        Returns the name of a case.
+    content_hash(index: int) -> str
+        Returns the hash of a case's text.
+    index_of(name: str) -> int
+        Returns the index of the case with this name. Raises KeyError if there is none.
+    add_transform(func: Callable[[str], str]) -> None
+        Applies func to the text of each case when it is read, e.g. to remove synopses.
+    close() -> None
+        Closes the memory map.
+"""
+import array
+import hashlib
+import json
+import logging
+import mmap
+import os
+
+# Set up logger
+logger = logging.getLogger('restatement')
+
+# Format version of the corpus files.
+CORPUS_VERSION = 1
+# Integers stored in the index for each case: byte offset, byte length and character length.
+INDEX_FIELDS = 3
+
+
+class CorpusStore:
+    """A read-only, memory-mapped corpus of case text.
+    Text is decoded from the map each time a case is read and is not kept.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.transforms = []
+        self._open()
+
+    def _open(self):
+        """Maps the text file and reads the index and manifest."""
+        with open(self.path + ".json", 'r', encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("version") != CORPUS_VERSION:
+            raise ValueError(f"Unsupported corpus version in {self.path}.json")
+        self.names = manifest["names"]
+        self.hashes = manifest["hashes"]
+        self.source_keys = manifest["keys"]
+        self._index = array.array('q')
+        with open(self.path + ".idx", 'rb') as f:
+            self._index.frombytes(f.read())
+        self._file = open(self.path + ".bin", 'rb')
+        if os.fstat(self._file.fileno()).st_size:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._map)
+        else:
+            # An empty file cannot be mapped.
+            self._map = None
+            self._view = memoryview(b"")
+        self._positions = None
+
+    @classmethod
+    def write(cls, path, items):
+        """Writes the (name, text, source key) items as a corpus and opens it.
+        The files are written under temporary names and then moved into place, so a crash
+        never leaves a corpus that looks complete.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        names = []
+        hashes = []
+        keys = []
+        index = array.array('q')
+        offset = 0
+        with open(path + ".bin.tmp", 'wb') as f:
+            for name, text, key in items:
+                data = text.encode("utf-8", "surrogatepass")
+                f.write(data)
+                index.extend((offset, len(data), len(text)))
+                offset += len(data)
+                names.append(name)
+                hashes.append(hashlib.blake2b(data, digest_size=16).hexdigest())
+                keys.append(key)
+        with open(path + ".idx.tmp", 'wb') as f:
+            index.tofile(f)
+        with open(path + ".json.tmp", 'w', encoding="utf-8") as f:
+            json.dump({"version": CORPUS_VERSION, "names": names, "hashes": hashes,
+                       "keys": keys}, f)
+        # The manifest is moved last, since its presence marks the corpus as complete.
+        for suffix in (".bin", ".idx", ".json"):
+            os.replace(path + suffix + ".tmp", path + suffix)
+        logger.info("CorpusStore: Wrote %s cases (%s bytes) to %s.", len(names), offset, path)
+        return cls(path)
+
+    @classmethod
+    def keys(cls, path):
+        """Returns the source keys of the corpus at path, or None if there is none."""
+        try:
+            with open(path + ".json", 'r', encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest.get("version") != CORPUS_VERSION:
+            return None
+        return manifest["keys"]
+
+    def __len__(self):
+        return len(self.names)
+
+    def _slice(self, index):
+        """Returns a view of the UTF-8 text of a case in the memory map. It must be released
+        before the store is closed.
+        """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("CorpusStore index out of range")
+        offset = self._index[index * INDEX_FIELDS]
+        size = self._index[index * INDEX_FIELDS + 1]
+        return self._view[offset:offset + size]
+
+    def get_bytes(self, index):
+        """Returns a copy of the UTF-8 text of a case."""
+        with self._slice(index) as view:
+            return bytes(view)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        # Decode straight from the memory map, and release the view as soon as it is decoded.
+        with self._slice(index) as view:
+            case = str(view, "utf-8", "surrogatepass")
+        for transform in self.transforms:
+            case = transform(case)
+        return case
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def length(self, index):
+        """Return the number of characters in a case."""
+        return self._index[index * INDEX_FIELDS + 2]
+
+    def name(self, index):
+        """Return the name of a case."""
+        return self.names[index]
+
+    def content_hash(self, index):
+        """Return the hash of a case's text."""
+        return self.hashes[index]
+
+    def index_of(self, name):
+        """Return the index of the case with this name."""
+        if self._positions is None:
+            self._positions = {name: index for index, name in enumerate(self.names)}
+        return self._positions[name]
+
+    def add_transform(self, func):
+        """Apply func to the text of each case when it is read."""
+        if func not in self.transforms:
+            self.transforms.append(func)
+
+    def close(self):
+        """Closes the memory map."""
+        self._view.release()
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+    def __getstate__(self):
+        # Only the path and transforms are pickled. The receiving process maps the same file.
+        return {"path": self.path, "transforms": self.transforms}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self.transforms = state["transforms"]
+        self._open()
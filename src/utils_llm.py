@@ -1,26 +1,70 @@
 """
 Utility functions for working with LLMs.
 
+openai, langchain and Chroma are imported the first time they are needed, and the default 
+OpenAIEmbeddings are built the first time LLMSettings.embeddings is read, so importing this 
+module (and the stage modules that import it) is cheap and does not need an OpenAI API key.
+Their classes can still be imported from this module, e.g. `from src.utils_llm import Chroma`.
+
 Functions
 
 set_openai_key() -> str
-    Sets the OpenAI API key based on your environmental variables.
+    Sets the OpenAI API key based on your environmental variables. 
+    The .env file is loaded once per process.
     Returns:
         A string representing the OpenAI API key.
 
+get_chat_model(model: str, temperature: float = 0.0, streaming: bool = True) -> ChatOpenAI
+    Returns a shared chat model client for the model and settings. Clients (and their HTTP 
+    connection pools) are reused across calls and threads instead of being built for every call.
+    Parameters:
+        model (str): The model to use.
+        temperature (float): The sampling temperature. Defaults to 0.0.
+        streaming (bool): Whether to stream the response. Defaults to True.
+    Returns:
+        A ChatOpenAI object.
+
+OpenAIBackend()
+    The default LLM backend. Sends calls to OpenAI through the clients from get_chat_model.
+    Other backends, such as the offline StubBackend, are set with utils_backend.set_llm_backend.
+
 get_models() -> None
     Prints a list of OpenAI models available to the user.
 
-num_tokens(string: str, encoding_name: str = "cl100k_base") -> int
+run_sync(coro: Coroutine) -> Any
+    Runs a coroutine on the module's background event loop and blocks until it returns.
+    The synchronous functions below are thin wrappers around their async counterparts, and 
+    they use run_sync so that they also work inside notebooks that already run an event loop.
+    Parameters:
+        coro (Coroutine): The coroutine to run.
+    Returns:
+        The return value of the coroutine.
+
+num_tokens(string: str, encoding_name: str = "cl100k_base", model: str = None) -> int
     Returns the number of tokens in a text string using the specified tokenizer.
     Parameters:
         string (str): The text string to tokenize.
         encoding_name (str): The name of the tokenizer to use. Defaults to "cl100k_base".
+        model (str): If given, the tokenizer that this model uses is used instead (see 
+            utils_tokens.encoding_name_for_model).
     Returns:
         An integer representing the number of tokens in the text string.
+    Counts are memoized by the shared TokenCounter in utils_tokens.
+
+num_tokens_many(strings: List[str], encoding_name: str = "cl100k_base", num_threads: int = 8,
+                model: str = None) -> List[int]
+    Returns the number of tokens in each string. Strings that have not been counted before are 
+    encoded together with tiktoken's batch encoder across threads.
+    Parameters:
+        strings (List[str]): The text strings to tokenize.
+        encoding_name (str): The name of the tokenizer to use. Defaults to "cl100k_base".
+        num_threads (int): The number of threads used for batch encoding. Defaults to 8.
+    Returns:
+        A list of integers, one per string.
 
 time_tokens(prompt_template: str, human_template: str, query: str, model: str = 'gpt-4') -> float
-    Returns the time needed to wait before the next request to the language model.
+    Returns the time needed to refill the model's token quota for a request.
+    Kept for compatibility. LLM calls now wait on the shared rate limiter in utils_ratelimit.
     Parameters:
         prompt_template (str): The prompt template.
         human_template (str): The human template.
@@ -35,7 +79,8 @@ sleep_for_time_tokens(
     query: str, 
     model: str = 'gpt-4'
 ) -> None
-    Sleeps for the time needed to wait before the next request to the language model.
+    Sleeps for the time needed to refill the model's token quota for a request.
+    Kept for compatibility. LLM calls now wait on the shared rate limiter in utils_ratelimit.
     Parameters:
         prompt_template (str): The prompt template.
         human_template (str): The human template.
@@ -43,8 +88,8 @@ sleep_for_time_tokens(
         model (str): The model to use. Defaults to 'gpt-4'.
 
 sleep_for_tokens(tokens: int, model: str = 'gpt-4') -> None
-    Sleeps for the time needed to wait before the next request to the language model. 
-    The number of tokens is provided as an argument.
+    Sleeps for the time needed to refill the model's token quota for a number of tokens.
+    Kept for compatibility. LLM calls now wait on the shared rate limiter in utils_ratelimit.
     Parameters:
         tokens (int): The number of tokens.
         model (str): The model to use. Defaults to 'gpt-4'.
@@ -57,7 +102,9 @@ trim_to_last_blank_line(string: str) -> str
         A string trimmed back to the last blank line.
 
 trim_for_tokens(string: str, max_tokens: int = 6000, max_attempts: int = 3000) -> str
-    Trims a string to a maximum number of tokens.
+    Trims a string to a maximum number of tokens by cutting it back to its last blank line, or 
+    to its last sentence when it does not end in one, until it fits. The string is tokenized 
+    once and the longest cut that fits is found by binary search over the candidate cuts.
     Parameters:
         string (str): The string to trim.
         max_tokens (int): The maximum number of tokens. Defaults to 6000.
@@ -72,6 +119,7 @@ trim_part_for_tokens(
     max_attempts: int = 3000
 ) -> str
     Trims a part of a string so that the part plus a remainder is under a token limit.
+    Uses the same cuts and binary search as trim_for_tokens.
     Parameters:
         part (str): The part of the string to trim.
         remainder (str): The remainder of the string.
@@ -90,49 +138,122 @@ string_to_token_list(string: str, chunk_size: int = 6000, chunk_overlap: int = 0
     Returns:
         A list of strings, each of which is a token-sized chunk of the original string.
 
-list_to_token_list(lst: List[str], chunk_size: int = 6000, chunk_overlap: int = 0) -> List[str]
+iter_token_chunks(
+    lst: List[str], 
+    chunk_size: int = 6000, 
+    chunk_overlap: int = 0, 
+    first_fit_decreasing: bool = False
+) -> Iterator[Tuple[str, List[int]]]
+    Combines strings in a list so that each chunk approaches the token limit, and yields each 
+    chunk with the indices of the strings it came from. The list is not modified and each 
+    string is tokenized once. Strings of chunk_size tokens or more are split into pieces.
+    Parameters:
+        lst (List[str]): The list of strings to combine.
+        chunk_size (int): The size of each chunk. Defaults to 6000.
+        chunk_overlap (int): The overlap between pieces of a split string. Defaults to 0.
+        first_fit_decreasing (bool): Whether to pack the largest strings first, each into the 
+            first chunk with room, which yields fewer chunks than packing in order. Chunks are 
+            then yielded after every string is packed. Defaults to False.
+    Returns:
+        An iterator of (chunk, source indices) tuples.
+
+list_to_token_list(
+    lst: List[str], 
+    chunk_size: int = 6000, 
+    chunk_overlap: int = 0, 
+    first_fit_decreasing: bool = False
+) -> List[str]
     Combines strings in a list so that each string in the list approaches the token limit.
     Parameters:
         lst (List[str]): The list of strings to combine.
         chunk_size (int): The size of each chunk. Defaults to 6000.
         chunk_overlap (int): The overlap between chunks. Defaults to 0.
+        first_fit_decreasing (bool): Whether to pack with first-fit-decreasing (see 
+            iter_token_chunks). Defaults to False.
     Returns:
         A list of strings, each of which is a token-sized chunk of the combined strings.
 
 list_to_db(
     lst: List[str],
     name: str = 'vectordb',
-    path: str = get_root_dir() + '/ data / vectordb', settings: LLMSettings
-) -> Chroma
-    Creates a vector database based on a list of strings.
+    path: str = os.path.join(get_root_dir(), 'data', 'vectordb'), settings: LLMSettings
+) -> Chroma or NumpyVectorIndex
+    Creates or updates a vector database of a list of strings, saved at path/name.db. 
+    Each string's id is a hash of its content. If the database was saved before with the same 
+    vector store and embeddings, only new strings are embedded and strings that are no longer in 
+    the list are deleted. If an embedding cache is set (see utils_cache.set_embedding_cache), 
+    strings embedded before are taken from it.
     Parameters:
         lst (List[str]): The list of strings to create the database from.
         name (str): Name of the database. Defaults to 'vectordb'.
-        path (str): Path to the database. Defaults to the root directory plus '/ data / vectordb'.
-        settings (LLMSettings): The settings for the database.
+        path (str): Folder of the database. Defaults to data/vectordb in the root directory.
+        settings (LLMSettings): The settings for the database. settings.vector_store selects 
+            Chroma ('chroma') or the in-process NumpyVectorIndex ('numpy', see utils_vectordb).
     Returns:
-        A Chroma object representing the vector database.
+        A Chroma or NumpyVectorIndex object representing the vector database.
 
-load_db(path: str, embeddings: OpenAIEmbeddings = OpenAIEmbeddings()) -> Chroma
-    Loads a vector database from a file.
+load_db(path: str, embeddings: Embeddings = None) -> Chroma or NumpyVectorIndex
+    Loads a vector database from a file. A NumpyVectorIndex is loaded if one is saved at path.
+    If an embedding cache is set, queries embedded before are taken from it.
     Parameters:
         path (str): The path to the database.
-        embeddings (OpenAIEmbeddings): The embeddings to use. Defaults to OpenAIEmbeddings().
+        embeddings (Embeddings): The embeddings to use. Defaults to LLMSettings.embeddings.
     Returns:
-        A Chroma object representing the loaded vector database.
+        A Chroma or NumpyVectorIndex object representing the loaded vector database.
 
-llm_call(prompt_template, human_template, query, model='gpt-4')
-    Returns the output of an LLMChain call. 
-    If the rate limit is reached, it will ask the user if they want to wait and retry.
+llm_call(prompt_template, human_template, query, model='gpt-4', temperature=0.0)
+    Returns the output of an LLM call. 
+    If an LLMCache is set (see utils_cache.set_llm_cache), cacheable calls are answered from the
+    cache when the same model, prompts and query were sent before, in the namespace set with
+    utils_cache.llm_cache_namespace. The cache is read and written on a separate thread, so
+    its queries do not hold up the other calls on the event loop.
+    The call waits on the model's shared rate limiter before it is sent, and the reservation is
+    reconciled against the token usage reported in the response.
+    Failed calls are retried according to the retry policy in utils_retry. When the rate limit
+    is reached, the model's shared limiter is paused so that every caller backs off.
+    Requests are sent through the backend set with utils_backend.set_llm_backend, or to OpenAI.
+    If a telemetry sink is added (see utils_telemetry), each call records an LLMCallEvent with 
+    its stage, method, model, estimated and actual tokens, latency, time to first token, 
+    rate limiter wait and retries.
 
 llm_call_long(prompt_template, human_template, query, model='gpt-4-1106-preview')
     Returns the output of an LLMChain call with a longer token limit. 
     Defaults to using gpt-4-1106-preview, which has an enormous token limit.
 
-llm_condense_string(string, prompt_condense, model='gpt-4', chunk_size=6000, chunk_overlap=200)
+llm_condense_string(
+    string, 
+    prompt_condense, 
+    model='gpt-4', 
+    chunk_size=6000, 
+    chunk_overlap=200, 
+    max_concurrency=8, 
+    prompt_condense_first=None, 
+    human_template=CONDENSE_HUMAN_TEMPLATE, 
+    separator="\n"
+)
     Condenses the length of a string. 
     The string is broken up into a list of token-sized strings. An LLM is called to condense 
-    each string in the list. The strings are then recombined as one string.
+    each string in the list, with up to max_concurrency calls at once. The outputs are then 
+    recombined in order as one string, each followed by separator. If prompt_condense_first 
+    is given, it is used instead of prompt_condense for the first string.
+
+llm_condense_tree(
+    string, 
+    prompt_condense, 
+    max_tokens, 
+    model='gpt-4', 
+    chunk_size=6000, 
+    chunk_overlap=200, 
+    max_rounds=3, 
+    max_concurrency=8, 
+    prompt_condense_first=None, 
+    human_template=CONDENSE_HUMAN_TEMPLATE, 
+    separator="\n"
+)
+    Condenses a string in up to max_rounds rounds until it is at most max_tokens long. 
+    Each round condenses its chunks concurrently, and the next round packs neighbouring 
+    outputs into token-sized chunks, so the input is reduced like a tree. The routers use 
+    this instead of their condensing loop when settings.condense_tree is set.
 
 llm_condense_string_long(string, prompt_condense, settings=LLMSettings)
     Condenses the input of an LLM query using longer LLM.
@@ -146,42 +267,116 @@ llm_router_gpt4(prompt_template, human_template, query, prompt_condense, setting
     This is designed to be the main function for calling GPT4 exclusively.
 
 llm_loop(prompt_template, human_template, lst, prompt_condense, settings=LLMSettings)
-    Loops through a list, calling llm_router on each item and sleeping for tokens.
+    Loops through a list, calling llm_router on each item.
 
 llm_loop_gpt4(prompt_template, human_template, lst, prompt_condense, settings=LLMSettings)
-    Loops through a list, calling llm_router_GPT4 on each item and sleeping for tokens.
+    Loops through a list, calling llm_router_GPT4 on each item.
+
+allm_call, allm_call_long, allm_condense_string, allm_condense_tree, allm_condense_string_long, 
+allm_router, allm_router_gpt4, allm_loop, allm_loop_gpt4
+    Async counterparts of the functions above. They take the same arguments and return the same
+    values. allm_loop and allm_loop_gpt4 process up to settings.max_concurrency items at once
+    and return the outputs in the same order as the input list.
 
 """
+import asyncio
+import bisect
+import itertools
 import logging
 import os
+import shutil
+import threading
 import time
 import textwrap
+import weakref
+import importlib
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from dotenv import load_dotenv
-import tiktoken
-import openai
-from langchain import LLMChain
-from langchain.chat_models import ChatOpenAI
-from langchain.prompts import (
-    ChatPromptTemplate,
-    SystemMessagePromptTemplate,
-    HumanMessagePromptTemplate,
+from src.utils_file import get_root_dir
+from src.utils_backend import LLMBackend, get_llm_backend
+from src.utils_cache import (
+    cached_embeddings,
+    embedding_name,
+    get_llm_cache,
+    get_llm_cache_namespace,
+    hash_key
 )
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.text_splitter import (
-    TokenTextSplitter
+from src.utils_ratelimit import get_rate_limiter
+from src.utils_telemetry import (
+    CallTimer,
+    LLMCallEvent,
+    bind_call_site,
+    get_call_site,
+    record_llm_call,
+    telemetry_enabled
+)
+from src.utils_tokens import get_encoding, get_token_counter, get_token_counter_for_model
+from src.utils_retry import (
+    get_retry_after,
+    get_retry_policy,
+    is_rate_limit,
+    is_retryable
 )
-from langchain.vectorstores import Chroma
-from src.utils_file import get_root_dir
 
 # Set up logger
 logger = logging.getLogger('restatement')
 
+# Completion tokens reserved for each call until the response reports the actual usage.
+COMPLETION_TOKENS_ESTIMATE = 1000
+
+# Dependencies that are imported on first use: name -> (module, attribute or None for the module).
+_LAZY_IMPORTS = {
+    'openai': ('openai', None),
+    'AsyncCallbackHandler': ('langchain.callbacks.base', 'AsyncCallbackHandler'),
+    'ChatOpenAI': ('langchain.chat_models', 'ChatOpenAI'),
+    'ChatPromptTemplate': ('langchain.prompts', 'ChatPromptTemplate'),
+    'SystemMessagePromptTemplate': ('langchain.prompts', 'SystemMessagePromptTemplate'),
+    'HumanMessagePromptTemplate': ('langchain.prompts', 'HumanMessagePromptTemplate'),
+    'OpenAIEmbeddings': ('langchain.embeddings', 'OpenAIEmbeddings'),
+    'TokenTextSplitter': ('langchain.text_splitter', 'TokenTextSplitter'),
+    'Chroma': ('langchain.vectorstores', 'Chroma'),
+}
+
+def _lazy(name):
+    """Imports a dependency listed in _LAZY_IMPORTS and keeps it as a module global."""
+    value = globals().get(name)
+    if value is None:
+        module_name, attribute = _LAZY_IMPORTS[name]
+        value = importlib.import_module(module_name)
+        if attribute is not None:
+            value = getattr(value, attribute)
+        globals()[name] = value
+    return value
+
+def __getattr__(name):
+    """Imports the dependencies in _LAZY_IMPORTS when they are read from this module."""
+    if name in _LAZY_IMPORTS:
+        return _lazy(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+class _LazyEmbeddings:
+    """The default LLMSettings.embeddings. OpenAIEmbeddings is built the first time the attribute
+    is read and then shared, like the class attribute it replaces. Setting embeddings on the
+    class or on an instance overrides it as before.
+    """
+
+    def __init__(self):
+        self._embeddings = None
+        self._lock = threading.Lock()
+
+    def __get__(self, instance, owner):
+        if self._embeddings is None:
+            with self._lock:
+                if self._embeddings is None:
+                    self._embeddings = _lazy('OpenAIEmbeddings')()
+        return self._embeddings
+
 @dataclass
 class LLMSettings:
     """Settings for the LLM."""
-    # Embeddings
-    embeddings = OpenAIEmbeddings()
+    # Embeddings (OpenAIEmbeddings unless set, built on first use)
+    embeddings = _LazyEmbeddings()
     # Primary LLM model
     model: str = 'gpt-4'
     # Maximum tokens for input to primary LLM
@@ -199,17 +394,136 @@ class LLMSettings:
     # Maximum number of attempts at reducing a long input to a short input by breaking it up
     # into chunks, summarizing those chunks, and then combining the summaries.
     max_attempts: int = 3
+    # Whether to pack briefs into chunks largest first, which makes fewer chunks than in order
+    first_fit_decreasing: bool = False
+    # Maximum number of LLM calls that the async loops keep in flight at once
+    max_concurrency: int = 8
+    # Number of cases that BriefCases.create_briefs briefs at once (1 briefs them one by one)
+    brief_workers: int = 4
+    # Number of processes that LoadCases parses .rtf files in (1 parses them in this process)
+    parse_workers: int = 4
+    # RTF engine used by LoadCases: 'fast' (utils_rtf) or 'striprtf'
+    rtf_engine: str = 'fast'
+    # Maximum size of the cache of parsed case text in megabytes. Cases evicted from it are
+    # parsed again when they are read, so it should hold the whole corpus.
+    parse_cache_max_mb: int = 8192
+    # Whether LoadCases writes the cases to a memory-mapped corpus and reads them from it
+    corpus_store: bool = False
+    # Vector store for briefs_db: 'chroma', or 'numpy' for the in-process NumpyVectorIndex
+    vector_store: str = 'chroma'
+    # Whether embeddings are cached on disk by list_to_db and load_db (see utils_cache)
+    embedding_cache: bool = True
+    # Whether the routers condense long inputs in tree-reduction rounds (see llm_condense_tree)
+    # instead of re-splitting and condensing the whole input on every attempt
+    condense_tree: bool = False
+    # Scope of the LLM response cache: 'section' (per section title), 'global', or None (off)
+    cache_scope: str = 'section'
+    # Maximum size of the LLM response cache in megabytes
+    cache_max_mb: int = 1024
+    # Whether briefs are shared across sections through the brief library (see utils_cache).
+    # Shared briefs are written with a prompt that does not name the section or area of law.
+    brief_library: bool = False
+
+# Human prompt for condensing a chunk of text. Note that it must contain {query}.
+CONDENSE_HUMAN_TEMPLATE = textwrap.dedent(
+    """Please write a shorter version of this. 
+    {query}
+    """
+    )
+
+# Background event loop that the synchronous wrappers submit their coroutines to.
+_loop = None
+_loop_thread = None
+_loop_lock = threading.Lock()
+# Thread that reads and writes the LLM cache, so its SQLite queries and commits do not block
+# the event loop. One thread is enough, since the cache serializes them with a lock.
+_cache_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="restatement-llm-cache")
+
+# Whether the .env file has been loaded in this process.
+_dotenv_loaded = False
+# Shared chat model clients. Async connection pools belong to the event loop that opened them,
+# so clients are grouped by event loop and then keyed by model settings.
+_chat_models = weakref.WeakKeyDictionary()
+_chat_models_lock = threading.Lock()
 
 def set_openai_key():
-    """Set variable for OpenAI API key based on your environmental variables."""
-    load_dotenv()
+    """Set variable for OpenAI API key based on your environmental variables.
+    The .env file is only read the first time this is called.
+    """
+    global _dotenv_loaded
+    if not _dotenv_loaded:
+        load_dotenv()
+        _dotenv_loaded = True
     openai_api_key = os.environ.get('OPENAI_API_KEY')
     return openai_api_key
 
+def get_chat_model(model, temperature=0.0, streaming=True):
+    """Returns a shared chat model client for the model and settings.
+    Clients are created on first use and then reused, so their HTTP connections stay open
+    across calls. Clients used outside an event loop are grouped with the background loop.
+    """
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = _get_loop()
+    openai_api_key = set_openai_key()
+    key = (model, float(temperature), streaming, openai_api_key)
+    with _chat_models_lock:
+        clients = _chat_models.setdefault(loop, {})
+        chat_model = clients.get(key)
+        if chat_model is None:
+            logger.debug("get_chat_model: Creating client for %s.", model)
+            chat_model = _lazy('ChatOpenAI')(
+                model_name=model,
+                temperature=temperature,
+                verbose=False,
+                openai_api_key=openai_api_key,
+                streaming=streaming,
+                # Retries are handled by llm_call so they go through the shared rate limiter.
+                max_retries=0
+                )
+            clients[key] = chat_model
+    return chat_model
+
+# Callback handler class built by _first_token_handler, since it subclasses a langchain class.
+_FirstTokenHandler = None
+
+def _first_token_handler(on_first_token):
+    """Returns a callback handler that calls on_first_token when the first streamed token arrives."""
+    global _FirstTokenHandler
+    if _FirstTokenHandler is None:
+        class _FirstTokenHandler(_lazy('AsyncCallbackHandler')):
+            """Calls on_first_token when the first streamed token arrives."""
+
+            def __init__(self, on_first_token):
+                self.on_first_token = on_first_token
+
+            async def on_llm_new_token(self, token, **kwargs):
+                if self.on_first_token is not None:
+                    self.on_first_token()
+                    self.on_first_token = None
+    return _FirstTokenHandler(on_first_token)
+
+class OpenAIBackend(LLMBackend):
+    """Sends LLM calls to OpenAI through the shared ChatOpenAI clients."""
+
+    async def agenerate(self, model, messages, temperature=0.0, on_first_token=None):
+        """Returns the completion text and the token usage reported for it."""
+        callbacks = [_first_token_handler(on_first_token)] if on_first_token is not None else None
+        result = await get_chat_model(model, temperature).agenerate(
+            [messages],
+            callbacks=callbacks
+        )
+        usage = (result.llm_output or {}).get('token_usage') or {}
+        return result.generations[0][0].text, usage
+
+# Backend used when no other backend is set with utils_backend.set_llm_backend.
+_openai_backend = OpenAIBackend()
+
 def get_models():
     """Prints a list of OpenAI models available to the user."""
     try:
-        available_models = openai.models.list()
+        available_models = _lazy('openai').models.list()
 
         for model in available_models.data:
             print(model.id)
@@ -217,19 +531,88 @@ def get_models():
         print(f"Error: {e}")
         print("Unable to retrieve model information.")
 
-def num_tokens(string, encoding_name="cl100k_base") -> int:
-    """Returns the number of tokens in a text string using the CL100k_base tokenizer."""
-    encoding = tiktoken.get_encoding(encoding_name)
-    tokens = len(encoding.encode(string))
-    return tokens
+def _get_loop():
+    """Returns the background event loop, starting it on first use."""
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(
+                target=_loop.run_forever,
+                name="restatement-llm-loop",
+                daemon=True
+            )
+            _loop_thread.start()
+    return _loop
+
+def run_sync(coro):
+    """Runs a coroutine on the background event loop and blocks until it returns.
+    A dedicated loop is used instead of asyncio.run so that the synchronous functions also work
+    in notebooks, where the main thread already has a running event loop.
+    """
+    loop = _get_loop()
+    if threading.current_thread() is _loop_thread:
+        coro.close()
+        raise RuntimeError(
+            "run_sync cannot be called from the LLM event loop. Await the allm_* function instead."
+        )
+    # The coroutine runs in a copy of this thread's context, so the caller is bound here.
+    with bind_call_site():
+        future = asyncio.run_coroutine_threadsafe(coro, loop)
+    try:
+        return future.result()
+    except BaseException:
+        # Stop the coroutine if the caller is interrupted (e.g. KeyboardInterrupt), so it does
+        # not keep running on the loop. Does nothing if the coroutine itself raised.
+        future.cancel()
+        raise
+
+async def _gather_in_order(func, items, limit):
+    """Awaits func(count, item) for every item with at most limit calls in flight.
+    Results are returned in the same order as items. If a call raises, or this coroutine is
+    cancelled, the calls still in flight or waiting for the semaphore are cancelled before the
+    exception is raised, so no more requests are sent for a result that will be thrown away.
+    """
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def run(count, item):
+        async with semaphore:
+            return await func(count, item)
+
+    tasks = [
+        asyncio.ensure_future(run(count, item)) for count, item in enumerate(items, start=1)
+    ]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        # Wait for the cancelled calls to finish unwinding before raising.
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+def _counter(encoding_name, model):
+    """Returns the token counter of the model if one is given, or of the tokenizer."""
+    if model is not None:
+        return get_token_counter_for_model(model)
+    return get_token_counter(encoding_name)
+
+def num_tokens(string, encoding_name="cl100k_base", model=None) -> int:
+    """Returns the number of tokens in a text string using the CL100k_base tokenizer, or
+    the tokenizer of model if one is given.
+    """
+    # Counts are memoized, so strings that are counted repeatedly are only tokenized once.
+    return _counter(encoding_name, model).count(string)
+
+
+def num_tokens_many(strings, encoding_name="cl100k_base", num_threads=8, model=None) -> list:
+    """Returns the number of tokens in each string, batch-encoding the uncounted ones."""
+    return _counter(encoding_name, model).count_many(strings, num_threads=num_threads)
 
 def time_tokens(prompt_template, human_template, query, model='gpt-4'):
-    """Returns the time needed to wait before the next request to the LLM."""
-    if model == 'gpt-3.5-turbo-1106':
-        tps = 300000 / 60 # tokens per minute under my account
-    else:
-        tps = 3000000 / 60 # tokens per minute under my account
-    tokens = num_tokens(prompt_template + human_template + query)
+    """Returns the time needed to refill the model's token quota for a request."""
+    tps = get_rate_limiter(model).tokens_per_second()
+    tokens = num_tokens(prompt_template + human_template + query, model=model)
     return tokens / tps
 
 def sleep_for_time_tokens(prompt_template, human_template, query, model='gpt-4'):
@@ -239,14 +622,12 @@ def sleep_for_time_tokens(prompt_template, human_template, query, model='gpt-4')
     time.sleep(time_to_sleep)
 
 def sleep_for_tokens(tokens, model='gpt-4'):
-    """Sleeps for the time needed to wait before the next request to the LLM.
+    """Sleeps for the time needed to refill the model's token quota for a number of tokens.
     Difference between this and sleep_for_time_tokens is that tokens are provided in argument
     rather than text strings that the function converts to tokens.
+    LLM calls no longer need this. They wait on the shared rate limiter before each request.
     """
-    if model == 'gpt-3.5-turbo-1106':
-        tps = 300000 / 60 # tokens per minute under my account
-    else:
-        tps = 300000 / 60 # tokens per minute under my account
+    tps = get_rate_limiter(model).tokens_per_second()
     time_to_sleep = tokens / tps
     logger.debug("Sleeping for %s seconds...", time_to_sleep)
     time.sleep(time_to_sleep)
@@ -259,32 +640,102 @@ def trim_to_last_blank_line(string):
             return '\n'.join(lines[:i+1])
     return ''
 
+def _trim_once(string):
+    """Cuts string back to the last blank line, or to the last sentence if that changes nothing."""
+    trimmed = trim_to_last_blank_line(string)
+    if trimmed == string:
+        return string[:string.rfind(".")+1]
+    return trimmed
+
+def _trim_cut_lengths(string, max_cuts):
+    """Returns the lengths of string and of up to max_cuts - 1 successive _trim_once cuts of it.
+    string must only contain '\n' line breaks (true of any output of _trim_once), so that every 
+    cut is a prefix of string and can be found from precomputed line spans and sentence ends.
+    """
+    # Span of each line, index of its first non-whitespace character, and last blank line before it
+    starts, ends, first_text, previous_blank = [], [], [], []
+    last_blank = -1
+    position = 0
+    for line in string.split("\n"):
+        end = position + len(line)
+        starts.append(position)
+        ends.append(end)
+        first_text.append(end - len(line.lstrip()))
+        previous_blank.append(last_blank)
+        if not line.strip():
+            last_blank = len(starts) - 1
+        position = end + 1
+    dots = [i for i, char in enumerate(string) if char == "."]
+
+    def cut(length):
+        """Returns the length of _trim_once(string[:length])."""
+        if length == 0:
+            return 0
+        # Last line of the prefix (a trailing newline does not start a new line)
+        k = bisect.bisect_left(starts, length) - 1
+        line_end = min(ends[k], length)
+        if first_text[k] >= line_end:
+            if line_end == length:
+                # The prefix ends in a blank line, so cut to the last sentence instead
+                d = bisect.bisect_left(dots, length) - 1
+                return dots[d] + 1 if d >= 0 else 0
+            return line_end
+        i = previous_blank[k]
+        return ends[i] if i >= 0 else 0
+
+    lengths = [len(string)]
+    while len(lengths) < max_cuts:
+        length = cut(lengths[-1])
+        if length == lengths[-1]:
+            # No further cut changes the string
+            break
+        lengths.append(length)
+    return lengths
+
+def _trim_search(string, count, max_tokens, max_attempts, extra_tokens=0):
+    """Returns what cutting string back one blank line or sentence at a time, until
+    count(string) <= max_tokens or max_attempts is reached, would return.
+    The string is tokenized once to estimate the tokens in every cut, the longest cut under 
+    budget is found by binary search, and the choice is confirmed with exact counts of it and 
+    the cut before it. extra_tokens estimates the tokens count adds to each cut.
+    """
+    if count(string) <= max_tokens or max_attempts <= 1:
+        return string
+    first = _trim_once(string)
+    lengths = _trim_cut_lengths(first, max_attempts - 1)
+    # Byte offset at which each token of the first cut starts
+    token_bytes = get_encoding().decode_tokens_bytes(get_encoding().encode(first))
+    token_starts = [0] + list(itertools.accumulate(len(b) for b in token_bytes))[:-1]
+
+    def estimate(length):
+        """Returns the tokens that start before the end of the cut."""
+        size = len(first[:length].encode("utf-8", "surrogatepass"))
+        return bisect.bisect_left(token_starts, size) + extra_tokens
+
+    # Cuts get shorter down the list, so the estimates never increase
+    low, high = 0, len(lengths) - 1
+    while low < high:
+        middle = (low + high) // 2
+        if estimate(lengths[middle]) <= max_tokens:
+            high = middle
+        else:
+            low = middle + 1
+    # Estimates can be off by a token or two at the cut, so confirm with exact counts
+    while low < len(lengths) - 1 and count(first[:lengths[low]]) > max_tokens:
+        low += 1
+    while low > 0 and count(first[:lengths[low-1]]) <= max_tokens:
+        low -= 1
+    logger.debug("_trim_search: Trimmed %s characters to %s.", len(string), lengths[low])
+    return first[:lengths[low]]
+
 def trim_for_tokens(string, max_tokens=6000, max_attempts=3000):
-    """Trims string to max_tokens."""
-    tokens = num_tokens(string)
-    count = 1
-    while tokens > max_tokens and count < max_attempts:
-        logger.debug(
-            "trim_for_tokens: String is too long. Trimming to last blank line. (Attempt %s).", 
-            count
-        )
-        if string == trim_to_last_blank_line(string):
-            logger.debug(
-                "trim_for_tokens: String is too long. Trimming to last sentence. (Attempt %s).",
-                count
-            )
-            string = string[:string.rfind(".")+1]
-            tokens = num_tokens(string)
-            count += 1
-            continue
-        string = trim_to_last_blank_line(string)
-        tokens = num_tokens(string)
-        count += 1
-    return string
+    """Trims string to max_tokens by cutting back to blank lines, then to sentences."""
+    return _trim_search(string, num_tokens, max_tokens, max_attempts)
 
 def trim_part_for_tokens(part, remainder, max_tokens=6000, trim_tokens=3000, max_attempts=3000):
     """Trims part so that part + remainder is under token limit."""
-    if num_tokens(remainder) > max_tokens:
+    remainder_tokens = num_tokens(remainder)
+    if remainder_tokens > max_tokens:
         logger.debug(
             "trim_query_for_tokens: Other parts exceed %s tokens. Reducing to %s tokens.",
             max_tokens,
@@ -292,121 +743,263 @@ def trim_part_for_tokens(part, remainder, max_tokens=6000, trim_tokens=3000, max
         )
         part = trim_for_tokens(part, trim_tokens)
         return part
-    tokens = num_tokens(part + remainder)
-    count = 1
-    while tokens > max_tokens and count < max_attempts:
-        logger.debug(
-            "trim_part_for_tokens: Part is too long. Trimming to last blank line. (Attempt %d).", 
-            count
-        )
-        if part == trim_to_last_blank_line(part):
-            logger.debug(
-                "trim_part_for_tokens: Part is too long. Trimming to last sentence. (Attempt %d).", 
-                count
-            )
-            part = part[:part.rfind(".")+1]
-            tokens = num_tokens(part + remainder)
-            count += 1
-            continue
-        part = trim_to_last_blank_line(part)
-        tokens = num_tokens(part + remainder)
-        count += 1
-    return part
+    return _trim_search(
+        part,
+        lambda candidate: num_tokens(candidate + remainder),
+        max_tokens,
+        max_attempts,
+        extra_tokens=remainder_tokens
+    )
 
 def string_to_token_list(string, chunk_size=6000, chunk_overlap=0):
     """Turns string into list of token-sized strings."""
-    text_splitter = TokenTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    text_splitter = _lazy('TokenTextSplitter')(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
     return text_splitter.split_text(string)
 
-def list_to_token_list(lst, chunk_size=6000, chunk_overlap=0):
-    """Combines strings in a list so that each string in the list approaches token limit.
-    This increases efficiency when you want an LLM to process all the items in a list
-    but you don't need to process each item individually with its own LLM call.
+def _count_items(lst):
+    """Returns the tokens in each string, or None for strings that cannot be tokenized."""
+    try:
+        return num_tokens_many(lst)
+    except Exception:
+        # Count one at a time so that one bad string does not lose the others
+        counts = []
+        for index, x in enumerate(lst):
+            try:
+                counts.append(num_tokens(x))
+            except Exception as e:
+                logger.error("Error calculating tokens for item at index %s: %s", index, e)
+                counts.append(None)
+        return counts
+
+def _token_items(lst, chunk_size, chunk_overlap):
+    """Yields (source index, string, tokens) for each item in lst.
+    Items of chunk_size tokens or more are split into token-sized pieces, which are not split 
+    again.
     """
-    temp_list = lst
-    token_list = []
-    total_tokens = 0
-    scratchpad = ""
-    index = 0
-    while index < len(temp_list):
-        x = temp_list[index]
+    for index, (x, tokens) in enumerate(zip(lst, _count_items(lst))):
+        if tokens is None:
+            continue
+        if tokens < chunk_size:
+            yield index, x, tokens
+            continue
         try:
-            tokens = num_tokens(x)
+            x_list = string_to_token_list(
+                x,
+                chunk_size=chunk_size,
+                chunk_overlap=chunk_overlap
+            )
         except Exception as e:
-            logging.error("Error calculating tokens for item at index %s: %s", index, e)
-            index += 1
-            continue
-        # If item exceeds token limit, split item into its own token_list,
-        # insert that list, end the current iteration, and continue to the next iteration.
-        if tokens >= chunk_size:
-            try:
-                x_list = string_to_token_list(
-                    x,
-                    chunk_size=chunk_size,
-                    chunk_overlap=chunk_overlap
-                )
-            except Exception as e:
-                logging.error(
-                    "Error splitting string into token list for item at index %d: %s", 
-                    index,
-                    e
-                )
-                index += 1
-                continue
-            temp_list.pop(index)
-            temp_list[index:index] = x_list  # insert x_list items at current position
+            logger.error(
+                "Error splitting string into token list for item at index %d: %s",
+                index,
+                e
+            )
             continue
-        # If item plus scratchpad exceeds token limit, add scratchpad to list,
-        # clear scratchpad, and clear total tokens.
-        if total_tokens + tokens >= chunk_size:
-            token_list.append(scratchpad)
-            scratchpad = ""
+        for piece, piece_tokens in zip(x_list, _count_items(x_list)):
+            if piece_tokens is not None:
+                yield index, piece, piece_tokens
+
+def _join_chunk(items):
+    """Returns the chunk text and the sorted source indices of a list of items."""
+    chunk = "".join("\n " + x for _, x, _ in items)
+    return chunk, sorted(set(index for index, _, _ in items))
+
+def _pack_greedy(items, chunk_size):
+    """Packs items into chunks in arrival order, starting a new chunk when the next item 
+    would bring the current one to chunk_size tokens.
+    """
+    scratchpad = []
+    total_tokens = 0
+    for item in items:
+        if scratchpad and total_tokens + item[2] >= chunk_size:
+            yield _join_chunk(scratchpad)
+            scratchpad = []
             total_tokens = 0
-        # Add item to scratchpad, add tokens to token count
-        scratchpad += "\n " + x
-        total_tokens += tokens
-        index += 1
-    if scratchpad:  # handle any remaining content in scratchpad
-        token_list.append(scratchpad)
-    return token_list
+        scratchpad.append(item)
+        total_tokens += item[2]
+    if scratchpad:
+        yield _join_chunk(scratchpad)
+
+class _FirstFit:
+    """Finds the first chunk with room for an item in O(log n).
+    Free tokens per chunk are kept in a max segment tree. Chunks that have not been opened yet 
+    are empty, so the first of them is where a new chunk opens.
+    """
+
+    def __init__(self, max_chunks, chunk_size):
+        self.size = 1
+        while self.size < max_chunks:
+            self.size *= 2
+        self.free = [chunk_size] * (2 * self.size)
+        self.opened = 0
+
+    def place(self, tokens):
+        """Takes tokens from the first chunk that has more free tokens and returns its index."""
+        if self.free[1] <= tokens:
+            # Too large for any chunk, even an empty one, so it gets a chunk of its own
+            node = self.size + self.opened
+        else:
+            node = 1
+            while node < self.size:
+                node = 2 * node if self.free[2 * node] > tokens else 2 * node + 1
+        self.free[node] -= tokens
+        index = node - self.size
+        self.opened = max(self.opened, index + 1)
+        node //= 2
+        while node:
+            self.free[node] = max(self.free[2 * node], self.free[2 * node + 1])
+            node //= 2
+        return index
+
+def _pack_first_fit_decreasing(items, chunk_size):
+    """Packs items, largest first, into the first chunk they fit in.
+    Items within a chunk keep their original order.
+    """
+    items = sorted(items, key=lambda item: item[2], reverse=True)
+    first_fit = _FirstFit(len(items), chunk_size)
+    chunks = []
+    for item in items:
+        index = first_fit.place(item[2])
+        if index == len(chunks):
+            chunks.append([])
+        chunks[index].append(item)
+    for chunk in chunks:
+        # Sorting is stable, so pieces of a split item stay in order
+        chunk.sort(key=lambda item: item[0])
+        yield _join_chunk(chunk)
+
+def iter_token_chunks(lst, chunk_size=6000, chunk_overlap=0, first_fit_decreasing=False):
+    """Yields (chunk, source indices) pairs that combine the strings in lst so that each chunk 
+    approaches the token limit. lst is not modified, and each string is tokenized once.
+    """
+    items = _token_items(lst, chunk_size, chunk_overlap)
+    if first_fit_decreasing:
+        yield from _pack_first_fit_decreasing(items, chunk_size)
+    else:
+        yield from _pack_greedy(items, chunk_size)
+
+def list_to_token_list(lst, chunk_size=6000, chunk_overlap=0, first_fit_decreasing=False):
+    """Combines strings in a list so that each string in the list approaches token limit.
+    This increases efficiency when you want an LLM to process all the items in a list
+    but you don't need to process each item individually with its own LLM call.
+    """
+    return [
+        chunk for chunk, _ in iter_token_chunks(
+            lst,
+            chunk_size,
+            chunk_overlap,
+            first_fit_decreasing
+        )
+    ]
 
 def list_to_db(
         lst,
         name='vectordb',
-        path=get_root_dir() + '/ data / vectordb',
+        path=os.path.join(get_root_dir(), 'data', 'vectordb'),
         settings=LLMSettings
     ):
-    """Create a vector database based on a list of strings.
+    """Create or update a vector database of a list of strings.
+    The database is saved at path/name.db, where load_db finds it. Each string's id is a hash
+    of its content, and the ids are saved in a manifest. If the database was already saved with
+    the same vector store and embeddings, only strings that are not in it are embedded, and
+    strings that are no longer in lst are deleted.
     """
-    # Create vector database.
-    embeddings = settings.embeddings
-    persist_directory = str(path) + f"/ {name}"
-    persist_directory = str(persist_directory)
-    vectordb = Chroma.from_texts(texts=lst,
-                                 embedding=embeddings,
-                                 persist_directory=persist_directory)
+    from src.utils_vectordb import NumpyVectorIndex, read_manifest, write_manifest
+    # Texts embedded before, in any run or section, are taken from the embedding cache.
+    embeddings = cached_embeddings(settings.embeddings)
+    persist_directory = os.path.join(str(path), f"{name}.db")
+    # One id per distinct string, in order.
+    texts = {}
+    for text in lst:
+        texts.setdefault(hash_key(text), text)
+    manifest = read_manifest(persist_directory)
+    embedding = embedding_name(embeddings)
+    if (manifest is not None and manifest.get("store") == settings.vector_store
+            and manifest.get("embedding") == embedding):
+        # Update the saved database.
+        vectordb = load_db(persist_directory, embeddings)
+        saved = set(manifest["ids"])
+        removed = [id_ for id_ in manifest["ids"] if id_ not in texts]
+        added = [id_ for id_ in texts if id_ not in saved]
+        if removed:
+            vectordb.delete(ids=removed)
+        if added:
+            vectordb.add_texts([texts[id_] for id_ in added], ids=added)
+        logger.info("list_to_db: %s: %s texts kept, %s added, %s removed.",
+                    persist_directory, len(texts) - len(added), len(added), len(removed))
+    else:
+        # Build the database from scratch. A database from another store or other embeddings
+        # is replaced.
+        if os.path.exists(persist_directory):
+            shutil.rmtree(persist_directory)
+        if settings.vector_store == 'numpy':
+            store = NumpyVectorIndex
+        else:
+            store = _lazy('Chroma')
+        vectordb = store.from_texts(texts=list(texts.values()),
+                                    embedding=embeddings,
+                                    ids=list(texts),
+                                    persist_directory=persist_directory)
     vectordb.persist()
+    # The manifest is written last, so it only lists texts that are in the database.
+    write_manifest(persist_directory, settings.vector_store, embedding, texts)
     return vectordb
 
 def load_db(
         path,
-        embeddings = OpenAIEmbeddings()
+        embeddings = None
     ):
     """Load a vector database from file.
     """
-    vector_db = Chroma(persist_directory=path,embedding_function=embeddings)
+    if embeddings is None:
+        embeddings = LLMSettings.embeddings
+    # Queries embedded before are taken from the embedding cache.
+    embeddings = cached_embeddings(embeddings)
+    from src.utils_vectordb import NumpyVectorIndex
+    if NumpyVectorIndex.exists(path):
+        return NumpyVectorIndex.load(path, embeddings)
+    vector_db = _lazy('Chroma')(persist_directory=path,embedding_function=embeddings)
     return vector_db
 
-def llm_call(prompt_template, human_template, query, model='gpt-4'):
-    """Returns the output of an LLMChain call.
+def _record_call(model, estimated_tokens, timer, text, usage, retries=0, cached=False, error=None):
+    """Sends a telemetry event for an LLM call to the telemetry sinks."""
+    stage, method = get_call_site()
+    prompt_tokens = usage.get('prompt_tokens') or estimated_tokens
+    completion_tokens = usage.get('completion_tokens') or (
+        num_tokens(text, model=model) if text else 0
+    )
+    record_llm_call(LLMCallEvent(
+        timestamp=time.time(),
+        stage=stage,
+        method=method,
+        model=model,
+        estimated_tokens=estimated_tokens,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=usage.get('total_tokens') or prompt_tokens + completion_tokens,
+        usage_reported=bool(usage.get('total_tokens')),
+        retries=retries,
+        cached=cached,
+        error=None if error is None else f"{type(error).__name__}: {error}",
+        **({'duration_s': 0.0, 'latency_s': 0.0} if cached else timer.timings())
+    ))
+
+async def allm_call(prompt_template, human_template, query, model='gpt-4', temperature=0.0):
+    """Returns the output of an LLM call.
+    Cacheable calls are answered from the LLM cache when the same call was made before.
+    Otherwise the call waits on the model's shared rate limiter first. Afterwards the reservation is
+    reconciled against the usage reported in the response, or against a count of the prompt
+    and completion when the response does not report usage (as with streaming).
+    Retryable errors are retried with backoff according to the retry policy. Rate limit errors
+    pause the shared limiter, so a burst of them slows every caller instead of each one retrying.
     """
-    system_message_prompt = SystemMessagePromptTemplate.from_template(
+    system_message_prompt = _lazy('SystemMessagePromptTemplate').from_template(
         prompt_template
         )
-    human_message_prompt = HumanMessagePromptTemplate.from_template(
+    human_message_prompt = _lazy('HumanMessagePromptTemplate').from_template(
         human_template
         )
-    chat_prompt = ChatPromptTemplate.from_messages(
+    chat_prompt = _lazy('ChatPromptTemplate').from_messages(
         [system_message_prompt, human_message_prompt]
         )
     chat_prompt_str = textwrap.dedent(
@@ -419,47 +1012,109 @@ def llm_call(prompt_template, human_template, query, model='gpt-4'):
     {query}
     """
     )
-    total_tokens = num_tokens(chat_prompt_str)
-    while True:
-        try:
-            llm_chain = LLMChain(
-                llm=ChatOpenAI(
-                    model_name=model,
-                    temperature=0.0,
-                    verbose=False,
-                    openai_api_key=set_openai_key(),
-                    streaming=True
-                    ),
-                prompt=chat_prompt,
-                verbose=False
+    total_tokens = num_tokens(chat_prompt_str, model=model)
+    timer = CallTimer()
+    cache = get_llm_cache()
+    # The namespace is read here, in the caller's context, and passed with each cache call.
+    namespace = get_llm_cache_namespace()
+    if cache is not None:
+        cached = await asyncio.get_running_loop().run_in_executor(
+            _cache_executor,
+            cache.get_response,
+            model,
+            prompt_template,
+            human_template,
+            query,
+            temperature,
+            namespace
+        )
+        if cached is not None:
+            logger.debug("llm_call: Response found in cache.")
+            output = {'query': query, 'text': cached['text']}
+            if telemetry_enabled():
+                _record_call(
+                    model,
+                    total_tokens,
+                    timer,
+                    cached['text'],
+                    cached.get('usage') or {},
+                    cached=True
                 )
-            output = llm_chain(query)
-            logger.debug(output['text'])
             return (output, total_tokens, model, chat_prompt_str)
-
-        except Exception as e:  # Replace Exception with the specific exception class, if known.
-            print(f"Error: {e}")
-
-            # Check if the error message corresponds to the limit being reached.
-            if "rate limit" in str(e).lower():
-                # Adjust the condition based on the actual error message.
-                user_input = input("""llm_call: The LLM rate limit has been reached.
-                                   Do you want to wait and retry? (yes/no): 
-                                   """).lower()
-                if user_input == 'yes':
-                    while True:
-                        try:
-                            wait_time = int(input("How long (seconds)?: "))
-                            break
-                        except ValueError:
-                            print("Please enter a valid number of seconds.")
-                    print(f"Waiting for {wait_time} seconds before retrying...")
-                    time.sleep(wait_time)  # wait
-                    continue
-                else:
-                    raise  # re-raise the exception if the user doesn't want to wait
+    messages = chat_prompt.format_messages(query=query)
+    limiter = get_rate_limiter(model)
+    policy = get_retry_policy()
+    attempt = 1
+    while True:
+        with timer.queue():
+            reservation = await limiter.aacquire(total_tokens + COMPLETION_TOKENS_ESTIMATE)
+        timer.start_attempt()
+        try:
+            text, usage = await (get_llm_backend() or _openai_backend).agenerate(
+                model,
+                messages,
+                temperature,
+                on_first_token=timer.first_token
+            )
+            break
+        except Exception as e:
+            # A failed request still counts against the request quota but uses no tokens.
+            limiter.reconcile(reservation, 0)
+            if not is_retryable(e) or attempt >= policy.max_attempts:
+                logger.error("llm_call: Call failed after %s attempt(s): %s", attempt, e)
+                if telemetry_enabled():
+                    timer.finish()
+                    _record_call(model, total_tokens, timer, "", {}, retries=attempt-1, error=e)
+                raise
+            delay = policy.delay(attempt, get_retry_after(e))
+            logger.warning(
+                "llm_call: Attempt %s of %s failed: %s. Retrying in %.1f seconds.",
+                attempt,
+                policy.max_attempts,
+                e,
+                delay
+            )
+            if is_rate_limit(e):
+                # Pause every caller of this model, not just this one.
+                limiter.pause(delay)
             else:
-                raise  # re-raise the exception if it's not related to the limit being reached
+                await asyncio.sleep(delay)
+            attempt += 1
+    timer.finish()
+    actual_tokens = usage.get('total_tokens') or total_tokens + num_tokens(text, model=model)
+    limiter.reconcile(reservation, actual_tokens)
+    if telemetry_enabled():
+        _record_call(model, total_tokens, timer, text, usage, retries=attempt-1)
+    if cache is not None:
+        await asyncio.get_running_loop().run_in_executor(
+            _cache_executor,
+            cache.set_response,
+            model,
+            prompt_template,
+            human_template,
+            query,
+            {'text': text, 'usage': usage},
+            temperature,
+            namespace
+        )
+    output = {'query': query, 'text': text}
+    logger.debug(output['text'])
+    return (output, total_tokens, model, chat_prompt_str)
+
+def llm_call(prompt_template, human_template, query, model='gpt-4', temperature=0.0):
+    """Returns the output of an LLM call.
+    """
+    return run_sync(allm_call(
+        prompt_template,
+        human_template,
+        query,
+        model=model,
+        temperature=temperature
+    ))
+
+async def allm_call_long(prompt_template, human_template, query, model='gpt-4-1106-preview'):
+    """Async counterpart of llm_call_long."""
+    return await allm_call(prompt_template, human_template, query, model=model)
 
 def llm_call_long(prompt_template, human_template, query, model='gpt-4-1106-preview'):
     """Returns the output of an LLMChain call with a longer token limit.
@@ -468,101 +1123,240 @@ def llm_call_long(prompt_template, human_template, query, model='gpt-4-1106-prev
     """
     return llm_call(prompt_template, human_template, query, model=model)
 
-def llm_condense_string(
+async def allm_condense_chunks(
+        texts,
+        prompt_condense,
+        model='gpt-4',
+        max_concurrency=8,
+        prompt_condense_first=None,
+        human_template=CONDENSE_HUMAN_TEMPLATE
+        ):
+    """Condenses each string in texts, with up to max_concurrency LLM calls at once.
+    Returns the outputs and the prompts in the same order as texts.
+    """
+    async def condense(count, text):
+        # The first chunk may get its own prompt, e.g. to keep the header of a legal opinion.
+        prompt_template = prompt_condense
+        if count == 1 and prompt_condense_first is not None:
+            prompt_template = prompt_condense_first
+        output, total_tokens, model_used, chat_prompt_str = await allm_call(
+            prompt_template,
+            human_template,
+            text,
+            model=model
+        )
+        logger.debug("llm_condense_string: String %s of %s condensed.", count, len(texts))
+        return output["text"], chat_prompt_str
+
+    results = await _gather_in_order(condense, texts, max_concurrency)
+    return [text for text, _ in results], [prompt for _, prompt in results]
+
+async def allm_condense_string(
         string,
         prompt_condense,
         model='gpt-4',
         chunk_size=6000,
-        chunk_overlap=200
+        chunk_overlap=200,
+        max_concurrency=8,
+        prompt_condense_first=None,
+        human_template=CONDENSE_HUMAN_TEMPLATE,
+        separator="\n"
         ):
     """Condenses the length of a string.
     The string is broken up into a list of token-sized strings. An LLM is called to 
     condense each string in the list. The strings are then recombined as one string.
     """
-    string_condensed = ""
-    prompt_lst = []
     # Split up strings into token-sized list
     texts = string_to_token_list(string, chunk_size, chunk_overlap)
     logger.debug("llm_condense_string: Number of strings to condense: %s", len(texts))
-    # Have LLM condense each string in the list. Then add each output to query_condensed.
-    prompt_template = prompt_condense
-    # Note that human template must containt {query} or LLMChain will error out.
-    human_template = textwrap.dedent(
-    """Please write a shorter version of this. 
-    {query}
-    """
+    # Have LLM condense the strings concurrently. Then recombine the outputs in order.
+    outputs, prompt_lst = await allm_condense_chunks(
+        texts,
+        prompt_condense,
+        model=model,
+        max_concurrency=max_concurrency,
+        prompt_condense_first=prompt_condense_first,
+        human_template=human_template
     )
-    count = 1
-    for text in texts:
-        output, total_tokens, model, chat_prompt_str = llm_call(
-            prompt_template,
-            human_template,
-            text,
-            model=model
-        )
-        # Add the output to the string_condensed.
-        string_condensed += output["text"]+"\n"
-        # Add the prompt to a list of prompts used in this function.
-        prompt_lst.append(chat_prompt_str)
-        logger.debug("llm_condense_string: String %s of %s condensed.", count, len(texts))
-        # Sleep for tokens used.
-        sleep_for_tokens(total_tokens, model)
-        count += 1
+    string_condensed = "".join(output + separator for output in outputs)
     return (string_condensed, prompt_lst)
 
-def llm_condense_string_long(
+async def allm_condense_tree(
+        string,
+        prompt_condense,
+        max_tokens,
+        model='gpt-4',
+        chunk_size=6000,
+        chunk_overlap=200,
+        max_rounds=3,
+        max_concurrency=8,
+        prompt_condense_first=None,
+        human_template=CONDENSE_HUMAN_TEMPLATE,
+        separator="\n"
+        ):
+    """Condenses a string in rounds until it is at most max_tokens long.
+    The first round condenses token-sized chunks of the string. Each later round packs
+    neighbouring outputs of the round before into token-sized chunks and condenses those, so
+    the chunks are reduced like a tree and no output is cut in half.
+    """
+    prompt_lst = []
+    tokens = num_tokens(string, model=model)
+    texts = string_to_token_list(string, chunk_size, chunk_overlap)
+    rounds = 0
+    while tokens > max_tokens and rounds < max_rounds and texts:
+        logger.debug(
+            "llm_condense_tree: Round %s/%s. Condensing %s strings.",
+            rounds+1,
+            max_rounds,
+            len(texts)
+        )
+        outputs, prompts = await allm_condense_chunks(
+            texts,
+            prompt_condense,
+            model=model,
+            max_concurrency=max_concurrency,
+            prompt_condense_first=prompt_condense_first,
+            human_template=human_template
+        )
+        prompt_lst.extend(prompts)
+        rounds += 1
+        string = "".join(output + separator for output in outputs)
+        previous_tokens, tokens = tokens, num_tokens(string, model=model)
+        if tokens >= previous_tokens:
+            logger.warning("llm_condense_tree: Condensing did not shorten the input. Stopping.")
+            break
+        # Merge neighbouring outputs into token-sized chunks for the next round.
+        texts = list_to_token_list(outputs, chunk_size)
+    return (string, prompt_lst)
+
+def llm_condense_string(
+        string,
+        prompt_condense,
+        model='gpt-4',
+        chunk_size=6000,
+        chunk_overlap=200,
+        max_concurrency=8,
+        prompt_condense_first=None,
+        human_template=CONDENSE_HUMAN_TEMPLATE,
+        separator="\n"
+        ):
+    """Condenses the length of a string.
+    The string is broken up into a list of token-sized strings. An LLM is called to 
+    condense each string in the list. The strings are then recombined as one string.
+    """
+    return run_sync(allm_condense_string(
+        string,
+        prompt_condense,
+        model=model,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        max_concurrency=max_concurrency,
+        prompt_condense_first=prompt_condense_first,
+        human_template=human_template,
+        separator=separator
+    ))
+
+def llm_condense_tree(
+        string,
+        prompt_condense,
+        max_tokens,
+        model='gpt-4',
+        chunk_size=6000,
+        chunk_overlap=200,
+        max_rounds=3,
+        max_concurrency=8,
+        prompt_condense_first=None,
+        human_template=CONDENSE_HUMAN_TEMPLATE,
+        separator="\n"
+        ):
+    """Condenses a string in rounds, reducing its chunks like a tree, until it is at most
+    max_tokens long.
+    """
+    return run_sync(allm_condense_tree(
+        string,
+        prompt_condense,
+        max_tokens,
+        model=model,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        max_rounds=max_rounds,
+        max_concurrency=max_concurrency,
+        prompt_condense_first=prompt_condense_first,
+        human_template=human_template,
+        separator=separator
+    ))
+
+async def allm_condense_string_long(
         string,
         prompt_condense,
         settings=LLMSettings,
     ):
-    """Condenses the input of an LLM query using longer LLM."""
-    return llm_condense_string(
+    """Async counterpart of llm_condense_string_long."""
+    return await allm_condense_string(
         string,
         prompt_condense,
         model=settings.model_long,
         chunk_size=settings.chunk_size_long,
-        chunk_overlap=settings.chunk_overlap
+        chunk_overlap=settings.chunk_overlap,
+        max_concurrency=settings.max_concurrency
         )
 
-def llm_router(
+def llm_condense_string_long(
+        string,
+        prompt_condense,
+        settings=LLMSettings,
+    ):
+    """Condenses the input of an LLM query using longer LLM."""
+    return run_sync(allm_condense_string_long(string, prompt_condense, settings=settings))
+
+async def allm_router(
         prompt_template,
         human_template,
         query,
         prompt_condense,
         settings=LLMSettings
     ):
-    """Depending on number of tokens of the input, runs different llm call functions. 
-    This is the default function for calling a large language model. The token length of 
-    the input does not need to be calculated in advance. This function can handle inputs
-    of any length.
-    Long inputs will be split into parts that an LLM can process. Each part will be condensed
-    and then the parts will be recombined. The recombined text will then be processed by either 
-    llm_call or llm_call_long.
-    If the recombined text is still too long, the recombined text will be condensed and recombined
-    up to two more times.
-    Shorter inputs will be processed by either llm_call or llm_call_long, depending on 
-    token length.
-    """
+    """Async counterpart of llm_router."""
     prompt_lst = []
-    total_tokens = num_tokens(prompt_template + human_template + query)
+    total_tokens = num_tokens(prompt_template + human_template + query, model=settings.model_long)
     attempts = 0
+    if settings.condense_tree and total_tokens > settings.max_tokens_long:
+        query, prompt = await allm_condense_tree(
+            query,
+            prompt_condense,
+            settings.max_tokens_long - num_tokens(prompt_template + human_template,
+                                                   model=settings.model_long),
+            model=settings.model_long,
+            chunk_size=settings.chunk_size_long,
+            chunk_overlap=settings.chunk_overlap,
+            max_rounds=settings.max_attempts,
+            max_concurrency=settings.max_concurrency
+        )
+        total_tokens = num_tokens(prompt_template + human_template + query,
+                                  model=settings.model_long)
+        prompt_lst.extend(prompt)
+        attempts = settings.max_attempts
     while total_tokens > settings.max_tokens_long and attempts < settings.max_attempts:
         logger.debug(
             "llm_router: Input is too long. Condensing... (Attempt %s/%s)", 
             attempts+1,
             settings.max_attempts
         )
-        query, prompt = llm_condense_string_long(
+        query, prompt = await allm_condense_string_long(
             string=query,
             prompt_condense=prompt_condense,
             settings=settings
         )
-        total_tokens = num_tokens(prompt_template + human_template + query)
+        total_tokens = num_tokens(prompt_template + human_template + query,
+                                  model=settings.model_long)
         prompt_lst.extend(prompt)
         attempts += 1
-    if total_tokens < settings.max_tokens:
+    # The models can use different tokenizers, so the input is counted again for the shorter
+    # model's limit.
+    short_tokens = num_tokens(prompt_template + human_template + query, model=settings.model)
+    if short_tokens < settings.max_tokens:
         logger.debug("llm_router: Input is short enough for GPT4. Processing...")
-        output, total_tokens, model, chat_prompt_str = llm_call(
+        output, total_tokens, model, chat_prompt_str = await allm_call(
             prompt_template,
             human_template,
             query,
@@ -570,7 +1364,7 @@ def llm_router(
         )
     elif total_tokens < settings.max_tokens_long:
         logger.debug("llm_router: Input is short enough for GPT3.5-turbo-1106. Processing...")
-        output, total_tokens, model, chat_prompt_str = llm_call_long(
+        output, total_tokens, model, chat_prompt_str = await allm_call_long(
             prompt_template,
             human_template,
             query,
@@ -583,43 +1377,80 @@ def llm_router(
     prompt_lst.append(chat_prompt_str)
     return (output, total_tokens, model, prompt_lst)
 
-def llm_router_gpt4(
+def llm_router(
         prompt_template,
         human_template,
         query,
         prompt_condense,
         settings=LLMSettings
     ):
-    """Depending on number of tokens of the input, runs either llm_call or llm_condense.
-    This is designed to be the main function for calling GPT4 exclusively,
-    because the token length of the input does not need to be calculated in advance.
-    If the input is within GPT4's token limit, it will be processed by llm_call.
-    Else it will be condensed by llm_condense (until it is short enough) and then 
-    processed by llm_call.
+    """Depending on number of tokens of the input, runs different llm call functions. 
+    This is the default function for calling a large language model. The token length of 
+    the input does not need to be calculated in advance. This function can handle inputs
+    of any length.
+    Long inputs will be split into parts that an LLM can process. Each part will be condensed
+    and then the parts will be recombined. The recombined text will then be processed by either 
+    llm_call or llm_call_long.
+    If the recombined text is still too long, the recombined text will be condensed and recombined
+    up to two more times.
+    Shorter inputs will be processed by either llm_call or llm_call_long, depending on 
+    token length.
     """
+    return run_sync(allm_router(
+        prompt_template,
+        human_template,
+        query,
+        prompt_condense,
+        settings=settings
+    ))
+
+async def allm_router_gpt4(
+        prompt_template,
+        human_template,
+        query,
+        prompt_condense,
+        settings=LLMSettings
+    ):
+    """Async counterpart of llm_router_gpt4."""
     prompt_lst = []
-    total_tokens = num_tokens(prompt_template + human_template + query)
+    total_tokens = num_tokens(prompt_template + human_template + query, model=settings.model)
 
     attempts = 0
+    if settings.condense_tree and total_tokens > settings.max_tokens:
+        query, prompt = await allm_condense_tree(
+            query,
+            prompt_condense,
+            settings.max_tokens - num_tokens(prompt_template + human_template,
+                                              model=settings.model),
+            model=settings.model,
+            chunk_size=settings.chunk_size,
+            chunk_overlap=settings.chunk_overlap,
+            max_rounds=settings.max_attempts,
+            max_concurrency=settings.max_concurrency
+        )
+        total_tokens = num_tokens(prompt_template + human_template + query, model=settings.model)
+        prompt_lst.extend(prompt)
+        attempts = settings.max_attempts
     while total_tokens > settings.max_tokens and attempts < settings.max_attempts:
         logger.debug(
             "llm_router_gpt4: Input is too long. Condensing... (Attempt %s/%s)", 
             attempts+1,
             settings.max_attempts
         )
-        query, prompt = llm_condense_string(
+        query, prompt = await allm_condense_string(
             query,
             prompt_condense,
             model=settings.model,
             chunk_size=settings.chunk_size,
-            chunk_overlap=settings.chunk_overlap
+            chunk_overlap=settings.chunk_overlap,
+            max_concurrency=settings.max_concurrency
         )
-        total_tokens = num_tokens(prompt_template + human_template + query)
+        total_tokens = num_tokens(prompt_template + human_template + query, model=settings.model)
         prompt_lst.extend(prompt)
         attempts += 1
     if total_tokens <= settings.max_tokens:
         logger.debug("llm_router_gpt4: Input is short enough for GPT4. Processing...")
-        output, total_tokens, model, chat_prompt_str = llm_call(
+        output, total_tokens, model, chat_prompt_str = await allm_call(
             prompt_template,
             human_template,
             query,
@@ -630,54 +1461,108 @@ def llm_router_gpt4(
     else:
         raise ValueError(f"After {settings.max_attempts} attempts, the input is still too long.")
 
-def llm_loop(
+def llm_router_gpt4(
+        prompt_template,
+        human_template,
+        query,
+        prompt_condense,
+        settings=LLMSettings
+    ):
+    """Depending on number of tokens of the input, runs either llm_call or llm_condense.
+    This is designed to be the main function for calling GPT4 exclusively,
+    because the token length of the input does not need to be calculated in advance.
+    If the input is within GPT4's token limit, it will be processed by llm_call.
+    Else it will be condensed by llm_condense (until it is short enough) and then 
+    processed by llm_call.
+    """
+    return run_sync(allm_router_gpt4(
+        prompt_template,
+        human_template,
+        query,
+        prompt_condense,
+        settings=settings
+    ))
+
+async def allm_loop(
         prompt_template,
         human_template,
         lst,
         prompt_condense,
         settings=LLMSettings
     ):
-    """Loops through list, calling llm_router on each item and sleeping for tokens."""
-    output_lst = []
-    prompt_lst = []
-    count = 1
-    for item in lst:
+    """Calls allm_router on each item in list, with up to settings.max_concurrency calls
+    in flight. Outputs and prompts are returned in the order of the list.
+    """
+    async def process(count, item):
         logger.debug("llm_loop: Processing item %s of %s", count, len(lst))
-        output, total_tokens, model, prompt = llm_router(
+        output, total_tokens, model, prompt = await allm_router(
             prompt_template,
             human_template,
             item,
             prompt_condense,
             settings=settings
         )
-        output_lst.append(output["text"])
-        prompt_lst.extend(prompt)
-        count += 1
-        sleep_for_tokens(total_tokens, model)
+        return output["text"], prompt
+
+    results = await _gather_in_order(process, lst, settings.max_concurrency)
+    output_lst = [output for output, _ in results]
+    prompt_lst = [prompt for _, prompts in results for prompt in prompts]
     return output_lst, prompt_lst
 
-def llm_loop_gpt4(
+def llm_loop(
         prompt_template,
         human_template,
         lst,
         prompt_condense,
         settings=LLMSettings
     ):
-    """Loops through list, calling llm_router_GPT4 on each item and sleeping for tokens."""
-    output_list = []
-    prompt_lst = []
-    count = 1
-    for item in lst:
+    """Loops through list, calling llm_router on each item."""
+    return run_sync(allm_loop(
+        prompt_template,
+        human_template,
+        lst,
+        prompt_condense,
+        settings=settings
+    ))
+
+async def allm_loop_gpt4(
+        prompt_template,
+        human_template,
+        lst,
+        prompt_condense,
+        settings=LLMSettings
+    ):
+    """Calls allm_router_gpt4 on each item in list, with up to settings.max_concurrency calls
+    in flight. Outputs and prompts are returned in the order of the list.
+    """
+    async def process(count, item):
         logger.debug("llm_loop_gpt4: Processing item %s of %s", count, len(lst))
-        output, total_tokens, model, prompt = llm_router_gpt4(
+        output, total_tokens, model, prompt = await allm_router_gpt4(
             prompt_template,
             human_template,
             item,
             prompt_condense,
             settings=settings
         )
-        output_list.append(output["text"])
-        prompt_lst.extend(prompt)
-        count += 1
-        sleep_for_tokens(total_tokens, model)
+        return output["text"], prompt
+
+    results = await _gather_in_order(process, lst, settings.max_concurrency)
+    output_list = [output for output, _ in results]
+    prompt_lst = [prompt for _, prompts in results for prompt in prompts]
     return output_list, prompt_lst
+
+def llm_loop_gpt4(
+        prompt_template,
+        human_template,
+        lst,
+        prompt_condense,
+        settings=LLMSettings
+    ):
+    """Loops through list, calling llm_router_GPT4 on each item."""
+    return run_sync(allm_loop_gpt4(
+        prompt_template,
+        human_template,
+        lst,
+        prompt_condense,
+        settings=settings
+    ))
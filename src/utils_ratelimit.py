@@ -0,0 +1,196 @@
+"""
+Rate limiting for calls to LLM APIs.
+
+Every call to an LLM reserves quota from a shared RateLimiter for its model before the request
+is sent, and reconciles the reservation against the usage reported in the response afterwards.
+Each RateLimiter holds two token buckets: one for tokens per minute and one for requests per
+minute. The limiters are shared by every thread and every asyncio task in the process.
+
+Classes
+
+TokenBucket(capacity: float)
+    A bucket that holds up to `capacity` units and refills continuously over one minute.
+
+Reservation(tokens: int, model: str)
+    Quota reserved for one LLM call.
+
+RateLimiter(model: str, tokens_per_minute: int, requests_per_minute: int)
+    Token and request buckets for one model.
+    acquire(tokens: int) -> Reservation
+        Blocks the calling thread until the quota is available, then reserves it.
+    aacquire(tokens: int) -> Reservation
+        Async counterpart of acquire. Awaits instead of blocking the event loop.
+    reconcile(reservation: Reservation, actual_tokens: int) -> None
+        Charges or refunds the difference between the reserved and the actual tokens.
+    pause(seconds: float) -> None
+        Stops every caller of this limiter from starting a new call for `seconds`.
+
+Functions
+
+get_rate_limiter(model: str) -> RateLimiter
+    Returns the shared RateLimiter for a model, creating it on first use.
+
+set_rate_limit(model: str, tokens_per_minute: int = None, requests_per_minute: int = None) -> None
+    Sets the limits for a model. Limits for models without an entry in RATE_LIMITS fall back to
+    DEFAULT_RATE_LIMIT.
+"""
+import asyncio
+import logging
+import threading
+import time
+from dataclasses import dataclass
+
+# Set up logger
+logger = logging.getLogger('restatement')
+
+# Tokens per minute and requests per minute for each model under my account.
+RATE_LIMITS = {
+    'gpt-3.5-turbo-1106': (300000, 3500),
+    'gpt-4': (300000, 500),
+    'gpt-4-1106-preview': (300000, 500),
+}
+# Limits for models that are not listed in RATE_LIMITS.
+DEFAULT_RATE_LIMIT = (300000, 500)
+
+# Shared limiters, one per model.
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class TokenBucket:
+    """A bucket that holds up to capacity units and refills continuously over one minute.
+    The level may go below zero when a call uses more tokens than it reserved. The debt is
+    paid back by the refill before anyone else can take from the bucket.
+    """
+
+    def __init__(self, capacity):
+        # Maximum number of units in the bucket
+        self.capacity = float(capacity)
+        # Units added per second
+        self.rate = self.capacity / 60
+        # Current number of units in the bucket
+        self.level = self.capacity
+        # Time of the last refill
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        """Adds the units that have accrued since the last refill."""
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Returns the seconds until amount units are available.
+        Amounts larger than the capacity only wait for a full bucket.
+        """
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount):
+        """Removes units from the bucket."""
+        self.level -= amount
+
+    def give(self, amount):
+        """Returns units to the bucket."""
+        self.level = min(self.capacity, self.level + amount)
+
+
+@dataclass
+class Reservation:
+    """Quota reserved for one LLM call."""
+    # Tokens reserved for the call
+    tokens: int
+    # Model the tokens were reserved for
+    model: str
+
+
+class RateLimiter:
+    """Token and request buckets for one model.
+    All state is guarded by a threading lock, so one limiter can be shared by threads and by
+    asyncio tasks running on any event loop.
+    """
+
+    def __init__(self, model, tokens_per_minute, requests_per_minute):
+        self.model = model
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.requests = TokenBucket(requests_per_minute)
+        # No caller may start a call before this time (set by pause)
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _try_reserve(self, tokens):
+        """Reserves the quota if it is available. Otherwise returns the seconds to wait."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens.refill(now)
+            self.requests.refill(now)
+            wait = max(
+                self.paused_until - now,
+                self.tokens.wait_time(tokens),
+                self.requests.wait_time(1)
+            )
+            if wait > 0:
+                return wait
+            self.tokens.take(tokens)
+            self.requests.take(1)
+            return 0.0
+
+    def acquire(self, tokens):
+        """Blocks until the quota is available, then reserves it."""
+        while True:
+            wait = self._try_reserve(tokens)
+            if wait <= 0:
+                return Reservation(tokens=tokens, model=self.model)
+            logger.debug("RateLimiter: Waiting %.2f seconds for %s quota.", wait, self.model)
+            time.sleep(wait)
+
+    async def aacquire(self, tokens):
+        """Async counterpart of acquire."""
+        while True:
+            wait = self._try_reserve(tokens)
+            if wait <= 0:
+                return Reservation(tokens=tokens, model=self.model)
+            logger.debug("RateLimiter: Waiting %.2f seconds for %s quota.", wait, self.model)
+            await asyncio.sleep(wait)
+
+    def reconcile(self, reservation, actual_tokens):
+        """Charges or refunds the difference between reserved and actual tokens."""
+        with self._lock:
+            self.tokens.refill(time.monotonic())
+            difference = actual_tokens - reservation.tokens
+            if difference > 0:
+                self.tokens.take(difference)
+            else:
+                self.tokens.give(-difference)
+
+    def pause(self, seconds):
+        """Stops every caller of this limiter from starting a new call for seconds."""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def tokens_per_second(self):
+        """Returns the rate at which token quota refills."""
+        return self.tokens.rate
+
+
+def get_rate_limiter(model):
+    """Returns the shared RateLimiter for a model, creating it on first use."""
+    with _limiters_lock:
+        limiter = _limiters.get(model)
+        if limiter is None:
+            tokens_per_minute, requests_per_minute = RATE_LIMITS.get(model, DEFAULT_RATE_LIMIT)
+            limiter = RateLimiter(model, tokens_per_minute, requests_per_minute)
+            _limiters[model] = limiter
+        return limiter
+
+
+def set_rate_limit(model, tokens_per_minute=None, requests_per_minute=None):
+    """Sets the limits for a model and resets its shared limiter."""
+    current_tokens, current_requests = RATE_LIMITS.get(model, DEFAULT_RATE_LIMIT)
+    RATE_LIMITS[model] = (
+        tokens_per_minute if tokens_per_minute is not None else current_tokens,
+        requests_per_minute if requests_per_minute is not None else current_requests
+    )
+    with _limiters_lock:
+        _limiters.pop(model, None)
@@ -0,0 +1,123 @@
+"""
+Token-budgeted retrieval of briefs for the 'restatement' project.
+
+Comment, Illustration and Reporter each fill the rest of a prompt with the briefs most similar
+to a heading or part. TokenBudgetRetriever does this with one search: it fetches the top k
+briefs with their scores, counts their tokens in one batch, and keeps them in rank order as
+long as they fit in the token budget. A brief that does not fit is skipped and the next one is
+tried, so a long brief does not crowd out shorter ones ranked below it.
+
+Classes
+
+Retrieval
+    The result of a retrieval.
+    documents (List[Document]): The chosen documents, in rank order.
+    scores (List[float]): The score the vector store gave each chosen document.
+    tokens (List[int]): The tokens in each chosen document.
+    used_tokens (int): The tokens in text.
+    budget (int): The token budget.
+    candidates (int): The number of documents fetched.
+    text (str): The chosen documents joined by the separator.
+
+TokenBudgetRetriever(db: VectorStore, separator: str = "\\n \\n", ignore_errors: bool = False)
+    Retrieves documents from a vector store within a token budget.
+    retrieve(query: str, k: int, budget: int) -> Retrieval
+        Returns up to k of the documents most similar to the query whose text fits in budget
+        tokens. If the store holds fewer than k documents, the ones it holds are searched. Other
+        search errors (e.g. authentication, network or embedding errors) are raised, unless
+        ignore_errors is set, in which case they are logged and the Retrieval is empty.
+
+Functions
+
+token_budget(max_tokens: int, *parts: str) -> int
+    Returns the tokens left of max_tokens after the parts of a prompt.
+"""
+import logging
+from dataclasses import dataclass, field
+
+from src.utils_tokens import get_token_counter
+
+# Set up logger
+logger = logging.getLogger('restatement')
+
+
+def token_budget(max_tokens, *parts):
+    """Return the tokens left of max_tokens after the parts of a prompt."""
+    return max_tokens - sum(get_token_counter().count_many(list(parts)))
+
+
+@dataclass
+class Retrieval:
+    """The documents chosen by a retrieval and their token usage."""
+    documents: list = field(default_factory=list)
+    scores: list = field(default_factory=list)
+    tokens: list = field(default_factory=list)
+    used_tokens: int = 0
+    budget: int = 0
+    candidates: int = 0
+    text: str = ""
+
+
+class TokenBudgetRetriever:
+    """Retrieves documents from a vector store within a token budget.
+    """
+
+    def __init__(self, db, separator="\n \n", ignore_errors=False):
+        self.db = db
+        self.separator = separator
+        self.ignore_errors = ignore_errors
+
+    def _search(self, query, k):
+        """Return the top k documents and their scores.
+        Some versions of Chroma raise instead of returning fewer results when the store holds
+        fewer than k documents, so k is lowered until the search fits.
+        """
+        while True:
+            try:
+                if hasattr(self.db, "similarity_search_with_score"):
+                    return self.db.similarity_search_with_score(query, k=k)
+                return [(doc, None) for doc in self.db.similarity_search(query, k=k)]
+            except Exception as e:
+                if k <= 1 or type(e).__name__ != "NotEnoughElementsException":
+                    raise
+                k -= 1
+
+    def retrieve(self, query, k, budget):
+        """Return up to k of the documents most similar to the query that fit in budget tokens.
+        """
+        try:
+            results = self._search(query, k)
+        except Exception as e:
+            if not self.ignore_errors:
+                raise
+            logger.warning("TokenBudgetRetriever: Search failed: %s", e)
+            results = []
+        retrieval = Retrieval(budget=budget, candidates=len(results))
+        if not results or budget <= 0:
+            return retrieval
+        counter = get_token_counter()
+        counts = counter.count_many([doc.page_content for doc, _ in results])
+        separator_tokens = counter.count(self.separator)
+        used = 0
+        for (doc, score), tokens in zip(results, counts):
+            cost = tokens + (separator_tokens if retrieval.documents else 0)
+            if used + cost > budget:
+                # Skip a document that does not fit, but try the ones ranked below it.
+                continue
+            retrieval.documents.append(doc)
+            retrieval.scores.append(score)
+            retrieval.tokens.append(tokens)
+            used += cost
+        # Tokens can merge across the separator, so check the joined text and drop the last
+        # documents if it came out over the budget.
+        retrieval.text = self.separator.join(doc.page_content for doc in retrieval.documents)
+        retrieval.used_tokens = counter.count(retrieval.text)
+        while retrieval.documents and retrieval.used_tokens > budget:
+            for values in (retrieval.documents, retrieval.scores, retrieval.tokens):
+                values.pop()
+            retrieval.text = self.separator.join(doc.page_content for doc in retrieval.documents)
+            retrieval.used_tokens = counter.count(retrieval.text)
+        logger.debug("TokenBudgetRetriever: Chose %s of %s documents, %s of %s tokens.",
+                     len(retrieval.documents), retrieval.candidates, retrieval.used_tokens,
+                     budget)
+        return retrieval
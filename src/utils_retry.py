@@ -0,0 +1,149 @@
+"""
+Retry policy for calls to LLM APIs.
+
+Errors are classified as retryable (rate limits, timeouts, connection errors, server errors) or
+fatal (bad requests, authentication, missing models). Retryable errors are retried with
+exponential backoff and jitter, up to a maximum number of attempts. A Retry-After header on the
+error overrides the backoff.
+
+Classes
+
+RetryPolicy(max_attempts: int = 6, base_delay: float = 1.0, max_delay: float = 60.0, jitter: float = 0.5)
+    Settings for retrying failed LLM calls.
+    delay(attempt: int, retry_after: float = None) -> float
+        Returns the seconds to wait before the next attempt.
+
+Functions
+
+is_retryable(error: Exception) -> bool
+    Returns True if the call that raised error may succeed when retried.
+
+is_rate_limit(error: Exception) -> bool
+    Returns True if error reports that the rate limit was reached.
+
+get_retry_after(error: Exception) -> float or None
+    Returns the delay requested by the Retry-After header of the error's response, if any.
+
+set_retry_policy(policy: RetryPolicy) -> None
+    Sets the policy used by every LLM call in the process.
+
+get_retry_policy() -> RetryPolicy
+    Returns the policy used by LLM calls.
+"""
+import logging
+import random
+import time
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+
+# Set up logger
+logger = logging.getLogger('restatement')
+
+# HTTP status codes worth retrying.
+RETRYABLE_STATUS_CODES = frozenset((408, 409, 429, 500, 502, 503, 504))
+# Exception class names (from openai, httpx and the standard library) worth retrying.
+RETRYABLE_ERROR_NAMES = frozenset((
+    'RateLimitError',
+    'APITimeoutError',
+    'APIConnectionError',
+    'InternalServerError',
+    'ServiceUnavailableError',
+    'Timeout',
+    'TimeoutError',
+    'TimeoutException',
+    'ConnectError',
+    'ConnectionError',
+    'ReadError',
+    'RemoteProtocolError',
+))
+
+
+@dataclass
+class RetryPolicy:
+    """Settings for retrying failed LLM calls."""
+    # Maximum number of attempts per call, including the first
+    max_attempts: int = 6
+    # Delay before the second attempt, doubled for each attempt after that
+    base_delay: float = 1.0
+    # Upper bound on any single delay
+    max_delay: float = 60.0
+    # Fraction of each delay that is randomized, so that callers do not retry in lockstep
+    jitter: float = 0.5
+
+    def delay(self, attempt, retry_after=None):
+        """Returns the seconds to wait after a failed attempt (counting from 1)."""
+        if retry_after is not None:
+            return min(self.max_delay, max(0.0, retry_after))
+        backoff = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return backoff * (1 - self.jitter) + random.uniform(0, backoff * self.jitter)
+
+
+# Policy used by every LLM call in the process (set by set_retry_policy).
+_retry_policy = RetryPolicy()
+
+
+def _status_code(error):
+    """Returns the HTTP status code attached to error, if any."""
+    status = getattr(error, 'status_code', None) or getattr(error, 'http_status', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status
+
+
+def is_rate_limit(error):
+    """Returns True if error reports that the rate limit was reached."""
+    return (
+        _status_code(error) == 429
+        or type(error).__name__ == 'RateLimitError'
+        or "rate limit" in str(error).lower()
+    )
+
+
+def is_retryable(error):
+    """Returns True if the call that raised error may succeed when retried.
+    Errors that are not recognized are treated as fatal.
+    """
+    if is_rate_limit(error):
+        return True
+    status = _status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES
+    return any(cls.__name__ in RETRYABLE_ERROR_NAMES for cls in type(error).__mro__)
+
+
+def get_retry_after(error):
+    """Returns the delay in seconds requested by the Retry-After header, if any."""
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if headers is None:
+        headers = getattr(error, 'headers', None)
+    if not headers:
+        return None
+    value = headers.get('retry-after-ms')
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return parsedate_to_datetime(value).timestamp() - time.time()
+    except (TypeError, ValueError):
+        logger.debug("get_retry_after: Could not parse Retry-After header: %s", value)
+        return None
+
+
+def set_retry_policy(policy):
+    """Sets the policy used by every LLM call in the process."""
+    global _retry_policy
+    _retry_policy = policy
+
+
+def get_retry_policy():
+    """Returns the policy used by LLM calls."""
+    return _retry_policy
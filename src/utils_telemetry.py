@@ -0,0 +1,415 @@
+"""
+Telemetry for LLM calls in the 'restatement' project.
+
+Every LLM call records an LLMCallEvent with the stage and method that made the call, the model,
+the estimated and reported tokens, the latency, the time to the first token, the time spent
+waiting on the rate limiter and the number of retries. Events go to every sink added with
+add_telemetry_sink. When no sink is added, nothing is recorded.
+
+The stage and method are taken from the first frame outside the LLM utilities that has a `self`,
+e.g. stage "Resolve" and method "get_authority". telemetry_stage overrides the stage for the
+calls made inside it.
+
+Classes
+
+LLMCallEvent
+    One LLM call. See the field comments for units.
+
+CallTimer()
+    Times the phases of one LLM call.
+
+TelemetrySink()
+    Base class for sinks.
+    record(event: LLMCallEvent) -> None
+
+JSONLSink(path: str)
+    Appends each event as one JSON line to a file.
+
+MemorySink(keep_events: bool = True)
+    Keeps events in memory and aggregates them by stage, method and model.
+    summary() -> List[dict]
+        Returns calls, errors, cache hits, retries, tokens and latencies per group.
+
+PrometheusSink()
+    Aggregates events into counters and histograms.
+    render() -> str
+        Returns the metrics in the Prometheus text exposition format.
+    write(path: str) -> None
+        Writes the metrics to a file, e.g. for the node exporter's textfile collector.
+
+Functions
+
+add_telemetry_sink(sink: TelemetrySink) -> None
+    Adds a sink that receives every event.
+
+remove_telemetry_sink(sink: TelemetrySink) -> None
+    Removes a sink.
+
+telemetry_enabled() -> bool
+    Returns True if any sink is added.
+
+telemetry_stage(stage: str) -> ContextManager
+    Attributes the calls made inside the block to stage.
+
+bind_call_site() -> ContextManager
+    Records the stage and method of the caller for the calls made inside the block. Used by
+    run_sync so that calls on the background event loop know where they came from.
+
+get_call_site() -> Tuple[str, str]
+    Returns the stage and method of the current call.
+
+record_llm_call(event: LLMCallEvent) -> None
+    Sends an event to every sink.
+"""
+import abc
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass
+
+# Set up logger
+logger = logging.getLogger('restatement')
+
+# Sinks that receive every event (set by add_telemetry_sink).
+_sinks = []
+_sinks_lock = threading.Lock()
+
+# Stage set by telemetry_stage, and (stage, method) bound by bind_call_site.
+_stage = contextvars.ContextVar('restatement_stage', default=None)
+_call_site = contextvars.ContextVar('restatement_call_site', default=None)
+
+# Modules whose frames are skipped when looking for the caller of an LLM call.
+_SKIPPED_MODULES = ('src.utils_', 'asyncio', 'concurrent', 'threading', 'contextlib')
+
+# Upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+
+
+@dataclass
+class LLMCallEvent:
+    """One LLM call."""
+    # Time the call finished (seconds since the epoch)
+    timestamp: float
+    # Stage (class) and method that made the call
+    stage: str
+    method: str
+    model: str
+    # Local count of the prompt tokens, made before the call
+    estimated_tokens: int
+    # Tokens reported by the API, or counted locally if usage_reported is False
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    total_tokens: int = 0
+    usage_reported: bool = False
+    # Seconds from the start of the call to its end, including waits and retries
+    duration_s: float = 0.0
+    # Seconds from sending the successful request to its response
+    latency_s: float = 0.0
+    # Seconds from sending the successful request to its first streamed token, if known
+    ttft_s: float = None
+    # Seconds spent waiting on the rate limiter, over all attempts
+    queue_wait_s: float = 0.0
+    # Number of failed attempts before the call succeeded or gave up
+    retries: int = 0
+    # Whether the response came from the LLM cache
+    cached: bool = False
+    # The error that ended the call, if it failed
+    error: str = None
+
+
+class CallTimer:
+    """Times the phases of one LLM call."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queue_wait = 0.0
+        self.attempt_started = self.started
+        self.first_token_at = None
+        self.finished = None
+
+    @contextlib.contextmanager
+    def queue(self):
+        """Times a wait on the rate limiter."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.queue_wait += time.perf_counter() - start
+
+    def start_attempt(self):
+        """Marks the moment a request is sent."""
+        self.attempt_started = time.perf_counter()
+        self.first_token_at = None
+
+    def first_token(self):
+        """Marks the arrival of the first token of the current attempt."""
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+
+    def finish(self):
+        """Marks the end of the call."""
+        self.finished = time.perf_counter()
+
+    def timings(self):
+        """Returns duration_s, latency_s, ttft_s and queue_wait_s for an LLMCallEvent."""
+        finished = self.finished if self.finished is not None else time.perf_counter()
+        ttft = None
+        if self.first_token_at is not None:
+            ttft = self.first_token_at - self.attempt_started
+        return {
+            'duration_s': finished - self.started,
+            'latency_s': finished - self.attempt_started,
+            'ttft_s': ttft,
+            'queue_wait_s': self.queue_wait
+        }
+
+
+class TelemetrySink(abc.ABC):
+    """Base class for sinks. A subclass without record cannot be instantiated."""
+
+    @abc.abstractmethod
+    def record(self, event):
+        """Receives one event."""
+
+
+class JSONLSink(TelemetrySink):
+    """Appends each event as one JSON line to a file."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+
+    def record(self, event):
+        line = json.dumps(asdict(event))
+        with self._lock:
+            with open(self.path, 'a', encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+class MemorySink(TelemetrySink):
+    """Keeps events in memory and aggregates them by stage, method and model."""
+
+    def __init__(self, keep_events=True):
+        self.keep_events = keep_events
+        self.events = []
+        self._groups = {}
+        self._lock = threading.Lock()
+
+    def record(self, event):
+        key = (event.stage, event.method, event.model)
+        with self._lock:
+            if self.keep_events:
+                self.events.append(event)
+            group = self._groups.setdefault(key, {
+                'stage': event.stage,
+                'method': event.method,
+                'model': event.model,
+                'calls': 0,
+                'errors': 0,
+                'cached': 0,
+                'retries': 0,
+                'estimated_tokens': 0,
+                'prompt_tokens': 0,
+                'completion_tokens': 0,
+                'duration_s': 0.0,
+                'latency_s': 0.0,
+                'max_latency_s': 0.0,
+                'ttft_s': 0.0,
+                'ttft_calls': 0,
+                'queue_wait_s': 0.0,
+            })
+            group['calls'] += 1
+            group['errors'] += event.error is not None
+            group['cached'] += event.cached
+            group['retries'] += event.retries
+            group['estimated_tokens'] += event.estimated_tokens
+            group['prompt_tokens'] += event.prompt_tokens
+            group['completion_tokens'] += event.completion_tokens
+            group['duration_s'] += event.duration_s
+            group['latency_s'] += event.latency_s
+            group['max_latency_s'] = max(group['max_latency_s'], event.latency_s)
+            if event.ttft_s is not None:
+                group['ttft_s'] += event.ttft_s
+                group['ttft_calls'] += 1
+            group['queue_wait_s'] += event.queue_wait_s
+
+    def summary(self):
+        """Returns one dict per (stage, method, model), with totals and mean latencies."""
+        with self._lock:
+            rows = []
+            for group in self._groups.values():
+                row = dict(group)
+                row['mean_latency_s'] = row['latency_s'] / row['calls']
+                row['mean_ttft_s'] = (
+                    row['ttft_s'] / row['ttft_calls'] if row['ttft_calls'] else None
+                )
+                rows.append(row)
+            return sorted(rows, key=lambda row: row['duration_s'], reverse=True)
+
+    def clear(self):
+        """Forgets every event."""
+        with self._lock:
+            self.events = []
+            self._groups = {}
+
+
+def _escape(value):
+    """Escapes a Prometheus label value."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class PrometheusSink(TelemetrySink):
+    """Aggregates events into counters and histograms in the Prometheus text format."""
+
+    def __init__(self, prefix='restatement_llm'):
+        self.prefix = prefix
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def _add(self, name, labels, value):
+        """Adds value to a counter. Called with the lock held."""
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def _observe(self, name, labels, value):
+        """Adds an observation to a histogram. Called with the lock held."""
+        key = (name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = [[0] * len(LATENCY_BUCKETS), 0, 0.0]
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += 1
+        histogram[2] += value
+
+    def record(self, event):
+        labels = (
+            ('stage', event.stage or ''),
+            ('method', event.method or ''),
+            ('model', event.model)
+        )
+        with self._lock:
+            self._add('calls_total', labels, 1)
+            self._add('errors_total', labels, event.error is not None)
+            self._add('cache_hits_total', labels, event.cached)
+            self._add('retries_total', labels, event.retries)
+            self._add('estimated_tokens_total', labels, event.estimated_tokens)
+            self._add('prompt_tokens_total', labels, event.prompt_tokens)
+            self._add('completion_tokens_total', labels, event.completion_tokens)
+            self._add('queue_wait_seconds_total', labels, event.queue_wait_s)
+            if not event.cached:
+                self._observe('latency_seconds', labels, event.latency_s)
+                if event.ttft_s is not None:
+                    self._observe('ttft_seconds', labels, event.ttft_s)
+
+    def render(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self._counters}):
+                metric = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {metric} counter")
+                for (counter, labels), value in sorted(self._counters.items()):
+                    if counter == name:
+                        label_str = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+                        lines.append(f"{metric}{{{label_str}}} {value}")
+            for name in sorted({name for name, _ in self._histograms}):
+                metric = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {metric} histogram")
+                for (histogram, labels), (buckets, count, total) in sorted(
+                    self._histograms.items()
+                ):
+                    if histogram != name:
+                        continue
+                    label_str = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+                    for bound, bucket in zip(LATENCY_BUCKETS, buckets):
+                        lines.append(f'{metric}_bucket{{{label_str},le="{bound}"}} {bucket}')
+                    lines.append(f'{metric}_bucket{{{label_str},le="+Inf"}} {count}')
+                    lines.append(f"{metric}_sum{{{label_str}}} {total}")
+                    lines.append(f"{metric}_count{{{label_str}}} {count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Writes the metrics to a file, replacing it atomically."""
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w', encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(temp_path, path)
+
+
+def add_telemetry_sink(sink):
+    """Adds a sink that receives every event."""
+    with _sinks_lock:
+        _sinks.append(sink)
+
+
+def remove_telemetry_sink(sink):
+    """Removes a sink."""
+    with _sinks_lock:
+        if sink in _sinks:
+            _sinks.remove(sink)
+
+
+def telemetry_enabled():
+    """Returns True if any sink is added."""
+    return bool(_sinks)
+
+
+@contextlib.contextmanager
+def telemetry_stage(stage):
+    """Attributes the calls made inside the block to stage."""
+    token = _stage.set(stage)
+    try:
+        yield
+    finally:
+        _stage.reset(token)
+
+
+def _find_caller(frame):
+    """Returns the (class, method) of the first frame outside the LLM utilities."""
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if not module.startswith(_SKIPPED_MODULES):
+            owner = frame.f_locals.get('self')
+            stage = type(owner).__name__ if owner is not None else module
+            return stage, frame.f_code.co_name
+        frame = frame.f_back
+    return None, None
+
+
+@contextlib.contextmanager
+def bind_call_site():
+    """Records the stage and method of the caller for the calls made inside the block."""
+    if not _sinks or _call_site.get() is not None:
+        yield
+        return
+    token = _call_site.set(_find_caller(sys._getframe(2)))
+    try:
+        yield
+    finally:
+        _call_site.reset(token)
+
+
+def get_call_site():
+    """Returns the stage and method of the current call."""
+    stage, method = _call_site.get() or _find_caller(sys._getframe(1))
+    return _stage.get() or stage, method
+
+
+def record_llm_call(event):
+    """Sends an event to every sink. Errors in sinks are logged, not raised."""
+    with _sinks_lock:
+        sinks = list(_sinks)
+    for sink in sinks:
+        try:
+            sink.record(event)
+        except Exception as e:
+            logger.warning("record_llm_call: %s failed to record event: %s", type(sink).__name__, e)
@@ -0,0 +1,170 @@
+"""
+Token counting for the 'restatement' project.
+
+Tokenizers are loaded once and shared. Counts are memoized in a bounded LRU keyed by a hash of
+the string, so the prompts, provisions and outlines that are counted again and again within a
+stage are only tokenized once. tiktoken itself is imported when the first tokenizer is loaded.
+
+Classes
+
+TokenCounter(encoding_name: str = "cl100k_base", max_entries: int = 65536)
+    Counts tokens with one tokenizer and memoizes the counts.
+    count(string: str) -> int
+        Returns the number of tokens in string.
+    count_many(strings: List[str], num_threads: int = 8) -> List[int]
+        Returns the number of tokens in each string. Strings that are not memoized are encoded
+        together with tiktoken's batch encoder across threads.
+    stats() -> dict
+        Returns hits, misses and the number of memoized counts.
+
+Functions
+
+get_encoding(encoding_name: str = "cl100k_base") -> tiktoken.Encoding
+    Returns the tokenizer with this name, loading it on first use.
+
+encoding_name_for_model(model: str) -> str
+    Returns the name of the tokenizer a model uses, or "cl100k_base" for unknown models.
+
+get_token_counter(encoding_name: str = "cl100k_base") -> TokenCounter
+    Returns the shared TokenCounter for a tokenizer.
+
+get_token_counter_for_model(model: str) -> TokenCounter
+    Returns the shared TokenCounter for the tokenizer a model uses.
+"""
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+# Set up logger
+logger = logging.getLogger('restatement')
+
+# Tokenizer used when none is specified.
+DEFAULT_ENCODING = "cl100k_base"
+
+# Loaded tokenizers and shared counters, keyed by tokenizer name.
+_encodings = {}
+_counters = {}
+_lock = threading.Lock()
+
+
+def _tiktoken():
+    """Returns the tiktoken module. It is imported on first use, because importing it loads
+    its native extension and registry of tokenizers.
+    """
+    import tiktoken
+    return tiktoken
+
+
+def get_encoding(encoding_name=DEFAULT_ENCODING):
+    """Returns the tokenizer with this name, loading it on first use."""
+    encoding = _encodings.get(encoding_name)
+    if encoding is None:
+        with _lock:
+            encoding = _encodings.get(encoding_name)
+            if encoding is None:
+                encoding = _tiktoken().get_encoding(encoding_name)
+                _encodings[encoding_name] = encoding
+    return encoding
+
+
+def encoding_name_for_model(model):
+    """Returns the name of the tokenizer a model uses, or the default for unknown models."""
+    try:
+        return _tiktoken().encoding_name_for_model(model)
+    except KeyError:
+        return DEFAULT_ENCODING
+
+
+class TokenCounter:
+    """Counts tokens with one tokenizer and memoizes the counts in a bounded LRU.
+    The LRU is keyed by a hash of the string rather than the string, so long opinions are not
+    kept alive by the memo.
+    """
+
+    def __init__(self, encoding_name=DEFAULT_ENCODING, max_entries=65536):
+        self.encoding_name = encoding_name
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def encoding(self):
+        """The tokenizer used by this counter."""
+        return get_encoding(self.encoding_name)
+
+    @staticmethod
+    def _key(string):
+        """Returns the memo key for a string."""
+        return hashlib.blake2b(
+            string.encode("utf-8", "surrogatepass"), digest_size=16
+        ).digest()
+
+    def _lookup(self, key):
+        """Returns the memoized count for key, or None. Called with the lock held."""
+        tokens = self._counts.get(key)
+        if tokens is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._counts.move_to_end(key)
+        return tokens
+
+    def _store(self, key, tokens):
+        """Memoizes a count, evicting the least recently used counts. Called with the lock held."""
+        self._counts[key] = tokens
+        self._counts.move_to_end(key)
+        while len(self._counts) > self.max_entries:
+            self._counts.popitem(last=False)
+
+    def count(self, string):
+        """Returns the number of tokens in string."""
+        key = self._key(string)
+        with self._lock:
+            tokens = self._lookup(key)
+        if tokens is not None:
+            return tokens
+        tokens = len(self.encoding.encode(string))
+        with self._lock:
+            self._store(key, tokens)
+        return tokens
+
+    def count_many(self, strings, num_threads=8):
+        """Returns the number of tokens in each string, in order."""
+        keys = [self._key(string) for string in strings]
+        counts = [None] * len(strings)
+        with self._lock:
+            for i, key in enumerate(keys):
+                counts[i] = self._lookup(key)
+        missing = [i for i, tokens in enumerate(counts) if tokens is None]
+        if missing:
+            encoded = self.encoding.encode_batch(
+                [strings[i] for i in missing],
+                num_threads=num_threads
+            )
+            with self._lock:
+                for i, tokens in zip(missing, encoded):
+                    counts[i] = len(tokens)
+                    self._store(keys[i], counts[i])
+        return counts
+
+    def stats(self):
+        """Returns hits, misses and the number of memoized counts."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._counts)}
+
+
+def get_token_counter(encoding_name=DEFAULT_ENCODING):
+    """Returns the shared TokenCounter for a tokenizer."""
+    counter = _counters.get(encoding_name)
+    if counter is None:
+        with _lock:
+            counter = _counters.setdefault(encoding_name, TokenCounter(encoding_name))
+    return counter
+
+
+def get_token_counter_for_model(model):
+    """Returns the shared TokenCounter for the tokenizer a model uses."""
+    return get_token_counter(encoding_name_for_model(model))
@@ -0,0 +1,276 @@
+"""
+In-process vector index for the 'restatement' project.
+
+A section's briefs_db holds a few thousand vectors at most, so exact search over a NumPy matrix
+is as fast as an approximate index and avoids Chroma's client stack. NumpyVectorIndex keeps the
+embeddings as rows of one contiguous float32 matrix, normalized so that cosine similarity is a
+matrix product, and answers queries with an exact top-k. It has the methods of the Chroma
+vector store that the stages use, so it can be used as briefs_db in its place (see
+llm_settings.vector_store).
+
+An index is saved as a directory with two files:
+
+- `vectors.npy`: the normalized embeddings. It is memory-mapped when the index is loaded.
+- `index.json`: the ids, texts and metadata of the rows.
+
+Searches read a snapshot of the index and take no lock, so any number of threads can search at
+once. add_texts and delete build a new snapshot and swap it in under a lock.
+
+list_to_db keeps a manifest next to each saved vector store (Chroma or NumpyVectorIndex) with the
+store, the embeddings and the id of each text, so a later run can tell which texts are already
+in the store and embed only the new ones.
+
+Classes
+
+Document(page_content: str, metadata: dict)
+    A search result. Has the page_content and metadata attributes of a langchain Document.
+
+NumpyVectorIndex(embedding: Embeddings, persist_directory: str = None)
+    An exact cosine similarity index over a float32 matrix.
+    from_texts(texts: List[str], embedding: Embeddings, metadatas: List[dict] = None,
+               ids: List[str] = None, persist_directory: str = None) -> NumpyVectorIndex
+        Class method. Embeds the texts and builds an index of them.
+    load(persist_directory: str, embedding: Embeddings, mmap: bool = True) -> NumpyVectorIndex
+        Class method. Loads a saved index. The matrix is memory-mapped unless mmap is False.
+    exists(persist_directory: str) -> bool
+        Static method. Returns whether an index is saved in the directory.
+    add_texts(texts: List[str], metadatas: List[dict] = None, ids: List[str] = None) -> List[str]
+        Embeds the texts and adds them to the index, replacing any rows with the same ids, as
+        Chroma does. Returns their ids.
+    delete(ids: List[str]) -> None
+        Removes the rows with these ids.
+    persist() -> None
+        Saves the index to its persist_directory.
+    similarity_search(query: str, k: int = 4) -> List[Document]
+        Returns the k texts most similar to the query.
+    similarity_search_with_score(query: str, k: int = 4) -> List[Tuple[Document, float]]
+        Returns the k texts most similar to the query with their cosine distance (1 minus the
+        cosine similarity), lowest first.
+    similarity_search_by_vector(embedding: List[float], k: int = 4) -> List[Document]
+        Returns the k texts most similar to a query vector.
+    batch_similarity_search_with_score(queries: List[str], k: int = 4)
+            -> List[List[Tuple[Document, float]]]
+        Embeds the queries in one call and scores them against the index in one matrix product.
+
+Functions
+
+read_manifest(persist_directory: str) -> dict or None
+    Returns the manifest saved in the directory, or None if there is none.
+
+write_manifest(persist_directory: str, store: str, embedding: str, ids: List[str]) -> None
+    Saves the manifest of a vector store: the store ('chroma' or 'numpy'), the name of the
+    embeddings (see utils_cache.embedding_name) and the ids of the texts in it. Vectors from
+    embeddings with different names are not mixed in one store.
+"""
+import json
+import logging
+import os
+import threading
+import uuid
+from dataclasses import dataclass, field
+
+import numpy as np
+
+# Set up logger
+logger = logging.getLogger('restatement')
+
+# Files of a saved index.
+VECTORS_FILE = "vectors.npy"
+INDEX_FILE = "index.json"
+# Manifest that list_to_db saves with every vector store.
+MANIFEST_FILE = "manifest.json"
+
+
+@dataclass
+class Document:
+    """A search result, with the attributes of a langchain Document."""
+    page_content: str
+    metadata: dict = field(default_factory=dict)
+
+
+@dataclass(frozen=True)
+class _Snapshot:
+    """The rows of the index at one point in time. Never changed once built."""
+    vectors: np.ndarray
+    ids: list
+    texts: list
+    metadatas: list
+
+
+def _normalize(vectors):
+    """Returns the rows of vectors as float32 unit vectors. Zero rows stay zero."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(vectors / norms, dtype=np.float32)
+
+
+def read_manifest(persist_directory):
+    """Return the manifest saved in the directory, or None if there is none."""
+    try:
+        with open(os.path.join(persist_directory, MANIFEST_FILE), 'r', encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(persist_directory, store, embedding, ids):
+    """Save the manifest of a vector store."""
+    path = os.path.join(persist_directory, MANIFEST_FILE)
+    with open(path + ".tmp", 'w', encoding="utf-8") as f:
+        json.dump({"store": store, "embedding": embedding, "ids": list(ids)}, f)
+    os.replace(path + ".tmp", path)
+
+
+class NumpyVectorIndex:
+    """An exact cosine similarity index over a float32 matrix.
+    """
+
+    def __init__(self, embedding, persist_directory=None):
+        self.embedding = embedding
+        self.persist_directory = persist_directory
+        self._snapshot = _Snapshot(np.zeros((0, 0), dtype=np.float32), [], [], [])
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, persist_directory=None):
+        """Embed the texts and build an index of them."""
+        index = cls(embedding, persist_directory)
+        index.add_texts(texts, metadatas, ids)
+        return index
+
+    @staticmethod
+    def exists(persist_directory):
+        """Return whether an index is saved in the directory."""
+        return os.path.exists(os.path.join(persist_directory, INDEX_FILE))
+
+    @classmethod
+    def load(cls, persist_directory, embedding, mmap=True):
+        """Load a saved index. The matrix is memory-mapped unless mmap is False."""
+        with open(os.path.join(persist_directory, INDEX_FILE), 'r', encoding="utf-8") as f:
+            data = json.load(f)
+        vectors = np.load(os.path.join(persist_directory, VECTORS_FILE),
+                          mmap_mode='r' if mmap else None)
+        if len(vectors) != len(data["ids"]):
+            raise ValueError(f"The vectors and index in {persist_directory} do not match.")
+        index = cls(embedding, persist_directory)
+        index._snapshot = _Snapshot(vectors, data["ids"], data["texts"], data["metadatas"])
+        return index
+
+    def __len__(self):
+        return len(self._snapshot.ids)
+
+    def add_texts(self, texts, metadatas=None, ids=None):
+        """Embed the texts and add them to the index, replacing rows with the same ids.
+        Returns their ids.
+        """
+        texts = list(texts)
+        if not texts:
+            return []
+        if metadatas is None:
+            metadatas = [{} for _ in texts]
+        if ids is None:
+            ids = [str(uuid.uuid4()) for _ in texts]
+        # Embed outside the lock, so searches and other writers are not held up.
+        vectors = _normalize(self.embedding.embed_documents(texts))
+        with self._lock:
+            old = self._without(set(ids))
+            if len(old.ids):
+                vectors = np.concatenate([old.vectors, vectors])
+            # Searches that already hold the old snapshot finish with it.
+            self._snapshot = _Snapshot(
+                vectors, old.ids + list(ids), old.texts + texts, old.metadatas + list(metadatas)
+            )
+        return list(ids)
+
+    def delete(self, ids):
+        """Remove the rows with these ids."""
+        with self._lock:
+            self._snapshot = self._without(set(ids))
+
+    def _without(self, ids):
+        """Return the current snapshot without the rows with these ids. Call with the lock."""
+        old = self._snapshot
+        keep = [row for row, id_ in enumerate(old.ids) if id_ not in ids]
+        if len(keep) == len(old.ids):
+            return old
+        return _Snapshot(
+            old.vectors[keep].reshape(len(keep), -1),
+            [old.ids[row] for row in keep],
+            [old.texts[row] for row in keep],
+            [old.metadatas[row] for row in keep]
+        )
+
+    def persist(self):
+        """Save the index to its persist_directory."""
+        if self.persist_directory is None:
+            raise ValueError("NumpyVectorIndex has no persist_directory.")
+        snapshot = self._snapshot
+        os.makedirs(self.persist_directory, exist_ok=True)
+        vectors_path = os.path.join(self.persist_directory, VECTORS_FILE)
+        index_path = os.path.join(self.persist_directory, INDEX_FILE)
+        # Write under temporary names and move into place, so a loaded index that maps the old
+        # file keeps working and a crash leaves the old index whole.
+        with open(vectors_path + ".tmp", 'wb') as f:
+            np.save(f, np.ascontiguousarray(snapshot.vectors, dtype=np.float32))
+        with open(index_path + ".tmp", 'w', encoding="utf-8") as f:
+            json.dump({"ids": snapshot.ids, "texts": snapshot.texts,
+                       "metadatas": snapshot.metadatas}, f)
+        os.replace(vectors_path + ".tmp", vectors_path)
+        os.replace(index_path + ".tmp", index_path)
+
+    def _top_k(self, snapshot, queries, k):
+        """Return the (row, cosine distance) pairs of the k nearest rows for each query."""
+        count = len(snapshot.ids)
+        k = min(k, count)
+        if k <= 0:
+            return [[] for _ in range(len(queries))]
+        # One matrix product scores every query against every row.
+        scores = queries @ snapshot.vectors.T
+        if k < count:
+            rows = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            rows = np.broadcast_to(np.arange(count), (len(queries), count))
+        results = []
+        for query_scores, query_rows in zip(scores, rows):
+            best = query_rows[np.argsort(-query_scores[query_rows], kind="stable")]
+            results.append([(int(row), float(1.0 - query_scores[row])) for row in best])
+        return results
+
+    def _results(self, snapshot, queries, k):
+        """Return the documents and cosine distances of the k nearest rows for each query."""
+        return [
+            [(Document(snapshot.texts[row], dict(snapshot.metadatas[row])), distance)
+             for row, distance in pairs]
+            for pairs in self._top_k(snapshot, queries, k)
+        ]
+
+    def similarity_search_with_score(self, query, k=4):
+        """Return the k texts most similar to the query with their cosine distance."""
+        snapshot = self._snapshot
+        if not snapshot.ids:
+            return []
+        vector = _normalize(self.embedding.embed_query(query))
+        return self._results(snapshot, vector, k)[0]
+
+    def similarity_search(self, query, k=4):
+        """Return the k texts most similar to the query."""
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    def similarity_search_by_vector(self, embedding, k=4):
+        """Return the k texts most similar to a query vector."""
+        snapshot = self._snapshot
+        if not snapshot.ids:
+            return []
+        return [doc for doc, _ in self._results(snapshot, _normalize(embedding), k)[0]]
+
+    def batch_similarity_search_with_score(self, queries, k=4):
+        """Embed the queries in one call and return the k nearest texts for each."""
+        queries = list(queries)
+        snapshot = self._snapshot
+        if not queries or not snapshot.ids:
+            return [[] for _ in queries]
+        vectors = _normalize(self.embedding.embed_documents(queries))
+        return self._results(snapshot, vectors, k)